@@ -0,0 +1,46 @@
+# bench_context.py - время БД на сборку контекста GPT: было / стало
+# Запуск: DB_HOST=... DB_NAME=... DB_USER=... DB_PASS=... python bench_context.py <user_id> [итераций]
+import sys, time, statistics
+import bot
+
+uid = int(sys.argv[1]) if len(sys.argv) > 1 else bot.ADMIN_ID
+n = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+def legacy_reminders(uid):
+    conn = bot.get_db_connection()
+    if not conn: return []
+    try:
+        c = conn.cursor()
+        c.execute("SELECT family_member, medicine_name, dosage, schedule_time, meal_relation, course_days FROM reminders WHERE user_id = %s AND active = TRUE", (uid,))
+        return c.fetchall()
+    finally: conn.close()
+
+def legacy_context(uid):
+    # Старый generate_gpt_response: 6 хелперов + запрос напоминаний, get_user_inventory ещё и get_active_cabinet внутри
+    bot.get_user_history(uid, limit=20)
+    bot.get_user_inventory(uid)
+    bot.get_active_cabinet(uid)
+    bot.get_user_family(uid)
+    bot.get_active_cabinet(uid)
+    bot.get_user_cabinets(uid)
+    legacy_reminders(uid)
+
+def one_round_trip(uid):
+    bot.build_context_text(bot.load_gpt_context(uid, history_limit=20))
+
+def run(name, fn):
+    fn(uid)  # прогрев
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        fn(uid)
+        times.append((time.perf_counter() - t) * 1000)
+    times.sort()
+    print("%-34s median %7.2f ms   p95 %7.2f ms" % (name, statistics.median(times), times[int(len(times) * 0.95) - 1]))
+
+pooled_get = bot.get_db_connection
+bot.get_db_connection = bot._db_connect  # как было: новое соединение на каждый хелпер
+run("before: connect per helper", legacy_context)
+bot.get_db_connection = pooled_get
+run("pool: same helpers", legacy_context)
+run("after: load_gpt_context (1 query)", one_round_trip)
@@ -0,0 +1,57 @@
+# bench_scheduler.py - стоимость тика встроенного планировщика при 1k..1M активных напоминаний
+# БД не нужна: планировщик заполняется синтетическим расписанием.
+# Запуск: python bench_scheduler.py [макс. число напоминаний]
+import sys, time, random
+from datetime import datetime, timedelta
+import bot
+
+max_n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+DUE_PER_MINUTE = 100  # одинаковое число сработавших в тестовую минуту при любом n
+TICKS = 200
+
+def legacy_tick(rows, current_time):
+    # Как было в cron_reminders: перебор всех активных и сравнение строки "%H:%M"
+    due = 0
+    for rid, schedule in rows:
+        if current_time in [t.strip() for t in schedule.split(",")]:
+            due += 1
+    return due
+
+print("%9s %12s %14s %16s %16s" % ("active", "load, s", "empty tick, us", "100 due tick, us", "legacy scan, ms"))
+n = 1000
+base = datetime(2026, 1, 1, 7, 0)
+while n <= max_n:
+    random.seed(n)
+    rows = []
+    for rid in range(n):
+        if rid < DUE_PER_MINUTE:
+            times = ["08:00"]
+        else:
+            tod = random.choice([t for t in range(0, 1440, 5) if t != 480])
+            times = ["%02d:%02d" % divmod(tod, 60)]
+        rows.append((rid, times, None, None))
+    sched = bot.ReminderScheduler(lambda fire_at, ids: None)
+    t = time.perf_counter()
+    sched.load(rows, base)
+    load_s = time.perf_counter() - t
+    sched.tick(base)  # минута 07:00 - сработавшие в ней не в счёт
+    # Пустые тики внутри той же минуты - ничего не срабатывает
+    t = time.perf_counter()
+    for i in range(TICKS):
+        sched.tick(base + timedelta(seconds=1))
+    empty_us = (time.perf_counter() - t) / TICKS * 1e6
+    # Проматываем до 07:59 (всё, что между, срабатывает), затем меряем тик 08:00 со 100 сработавшими
+    sched.tick(base + timedelta(minutes=59))
+    at = base + timedelta(minutes=60)
+    t = time.perf_counter()
+    for i in range(TICKS):
+        sched._cursor = sched.to_minute(at) - 1  # та же минута заново
+        fired = sched.tick(at)
+    due_us = (time.perf_counter() - t) / TICKS * 1e6
+    assert sum(len(v) for v in fired.values()) == DUE_PER_MINUTE
+    legacy_rows = [(rid, ",".join(times)) for rid, times, _, _ in rows]
+    t = time.perf_counter()
+    legacy_tick(legacy_rows, "08:00")
+    legacy_ms = (time.perf_counter() - t) * 1000
+    print("%9d %12.2f %14.1f %16.1f %16.1f" % (n, load_s, empty_us, due_us, legacy_ms))
+    n *= 10
@@ -0,0 +1,36 @@
+# bench_telegram.py - исходящая задержка на сообщение: urllib на каждый вызов против общего keep-alive клиента
+# Поднимает tg_stub.py у себя, сеть не нужна. Запуск: STUB_DELAY_MS=20 python bench_telegram.py [сообщений]
+import sys, json, time, statistics, urllib.request
+import tg_stub
+import bot
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+server = tg_stub.serve(0)
+bot.TELEGRAM_API_BASE = "http://127.0.0.1:%s" % server.server_address[1]
+
+def legacy_tg_api(method, data):
+    # Как было: новый Request и новое соединение на каждый вызов
+    url = bot.TELEGRAM_API_BASE + "/bot" + bot.TELEGRAM_TOKEN + "/" + method
+    req = urllib.request.Request(url, data=json.dumps(data).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+def one_message(api):
+    # Типичный ответ на текст: сообщение, правка, удаление служебного
+    r = api("sendMessage", {"chat_id": 1, "text": "Привет"})
+    api("editMessageText", {"chat_id": 1, "message_id": r["result"]["message_id"], "text": "Привет!"})
+    api("deleteMessage", {"chat_id": 1, "message_id": r["result"]["message_id"]})
+
+def run(name, api):
+    one_message(api)
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        one_message(api)
+        times.append((time.perf_counter() - t) * 1000)
+    times.sort()
+    print("%-28s median %7.2f ms   p95 %7.2f ms" % (name, statistics.median(times), times[int(len(times) * 0.95) - 1]))
+
+run("urllib, connect per call", legacy_tg_api)
+run("pooled keep-alive client", bot.tg_api)
+server.shutdown()
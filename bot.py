@@ -1,65 +1,673 @@
-import os, logging, io, re, tempfile, base64, json, urllib.request, psycopg2
+import os, sys, logging, io, re, base64, json, hashlib, urllib.request, psycopg2, threading, time
+import psycopg2.extensions
+import importlib.util
+import httpx
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from flask import Flask, request as flask_request
 logging.basicConfig(level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # строка на каждый запрос к Bot API/OpenAI, при потоковых правках - десятки на ответ
 logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org")  # для офлайн-замеров: tg_stub.py
 YUKASSA_SHOP_ID = os.environ.get("YUKASSA_SHOP_ID", "")
 YUKASSA_SECRET_KEY = os.environ.get("YUKASSA_SECRET_KEY", "")
 SUBSCRIPTION_PRICE = 1490
 TRIAL_DAYS = 7
 ADMIN_ID = 210064232
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY", "")  # /metrics, /debug_db, /cleanup_db: заголовок X-Admin-Key или ?key=; пусто - закрыты
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "12"))  # = потоки gunicorn (--threads 8 в Dockerfile) + UPDATE_WORKERS (4)
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))  # сек. ожидания свободного соединения
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))  # после стольких сек. простоя соединение проверяется SELECT 1
+STARTUP_MIGRATE = os.environ.get("STARTUP_MIGRATE", "1") == "1"  # 0 - миграции только через "python bot.py migrate"
+TG_POOL_SIZE = int(os.environ.get("TG_POOL_SIZE", "20"))  # keep-alive соединений к Bot API на процесс
+REMINDER_SEND_WORKERS = int(os.environ.get("REMINDER_SEND_WORKERS", "8"))
+TG_RATE_PER_SEC = float(os.environ.get("TG_RATE_PER_SEC", "28"))  # лимит Telegram ~30 сообщений/сек на бота
+TG_CHAT_INTERVAL = float(os.environ.get("TG_CHAT_INTERVAL", "1.0"))  # не чаще раза в секунду в один чат
+TG_SEND_RETRIES = int(os.environ.get("TG_SEND_RETRIES", "3"))
+CRON_CLAIM_BATCH = int(os.environ.get("CRON_CLAIM_BATCH", "2000"))
+CRON_RECLAIM_MINUTES = int(os.environ.get("CRON_RECLAIM_MINUTES", "10"))  # захваченное, но не отправленное (упал инстанс) - отдать другим
+REMINDER_SCHEDULER = os.environ.get("REMINDER_SCHEDULER", "cron")  # inprocess - свой таймер вместо ежеминутного /cron_reminders
+SCHEDULER_CATCHUP_MINUTES = int(os.environ.get("SCHEDULER_CATCHUP_MINUTES", "60"))  # сколько пропущенного досылать после рестарта
+SCHEDULER_RELOAD_MINUTES = int(os.environ.get("SCHEDULER_RELOAD_MINUTES", "5"))  # перечитывать reminder_times: напоминания с других инстансов
+# Воркеры очереди работают между запросами: на Cloud Run нужен CPU always allocated (gcloud run deploy --no-cpu-throttling),
+# иначе после ответа на /webhook CPU отбирается и update-ы лежат до следующего запроса
+UPDATE_QUEUE = os.environ.get("UPDATE_QUEUE", "1") == "1"  # 0 - обрабатывать update прямо в запросе /webhook, как раньше
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "4"))  # update-ов в обработке одновременно на процесс
+UPDATE_VISIBILITY_TIMEOUT = int(os.environ.get("UPDATE_VISIBILITY_TIMEOUT", "180"))  # сек.: не подтверждённый update снова виден воркерам
+UPDATE_MAX_ATTEMPTS = int(os.environ.get("UPDATE_MAX_ATTEMPTS", "3"))  # после стольких неудач - dead letter (status = 'dead')
+UPDATE_POLL_INTERVAL = float(os.environ.get("UPDATE_POLL_INTERVAL", "1.0"))  # опрос очереди, если свой webhook не будил
+UPDATE_DEBOUNCE_SECONDS = float(os.environ.get("UPDATE_DEBOUNCE_SECONDS", "0"))  # >0 - сообщения подряд за это время = один ход GPT
+UPDATE_MERGE_MAX = int(os.environ.get("UPDATE_MERGE_MAX", "10"))  # не больше стольких сообщений в одном ходе
+GPT_MODEL = os.environ.get("GPT_MODEL", "gpt-4o-mini")
+GPT_FALLBACK_MODEL = os.environ.get("GPT_FALLBACK_MODEL", "")  # например gpt-4.1-mini: если основная модель недоступна после повторов
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))  # повторов на один вызов
+OPENAI_RETRY_BUDGET = float(os.environ.get("OPENAI_RETRY_BUDGET", "0.2"))  # повторов на вызов в среднем по процессу - без шторма при сбое API
+GPT_CONTEXT_BUDGET = int(os.environ.get("GPT_CONTEXT_BUDGET", "3000"))  # токенов на промпт без ответа
+GPT_INVENTORY_SHARE = float(os.environ.get("GPT_INVENTORY_SHARE", "0.5"))  # доля остатка бюджета, которую может занять аптечка
+GPT_INVENTORY_TOP_K = int(os.environ.get("GPT_INVENTORY_TOP_K", "30"))  # аптечка больше - в промпт только K самых релевантных вопросу, остальные счётчиками по категориям
+GPT_RECENT_TURNS = int(os.environ.get("GPT_RECENT_TURNS", "6"))  # реплик считаются свежими (в отчёте отдельно от старых)
+GPT_TURN_MAX_TOKENS = int(os.environ.get("GPT_TURN_MAX_TOKENS", "300"))  # длинная реплика (распознанное фото) обрезается
+GPT_HISTORY_ROWS = int(os.environ.get("GPT_HISTORY_ROWS", "40"))  # сколько реплик загружать; сколько войдёт - решает бюджет
+GPT_SUMMARY = os.environ.get("GPT_SUMMARY", "1") == "1"  # старые реплики сворачиваются в резюме пользователя
+GPT_SUMMARY_EVERY = int(os.environ.get("GPT_SUMMARY_EVERY", "10"))  # K: обновлять резюме, когда вне окна накопилось столько реплик
+GPT_SUMMARY_RECENT = int(os.environ.get("GPT_SUMMARY_RECENT", "8"))  # последние реплики остаются дословно
+GPT_SUMMARY_MODEL = os.environ.get("GPT_SUMMARY_MODEL", GPT_MODEL)
+LOCAL_INTENTS = os.environ.get("LOCAL_INTENTS", "1") == "1"  # простые просьбы ("удали нурофен") - без GPT
+BULK_INGEST = os.environ.get("BULK_INGEST", "1") == "1"  # список лекарств одним сообщением - без GPT, одной транзакцией
+BULK_INGEST_MIN = int(os.environ.get("BULK_INGEST_MIN", "3"))  # от скольких пунктов сообщение считается списком
+MEDREF_PATH = os.environ.get("MEDREF_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "medicines_ref.tsv"))
+MEDREF_MIN_SCORE = float(os.environ.get("MEDREF_MIN_SCORE", "0.6"))  # порог сходства триграмм для нечёткого совпадения
+ANSWER_CACHE = os.environ.get("ANSWER_CACHE", "1") == "1"  # общий кэш ответов на справочные вопросы
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_TTL_HOURS = float(os.environ.get("ANSWER_CACHE_TTL_HOURS", "72"))
+ANSWER_CACHE_NEAR_DUP = float(os.environ.get("ANSWER_CACHE_NEAR_DUP", "0"))  # например 0.8: похожий вопрос тоже попадание; 0 - только точный ключ
+ANSWER_CACHE_DB = os.environ.get("ANSWER_CACHE_DB", "0") == "1"  # второй уровень в Postgres (answer_cache)
+GPT_TOOLS = os.environ.get("GPT_TOOLS", "0") == "1"  # действия через вызов функций (tools) с JSON-схемами вместо команд в скобках
+GPT_PROMPT_MEDREF = os.environ.get("GPT_PROMPT_MEDREF", "1") == "1"  # справочник лекарств в неизменной части системного промпта
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("PROMPT_CACHE_MIN_TOKENS", "1024"))  # префикс короче провайдер не кэширует
+GPT_STREAM = os.environ.get("GPT_STREAM", "1") == "1"  # ответ GPT появляется по мере генерации (правками одного сообщения)
+GPT_STREAM_EDIT_INTERVAL = float(os.environ.get("GPT_STREAM_EDIT_INTERVAL", "1.0"))  # сек. между правками одного сообщения
+GPT_STREAM_MIN_CHARS = int(os.environ.get("GPT_STREAM_MIN_CHARS", "20"))  # меньше - ещё не отправляем
+DEDUP_LRU_SIZE = int(os.environ.get("DEDUP_LRU_SIZE", "10000"))  # последних update_id в памяти процесса
+DEDUP_TTL_HOURS = int(os.environ.get("DEDUP_TTL_HOURS", "48"))  # Telegram хранит недоставленные update-ы сутки
 
 app = Flask(__name__)
 
 def get_config():
     return {"OPENAI_API_KEY": OPENAI_API_KEY, "TELEGRAM_TOKEN": TELEGRAM_TOKEN, "DB_NAME": os.getenv("DB_NAME",""), "DB_USER": os.getenv("DB_USER",""), "DB_PASS": os.getenv("DB_PASS",""), "INSTANCE_CONNECTION_NAME": os.getenv("INSTANCE_CONNECTION_NAME",""), "DB_HOST": os.getenv("DB_HOST","")}
 
-def get_db_connection():
+def _db_connect():
     cfg = get_config()
+    if cfg["INSTANCE_CONNECTION_NAME"]:
+        return psycopg2.connect(host="/cloudsql/"+cfg["INSTANCE_CONNECTION_NAME"], database=cfg["DB_NAME"], user=cfg["DB_USER"], password=cfg["DB_PASS"], connect_timeout=10)
+    return psycopg2.connect(host=cfg["DB_HOST"], database=cfg["DB_NAME"], user=cfg["DB_USER"], password=cfg["DB_PASS"], connect_timeout=10)
+
+# === DB pool ===
+
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул, остальное проксируется в psycopg2"""
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+class DBPool:
+    """Потокобезопасный пул соединений: проверка живости, переподключение после failover, ограниченное ожидание"""
+    def __init__(self, size, timeout, check_idle):
+        self.size = size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, время возврата)], берём с конца - самое тёплое
+        self._open = 0
+        self.in_use = 0
+        self.stats = {"acquired": 0, "created": 0, "reconnects": 0, "timeouts": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0}
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeout("no free DB connection in %.1fs (in use %s/%s)" % (self.timeout, self.in_use, self.size))
+                self._cond.wait(left)
+            conn, released_at = self._idle.pop() if self._idle else (None, 0)
+            if conn is None:
+                self._open += 1
+            self.in_use += 1
+            wait_ms = (time.monotonic() - start) * 1000
+            self.stats["acquired"] += 1
+            self.stats["wait_total_ms"] += wait_ms
+            self.stats["wait_max_ms"] = max(self.stats["wait_max_ms"], wait_ms)
+        try:
+            if conn is not None and (conn.closed or (time.monotonic() - released_at > self.check_idle and not self._alive(conn))):
+                # После failover умирают все соединения сразу - простаивающие тоже не жильцы
+                self._discard(conn)
+                self._drop_idle()
+                conn = None
+                with self._cond:
+                    self.stats["reconnects"] += 1
+            if conn is None:
+                conn = _db_connect()
+                with self._cond:
+                    self.stats["created"] += 1
+            return PooledConnection(self, conn)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try: conn.rollback()
+            except Exception: broken = True
+        with self._cond:
+            self.in_use -= 1
+            if broken:
+                self._open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._discard(conn)
+
+    def _alive(self, conn):
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1")
+            c.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+
+    def _drop_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def snapshot(self):
+        with self._cond:
+            st = dict(self.stats)
+            st.update({"size": self.size, "open": self._open, "idle": len(self._idle), "in_use": self.in_use})
+        st["wait_avg_ms"] = round(st["wait_total_ms"] / st["acquired"], 2) if st["acquired"] else 0.0
+        return st
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
+    return _db_pool
+
+_unit_local = threading.local()
+
+class UnitCursor:
+    """Курсор единицы работы: отмечает, что хелпер что-то записал"""
+    def __init__(self, unit, cur):
+        self._unit = unit
+        self._cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, params=None):
+        if not sql.lstrip()[:6].upper() == "SELECT":
+            self._unit.dirty = True
+        return self._cur.execute(sql, params)
+
+class UnitConnection:
+    """Соединение update-а, которое получают хелперы внутри db_unit().
+    commit() и close() не трогают транзакцию - она фиксируется в db_release() перед внешним вызовом или в конце update.
+    После каждого пишущего хелпера ставится SAVEPOINT, rollback() откатывает только до него."""
+    def __init__(self, unit):
+        self._unit = unit
+
+    def __getattr__(self, name):
+        return getattr(self._unit.acquire(), name)
+
+    def cursor(self, *args, **kwargs):
+        return UnitCursor(self._unit, self._unit.acquire().cursor(*args, **kwargs))
+
+    def commit(self):
+        self._unit.mark()
+
+    def close(self):
+        self._unit.mark()
+
+    def rollback(self):
+        self._unit.rollback_to_mark()
+
+class DBUnit:
+    def __init__(self):
+        self.conn = None  # берётся из пула при первом обращении к БД, отдаётся в db_release()
+        self.dirty = False
+        self.has_mark = False
+        self.pending = []       # db_after_commit() после последнего SAVEPOINT - пропадают при откате к нему
+        self.after_commit = []  # вызываются, когда транзакция действительно зафиксирована
+
+    def acquire(self):
+        if self.conn is None:
+            self.conn = get_db_pool().acquire()
+        return self.conn
+
+    def release(self, commit=True):
+        """Зафиксировать (или откатить) транзакцию и вернуть соединение в пул"""
+        conn, self.conn = self.conn, None
+        self.dirty = self.has_mark = False
+        callbacks, self.after_commit, self.pending = self.after_commit + self.pending, [], []
+        if conn is None:
+            return
+        try:
+            if commit and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                conn.commit()
+            else:
+                conn.rollback()
+                callbacks = []
+        finally:
+            conn.close()
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                logger.error("After commit err: %s", e)
+
+    def mark(self):
+        if self.dirty and self.conn is not None and self.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            self.conn.cursor().execute("SAVEPOINT unit_mark")
+            self.has_mark = True
+        self.after_commit += self.pending
+        self.pending = []
+        self.dirty = False
+
+    def rollback_to_mark(self):
+        if self.conn is None:
+            pass  # уже зафиксировано в db_release()
+        elif self.has_mark:
+            self.conn.cursor().execute("ROLLBACK TO SAVEPOINT unit_mark")
+        else:
+            self.conn.rollback()
+            self.after_commit = []
+        self.pending = []
+        self.dirty = False
+
+    def recover(self):
+        # Хелпер поймал исключение и не откатился сам ("except: return []")
+        if self.conn is not None and self.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            logger.warning("Unit of work: recovering aborted transaction")
+            self.rollback_to_mark()
+
+@contextmanager
+def db_unit():
+    """Одно соединение и одна транзакция на каждый отрезок обработки update-а между внешними вызовами.
+    Все хелперы внутри блока через get_db_connection() получают это соединение; Whisper, GPT и Telegram
+    вызываются после db_release() - соединение не занято и транзакция не висит открытой на время сети."""
+    if getattr(_unit_local, "unit", None) is not None:
+        yield _unit_local.unit
+        return
+    unit = DBUnit()
+    _unit_local.unit = unit
     try:
-        if cfg["INSTANCE_CONNECTION_NAME"]:
-            return psycopg2.connect(host="/cloudsql/"+cfg["INSTANCE_CONNECTION_NAME"], database=cfg["DB_NAME"], user=cfg["DB_USER"], password=cfg["DB_PASS"], connect_timeout=10)
-        return psycopg2.connect(host=cfg["DB_HOST"], database=cfg["DB_NAME"], user=cfg["DB_USER"], password=cfg["DB_PASS"], connect_timeout=10)
+        yield unit
+        if unit.conn is not None and unit.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            unit.rollback_to_mark()
+        unit.release()
+    except Exception:
+        try: unit.release(commit=False)
+        except Exception: pass
+        raise
+    finally:
+        _unit_local.unit = None
+
+def db_release():
+    """Перед внешним вызовом: зафиксировать сделанное в db_unit() и вернуть соединение в пул.
+    Следующий хелпер возьмёт соединение заново. Вне db_unit() - ничего не делает"""
+    unit = getattr(_unit_local, "unit", None)
+    if unit is not None and unit.conn is not None:
+        unit.recover()
+        try:
+            unit.release()
+        except Exception as e:
+            logger.error("DB release err: %s", e)
+
+def db_after_commit(fn):
+    """fn() - после фиксации текущей транзакции db_unit(); откатилась - не вызывается"""
+    _unit_local.unit.pending.append(fn)
+
+def get_db_connection():
+    unit = getattr(_unit_local, "unit", None)
+    try:
+        if unit is not None:
+            unit.recover()
+            unit.acquire()
+            return UnitConnection(unit)
+        return get_db_pool().acquire()
     except Exception as e:
         logger.error("DB err: %s", e)
         return None
 
-def init_db():
+# === Schema migrations ===
+# (версия, описание, [SQL]) - новые только дописывать в конец, применённые не менять.
+# Индексы на больших горячих таблицах (messages, inventory, reminder_log) - CONCURRENTLY: строятся вне транзакции
+# миграции и не блокируют запись. Поэтому все операторы миграции должны быть идемпотентны (IF NOT EXISTS, ON CONFLICT)
+
+MIGRATIONS = [
+    (1, "base schema", [
+        "CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, username TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS messages (id SERIAL PRIMARY KEY, user_id BIGINT, role TEXT NOT NULL, content TEXT NOT NULL, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS inventory (id SERIAL PRIMARY KEY, user_id BIGINT, medicine_name TEXT NOT NULL, quantity INTEGER DEFAULT 1, dosage TEXT, expiry_date DATE, category TEXT, notes TEXT, cabinet_id INTEGER DEFAULT 0, storage TEXT DEFAULT '', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS family (id SERIAL PRIMARY KEY, user_id BIGINT, name TEXT NOT NULL, age INTEGER, gender TEXT, relation TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS reminders (id SERIAL PRIMARY KEY, user_id BIGINT, family_member TEXT, medicine_name TEXT NOT NULL, dosage TEXT, schedule_time TEXT NOT NULL, meal_relation TEXT DEFAULT '', course_days INTEGER DEFAULT 0, pills_per_dose REAL DEFAULT 1, pills_in_pack INTEGER DEFAULT 0, pills_remaining REAL DEFAULT 0, start_date DATE, end_date DATE, active BOOLEAN DEFAULT TRUE, last_reminded TIMESTAMP, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS cabinets (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, name TEXT NOT NULL DEFAULT 'Моя аптечка', is_default BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS shared_access (id SERIAL PRIMARY KEY, owner_id BIGINT NOT NULL, shared_with_id BIGINT NOT NULL, shared_with_username TEXT, relation TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(owner_id, shared_with_id))",
+        "CREATE TABLE IF NOT EXISTS user_state (user_id BIGINT PRIMARY KEY, active_cabinet_id INTEGER DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS subscriptions (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL UNIQUE, plan TEXT DEFAULT 'free', started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expires_at TIMESTAMP, trial_used BOOLEAN DEFAULT FALSE, payment_id TEXT)",
+        "CREATE TABLE IF NOT EXISTS payments (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, payment_id TEXT UNIQUE, amount DECIMAL(10,2), status TEXT DEFAULT 'pending', promo_code TEXT, discount_percent INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, confirmed_at TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS promo_codes (id SERIAL PRIMARY KEY, code TEXT UNIQUE NOT NULL, action TEXT DEFAULT 'discount', discount_percent INTEGER DEFAULT 0, free_days INTEGER DEFAULT 0, max_uses INTEGER DEFAULT 0, used_count INTEGER DEFAULT 0, active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS promo_usage (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, promo_id INTEGER REFERENCES promo_codes(id), used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(user_id, promo_id))",
+        "ALTER TABLE inventory ADD COLUMN IF NOT EXISTS storage TEXT DEFAULT ''",
+        # reminder_log раньше создавался и в init_db, и в cleanup_db с разными колонками - сводим к одной схеме
+        """CREATE TABLE IF NOT EXISTS reminder_log (
+            id SERIAL PRIMARY KEY,
+            reminder_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            scheduled_time TIMESTAMP NOT NULL,
+            status TEXT DEFAULT 'pending',
+            snooze_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT NOW(),
+            completed_at TIMESTAMP
+        )""",
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS user_id BIGINT",
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS scheduled_time TIMESTAMP",
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS snooze_count INTEGER DEFAULT 0",
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW()",
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP",
+        "ALTER TABLE reminder_log ALTER COLUMN status SET DEFAULT 'pending'",
+    ]),
+    (2, "indexes for hot queries", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_user_ts_idx ON messages (user_id, timestamp DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_user_cab_idx ON inventory (user_id, cabinet_id, medicine_name)",
+        "CREATE INDEX IF NOT EXISTS family_user_idx ON family (user_id)",
+        "CREATE INDEX IF NOT EXISTS cabinets_user_idx ON cabinets (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS reminders_active_user_idx ON reminders (user_id) WHERE active = TRUE",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminder_log_rem_sched_idx ON reminder_log (reminder_id, scheduled_time, status)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminder_log_snoozed_idx ON reminder_log (scheduled_time) WHERE status = 'snoozed'",
+        "CREATE INDEX IF NOT EXISTS promo_codes_upper_code_idx ON promo_codes (UPPER(code)) WHERE active = TRUE",
+    ]),
+    (3, "reminder_times and set-based cron", [
+        # Одна строка на каждое время приёма: cron ищет по индексу fire_time, а не перебирает все напоминания
+        "CREATE TABLE IF NOT EXISTS reminder_times (reminder_id INTEGER NOT NULL, user_id BIGINT NOT NULL, fire_time TIME NOT NULL, PRIMARY KEY (reminder_id, fire_time))",
+        "CREATE INDEX IF NOT EXISTS reminder_times_fire_idx ON reminder_times (fire_time)",
+        r"""INSERT INTO reminder_times (reminder_id, user_id, fire_time)
+            SELECT r.id, r.user_id, t::time FROM reminders r, regexp_split_to_table(trim(r.schedule_time), '\s*,\s*') t
+            WHERE r.active = TRUE AND t ~ '^([01]?\d|2[0-3]):[0-5]\d$' AND r.user_id IS NOT NULL
+            ON CONFLICT DO NOTHING""",
+        # fire_time - плановое время дозы, не меняется при откладывании; уникальность = "уже отправлено"
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS fire_time TIMESTAMP",
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS reminder_log_fire_uniq ON reminder_log (reminder_id, fire_time)",
+        "CREATE INDEX IF NOT EXISTS reminders_course_end_idx ON reminders ((start_date + course_days)) WHERE active = TRUE AND course_days > 0",
+    ]),
+    (4, "reminder_log as a claimable send queue", [
+        "ALTER TABLE reminder_log ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminder_log_queue_idx ON reminder_log (user_id, id) WHERE status IN ('queued', 'sending')",
+    ]),
+    (5, "durable update queue", [
+        # Сырой update от Telegram: webhook только сохраняет, обрабатывают воркеры. Обработанные удаляются
+        """CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            update_id BIGINT,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            visible_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )""",
+        "CREATE INDEX IF NOT EXISTS update_queue_ready_idx ON update_queue (visible_at, id) WHERE status = 'queued'",
+    ]),
+    (6, "update deduplication", [
+        # key: u:<update_id> или cb:<callback_query id>
+        "CREATE TABLE IF NOT EXISTS processed_updates (key TEXT PRIMARY KEY, created_at TIMESTAMP NOT NULL DEFAULT NOW())",
+        "CREATE INDEX IF NOT EXISTS processed_updates_created_idx ON processed_updates (created_at)",
+    ]),
+    (7, "per-user update ordering", [
+        # Update пользователя берётся в работу, только когда более ранних его update-ов в очереди нет
+        "ALTER TABLE update_queue ADD COLUMN IF NOT EXISTS user_id BIGINT",
+        "ALTER TABLE update_queue ADD COLUMN IF NOT EXISTS mergeable BOOLEAN NOT NULL DEFAULT FALSE",
+        "CREATE INDEX IF NOT EXISTS update_queue_user_idx ON update_queue (user_id, id) WHERE status = 'queued'",
+    ]),
+    (8, "rolling conversation summaries", [
+        # last_message_id - до какой реплики включительно история свёрнута в summary
+        "CREATE TABLE IF NOT EXISTS conversation_summaries (user_id BIGINT PRIMARY KEY, summary TEXT NOT NULL DEFAULT '', last_message_id INTEGER NOT NULL DEFAULT 0, updated_at TIMESTAMP DEFAULT NOW())",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_user_id_idx ON messages (user_id, id)",
+    ]),
+    (9, "shared answer cache", [
+        "CREATE TABLE IF NOT EXISTS answer_cache (key TEXT PRIMARY KEY, question TEXT, answer TEXT NOT NULL, hits INTEGER NOT NULL DEFAULT 0, created_at TIMESTAMP NOT NULL DEFAULT NOW())",
+        "CREATE INDEX IF NOT EXISTS answer_cache_created_idx ON answer_cache (created_at)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(c):
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return c.fetchone()[0]
+
+def run_concurrently(conn, sql):
+    """CREATE INDEX CONCURRENTLY - только вне транзакции. Недостроенный (INVALID) после прошлого сбоя индекс
+    IF NOT EXISTS посчитал бы готовым - такой сначала удаляется"""
+    conn.commit()
+    conn.set_session(autocommit=True)
+    try:
+        c = conn.cursor()
+        name = re.search(r"IF NOT EXISTS (\w+)", sql).group(1)
+        c.execute("SELECT 1 FROM pg_class ic JOIN pg_index i ON i.indexrelid = ic.oid WHERE ic.relname = %s AND NOT i.indisvalid", (name,))
+        if c.fetchone():
+            c.execute("DROP INDEX CONCURRENTLY IF EXISTS " + name)
+        c.execute(sql)
+    finally:
+        conn.set_session(autocommit=False)
+
+def migrate():
+    """Применить недостающие миграции, каждую в своей транзакции (индексы CONCURRENTLY - отдельно от неё)"""
     conn = get_db_connection()
     if not conn:
-        return
+        return False
     try:
         c = conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, username TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS messages (id SERIAL PRIMARY KEY, user_id BIGINT, role TEXT NOT NULL, content TEXT NOT NULL, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS inventory (id SERIAL PRIMARY KEY, user_id BIGINT, medicine_name TEXT NOT NULL, quantity INTEGER DEFAULT 1, dosage TEXT, expiry_date DATE, category TEXT, notes TEXT, cabinet_id INTEGER DEFAULT 0, storage TEXT DEFAULT '', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS family (id SERIAL PRIMARY KEY, user_id BIGINT, name TEXT NOT NULL, age INTEGER, gender TEXT, relation TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS reminders (id SERIAL PRIMARY KEY, user_id BIGINT, family_member TEXT, medicine_name TEXT NOT NULL, dosage TEXT, schedule_time TEXT NOT NULL, meal_relation TEXT DEFAULT '', course_days INTEGER DEFAULT 0, pills_per_dose REAL DEFAULT 1, pills_in_pack INTEGER DEFAULT 0, pills_remaining REAL DEFAULT 0, start_date DATE, end_date DATE, active BOOLEAN DEFAULT TRUE, last_reminded TIMESTAMP, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS cabinets (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, name TEXT NOT NULL DEFAULT 'Моя аптечка', is_default BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS shared_access (id SERIAL PRIMARY KEY, owner_id BIGINT NOT NULL, shared_with_id BIGINT NOT NULL, shared_with_username TEXT, relation TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(owner_id, shared_with_id))")
-        c.execute("CREATE TABLE IF NOT EXISTS user_state (user_id BIGINT PRIMARY KEY, active_cabinet_id INTEGER DEFAULT 0)")
-        c.execute("CREATE TABLE IF NOT EXISTS subscriptions (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL UNIQUE, plan TEXT DEFAULT 'free', started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expires_at TIMESTAMP, trial_used BOOLEAN DEFAULT FALSE, payment_id TEXT)")
-        c.execute("CREATE TABLE IF NOT EXISTS payments (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, payment_id TEXT UNIQUE, amount DECIMAL(10,2), status TEXT DEFAULT 'pending', promo_code TEXT, discount_percent INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, confirmed_at TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS promo_codes (id SERIAL PRIMARY KEY, code TEXT UNIQUE NOT NULL, action TEXT DEFAULT 'discount', discount_percent INTEGER DEFAULT 0, free_days INTEGER DEFAULT 0, max_uses INTEGER DEFAULT 0, used_count INTEGER DEFAULT 0, active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        c.execute("CREATE TABLE IF NOT EXISTS promo_usage (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, promo_id INTEGER REFERENCES promo_codes(id), used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE(user_id, promo_id))")
-        c.execute("CREATE TABLE IF NOT EXISTS reminder_log (id SERIAL PRIMARY KEY, reminder_id INTEGER REFERENCES reminders(id), sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, status TEXT DEFAULT 'sent')")
+        # Несколько инстансов могут стартовать одновременно - мигрирует один, остальные ждут
+        c.execute("SELECT pg_advisory_lock(hashtext('nebolit_migrate'))")
         try:
-            c.execute("ALTER TABLE inventory ADD COLUMN IF NOT EXISTS storage TEXT DEFAULT ''")
+            current = get_schema_version(c)
             conn.commit()
-        except:
+            for version, desc, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                for sql in statements:
+                    if " CONCURRENTLY " in sql:
+                        run_concurrently(conn, sql)
+                    else:
+                        c.execute(sql)
+                c.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, desc))
+                conn.commit()
+                logger.info("Migration %s applied: %s", version, desc)
+        finally:
             conn.rollback()
-        c.execute("DELETE FROM reminders WHERE medicine_name IN ('лекарство','medicine','test') OR family_member IN ('член_семьи','member')")
-        c.execute("DELETE FROM inventory WHERE dosage = 'дозировка' OR category = 'категория' OR medicine_name IN ('лекарство','medicine','test')")
-        c.execute("DELETE FROM family WHERE name IN ('имя','name','test','член_семьи','member') OR gender IN ('пол','gender') OR relation IN ('отношение','relation','родство') OR age = 0")
-        conn.commit()
-        logger.info("DB init OK")
+            c.execute("SELECT pg_advisory_unlock(hashtext('nebolit_migrate'))")
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error("Migrate err: %s", e)
+        return False
+    finally:
+        conn.close()
+
+# Горячие запросы и таблицы, по которым в плане не должно быть Seq Scan
+HOT_QUERIES = [
+    ("history", "messages", "SELECT role, content FROM messages WHERE user_id = %(uid)s ORDER BY timestamp DESC LIMIT 20"),
+    ("inventory", "inventory", "SELECT medicine_name, quantity, dosage, expiry_date, category, storage FROM inventory WHERE user_id = %(uid)s AND cabinet_id = 0 ORDER BY medicine_name"),
+    ("family", "family", "SELECT name, age, gender, relation FROM family WHERE user_id = %(uid)s"),
+    ("cabinets", "cabinets", "SELECT id, name, is_default FROM cabinets WHERE user_id = %(uid)s ORDER BY id"),
+    ("user reminders", "reminders", "SELECT family_member, medicine_name FROM reminders WHERE user_id = %(uid)s AND active = TRUE"),
+    ("due reminders", "reminder_times", "SELECT r.id FROM reminder_times t JOIN reminders r ON r.id = t.reminder_id WHERE t.fire_time = '08:00'::time AND r.active = TRUE"),
+    ("finished courses", "reminders", "SELECT id FROM reminders WHERE active = TRUE AND course_days > 0 AND start_date + course_days < CURRENT_DATE"),
+    ("snoozed reminders", "reminder_log", "SELECT id, snooze_count FROM reminder_log WHERE status = 'snoozed' AND scheduled_time <= NOW() AND snooze_count < 3"),
+    ("reminder queue", "reminder_log", "SELECT id FROM reminder_log WHERE status IN ('queued', 'sending') ORDER BY user_id, id LIMIT 100"),
+    ("update queue", "update_queue", "SELECT id FROM update_queue WHERE status = 'queued' AND visible_at <= NOW() ORDER BY id LIMIT 1"),
+    ("user update order", "update_queue", "SELECT 1 FROM update_queue WHERE user_id = %(uid)s AND status = 'queued' AND id < 100"),
+    ("promo code", "promo_codes", "SELECT id FROM promo_codes WHERE UPPER(code) = UPPER('NB-TEST') AND active = TRUE"),
+]
+
+def check_query_plans():
+    """EXPLAIN горячих запросов; с enable_seqscan=off Seq Scan остаётся только там, где нет подходящего индекса"""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    results = []
+    try:
+        c = conn.cursor()
+        c.execute("SET LOCAL enable_seqscan = off")
+        for name, tables, sql in HOT_QUERIES + [("gpt context", "messages,inventory,family,cabinets,reminders", GPT_CONTEXT_SQL)]:
+            c.execute("EXPLAIN " + sql, {"uid": 0, "limit": 20})
+            plan = "\n".join(r[0] for r in c.fetchall())
+            seq = [t for t in tables.split(",") if "Seq Scan on %s" % t in plan]
+            results.append((name, not seq, plan))
+            if seq:
+                logger.warning("Seq scan in hot query '%s' on %s:\n%s", name, ", ".join(seq), plan)
+        conn.rollback()
+        return results
     except Exception as e:
-        logger.error("Init DB err: %s", e)
+        logger.error("Check plans err: %s", e)
+        return None
+    finally:
+        conn.close()
+
+def ensure_schema():
+    """На старте: одна проверка версии, миграции - только если схема отстала"""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        c = conn.cursor()
+        try:
+            c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = c.fetchone()[0]
+        except psycopg2.Error:
+            conn.rollback()
+            current = 0
+    finally:
+        conn.close()
+    if current >= SCHEMA_VERSION:
+        return True
+    if not STARTUP_MIGRATE:
+        logger.warning("Schema version %s < %s, run: python bot.py migrate", current, SCHEMA_VERSION)
+        return False
+    return migrate()
+
+# === Maintenance (offline: python bot.py maintenance) ===
+
+MAINTENANCE_SQL = [
+    ("template reminders", "DELETE FROM reminders WHERE medicine_name IN ('лекарство','medicine','test') OR family_member IN ('член_семьи','member')"),
+    ("template inventory", "DELETE FROM inventory WHERE dosage = 'дозировка' OR category = 'категория' OR medicine_name IN ('лекарство','medicine','test')"),
+    ("non-medicine inventory", "DELETE FROM inventory WHERE LOWER(medicine_name) IN ('лев', 'циньян', 'ян', 'анна')"),
+    ("template family", "DELETE FROM family WHERE LOWER(name) IN ('имя','name','test','член_семьи','member') OR gender IN ('пол','gender') OR relation IN ('отношение','relation','родство') OR age = 0"),
+    ("family duplicates", "DELETE FROM family WHERE id NOT IN (SELECT MIN(id) FROM family GROUP BY user_id, LOWER(name))"),
+    ("expired update keys", "DELETE FROM processed_updates WHERE created_at < NOW() - INTERVAL '%s hours'" % DEDUP_TTL_HOURS),
+    ("expired cached answers", "DELETE FROM answer_cache WHERE created_at < NOW() - INTERVAL '%s hours'" % ANSWER_CACHE_TTL_HOURS),
+    ("old dead updates", "DELETE FROM update_queue WHERE status = 'dead' AND created_at < NOW() - INTERVAL '14 days'"),
+]
+
+def run_maintenance():
+    """Чистка мусора от шаблонных команд GPT. Тяжёлые DELETE по целым таблицам - не на старте инстанса"""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        c = conn.cursor()
+        done = []
+        for label, sql in MAINTENANCE_SQL:
+            c.execute(sql)
+            done.append((label, c.rowcount))
+            conn.commit()
+        logger.info("Maintenance: %s", done)
+        return done
+    except Exception as e:
+        logger.error("Maintenance err: %s", e)
+        conn.rollback()
+        return None
     finally:
         conn.close()
 
+# === Warm-up ===
+
+_warmup = {"started": False, "ready": False, "steps": {}}
+_warmup_lock = threading.Lock()
+
+def _warm_db():
+    if not ensure_schema():
+        # Старая схема - не READY: иначе инстанс примет трафик и упадёт на первом же запросе к новым таблицам
+        raise RuntimeError("schema is not current, run: python bot.py migrate")
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("no DB connection")
+    conn.close()
+
+def _warm_openai():
+    get_openai_client()  # тяжёлый импорт openai и клиент - до первого сообщения
+
+def _warm_telegram():
+    # Открыть keep-alive соединение (TCP+TLS) к Bot API заранее
+    get_tg_client()
+    tg_api("getMe")
+
+WARMUP_STEPS = [
+    ("db", _warm_db),
+    ("openai", _warm_openai),
+    ("telegram", _warm_telegram),
+]
+
+def _run_warmup():
+    ok = True
+    for name, fn in WARMUP_STEPS:
+        t = time.monotonic()
+        try:
+            fn()
+            _warmup["steps"][name] = "ok %.0f ms" % ((time.monotonic() - t) * 1000)
+        except Exception as e:
+            ok = False
+            _warmup["steps"][name] = "error: %s" % e
+            logger.error("Warm-up %s err: %s", name, e)
+    _warmup["ready"] = ok
+    if not ok:
+        # Повторим при следующем /ready
+        with _warmup_lock:
+            _warmup["started"] = False
+
+def start_warmup():
+    with _warmup_lock:
+        if _warmup["started"]:
+            return
+        _warmup["started"] = True
+    threading.Thread(target=_run_warmup, name="warmup", daemon=True).start()
+
 def md_to_html(text):
     text = re.sub(r'\*\*\*(.+?)\*\*\*', r'<b><i>\1</i></b>', text)
     text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
@@ -165,8 +773,7 @@ def get_user_inventory(uid):
     if not conn: return []
     try:
         c = conn.cursor()
-        cab_id, _ = get_active_cabinet(uid)
-        c.execute("SELECT medicine_name, quantity, dosage, expiry_date, category, storage FROM inventory WHERE user_id = %s AND cabinet_id = %s ORDER BY medicine_name", (uid, cab_id))
+        c.execute("SELECT medicine_name, quantity, dosage, expiry_date, category, storage FROM inventory WHERE user_id = %s AND cabinet_id = COALESCE((SELECT active_cabinet_id FROM user_state WHERE user_id = %s), 0) ORDER BY medicine_name", (uid, uid))
         return c.fetchall()
     except Exception as e: logger.error("Inv err: %s", e); return []
     finally: conn.close()
@@ -181,6 +788,636 @@ def get_user_family(uid):
     except: return []
     finally: conn.close()
 
+# === Medicine reference ===
+# Справочник частых безрецептурных лекарств (medicines_ref.tsv рядом с ботом): название, синонимы, вещество, дозировка,
+# категория, хранение. Имена сравниваются в грубой латинице ("Нурофен" и "Nurofen" -> "nurofen"), опечатки
+# ("нурафен") ловит триграммный индекс. Поиск - микросекунды, без обращения к модели
+
+CATEGORIES = ("ТЕМПЕРАТУРА", "БОЛЬ", "ЖИВОТ", "РАНЫ", "РАЗНОЕ")
+STORAGES = ("ХОЛОДИЛЬНИК", "КОМНАТНАЯ")
+TRANSLIT = dict(zip("абвгдеёзийклмнопрстуфыэ", "abvgdeezijklmnoprstufie"))
+TRANSLIT.update({"ж": "zh", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ь": "", "ю": "u", "я": "ia"})
+LATIN_SOUNDS = (("ph", "f"), ("th", "t"), ("kh", "h"), ("ck", "k"), ("c", "k"), ("x", "ks"), ("w", "v"), ("y", "i"), ("j", "i"), ("q", "k"))
+
+def translit_key(name):
+    """Ключ сравнения имён: транслит, латинские буквосочетания по звучанию, без двойных букв и знаков"""
+    s = "".join(TRANSLIT.get(ch, ch) for ch in name.lower())
+    s = re.sub(r"c(?=[eiy])", "ts", s)  # Citramon -> tsitramon, как Цитрамон
+    for a, b in LATIN_SOUNDS:
+        s = s.replace(a, b)
+    s = re.sub(r"[^a-z0-9]+", " ", s).strip()
+    return re.sub(r"(.)\1+", r"\1", s)
+
+def edit_distance(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def trigrams(key):
+    k = "  %s " % key
+    return {k[i:i + 3] for i in range(len(k) - 2)}
+
+@dataclass
+class MedEntry:
+    name: str
+    substance: str
+    dosage: str
+    category: str
+    storage: str
+
+class MedRef:
+    """Индекс справочника: точный ключ -> (запись, как писать имя), триграмма -> ключи"""
+    def __init__(self, rows=()):
+        self._exact = {}
+        self._grams = {}
+        self.entries = []
+        for name, aliases, substance, dosage, category, storage in rows:
+            entry = MedEntry(name, substance, dosage, category, storage)
+            self.entries.append(entry)
+            for alias in [name] + [a.strip() for a in aliases.split(",") if a.strip()]:
+                key = translit_key(alias)
+                if not key or key in self._exact:
+                    continue
+                # Русский синоним пишем как пользователь его знает ("Панадол"), латинский - основным именем
+                self._exact[key] = (entry, alias if re.search(r"[а-яё]", alias.lower()) else name)
+                for g in trigrams(key):
+                    self._grams.setdefault(g, []).append(key)
+
+    @classmethod
+    def load(cls, path):
+        rows = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("#") or not line.strip():
+                        continue
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 6:
+                        rows.append(parts)
+        except OSError as e:
+            logger.warning("Medicine reference not loaded: %s", e)
+        return cls(rows)
+
+    def match(self, name, min_score=MEDREF_MIN_SCORE):
+        """(запись, имя для аптечки, точное ли совпадение) или (None, None, False). "Нурофен 200 мг" ищется как "Нурофен".
+        Нечёткое совпадение - только подсказка: "Энтерол" похож на "Энтеросгель", "Аспирин Кардио" - не "Аспирин" """
+        full = translit_key(name)
+        if full in self._exact:
+            return self._exact[full] + (True,)  # "Мезим форте 10000" - своя строка справочника
+        name = re.sub(r"\s+\d.*$", "", name.strip())
+        key = translit_key(name)
+        if not key:
+            return None, None, False
+        if key in self._exact:
+            return self._exact[key] + (True,)
+        grams = trigrams(key)
+        counts = {}
+        for g in grams:
+            for k in self._grams.get(g, ()):
+                counts[k] = counts.get(k, 0) + 1
+        best, best_score = None, min_score
+        for k, n in counts.items():
+            score = 2.0 * n / (len(grams) + len(k) + 2)  # Dice по триграммам; у ключа длины L их L+2
+            if score >= best_score:
+                best, best_score = k, score
+        if best:
+            return self._exact[best] + (False,)
+        # Одна-две опечатки в коротком имени ("нурафен") рвут слишком много триграмм - добираем расстоянием правки
+        allowed = 1 if len(key) < 8 else 2
+        top = sorted((k for k, n in counts.items() if n >= 2 and abs(len(k) - len(key)) <= allowed), key=counts.get, reverse=True)[:10]
+        near = [k for k in top if edit_distance(k, key) <= allowed]
+        if len(key) >= 5 and len({self._exact[k][0].name for k in near}) == 1:
+            return self._exact[near[0]] + (False,)
+        first = key.split(" ")[0]
+        if first != key and len(first) >= 4 and first in self._exact:
+            return self._exact[first] + (False,)  # "Нурофен Экспресс" -> похоже на Нурофен
+        return None, None, False
+
+    def lookup(self, name, exact=False):
+        """Запись справочника; exact=True - только при точном совпадении (переименование, удаление)"""
+        entry, _, is_exact = self.match(name)
+        return entry if is_exact or not exact else None
+
+    def find_in_text(self, text, limit=3):
+        """Лекарства справочника, упомянутые в свободном тексте (ответ vision): точные 1-2 слова или близкое длинное слово"""
+        words = re.findall(r"[A-Za-zА-Яа-яЁё\-]+", text)
+        found = []
+        for i, w in enumerate(words):
+            for cand in ([w + " " + words[i + 1]] if i + 1 < len(words) else []) + [w]:
+                if len(cand) < 4:
+                    continue
+                key = translit_key(cand)
+                entry = self._exact.get(key, (None,))[0]
+                if entry is None and len(cand) >= 6 and cand[0].isupper():
+                    entry = self.match(cand, min_score=0.75)[0]
+                if entry and entry not in found:
+                    found.append(entry)
+                    break
+            if len(found) >= limit:
+                break
+        return found
+
+# Слова силы и формы: синоним с ними, которых нет в имени записи, - другой препарат по дозировке
+STRENGTH_FORM_RE = re.compile(r"\b(?:форте|forte|макс|max|экспресс|express|дет\w*|сироп\w*|суспенз\w*|свеч\w*|гель|мазь|крем|спрей|капли|\d+)\b", re.IGNORECASE)
+
+def normalize_medicine(name, dosage, category, storage):
+    """Поля ADD_MEDICINE по справочнику. Точное совпадение - имя как в справочнике, дозировка если не указана,
+    категория и хранение из справочника. Нечёткое - имя и дозировка как есть, справочник только заполняет пустые поля.
+    Категория по умолчанию (РАЗНОЕ) - только здесь, после справочника"""
+    if category and category.upper() not in CATEGORIES:
+        category = None
+    entry, display, exact = medref.match(name)
+    if not entry:
+        return name, dosage, category or "РАЗНОЕ", storage
+    if not exact:
+        if len(re.sub(r"\s+\d.*$", "", name.strip()).split()) > 1:
+            return name, dosage, category or "РАЗНОЕ", storage  # "Аспирин Кардио" - другой препарат, не Аспирин
+        return name, dosage, category or entry.category, storage or entry.storage
+    if not dosage or dosage.strip() in ("?", "-"):
+        own = set(w.lower() for w in STRENGTH_FORM_RE.findall(entry.name))
+        if all(w.lower() in own for w in STRENGTH_FORM_RE.findall(display)):
+            dosage = entry.dosage or dosage
+    return display, dosage, entry.category, entry.storage
+
+def describe_medicine(entry):
+    return "%s (%s)" % (entry.name, ", ".join(f for f in (entry.substance, entry.dosage, entry.category, entry.storage) if f))
+
+medref = MedRef.load(MEDREF_PATH)
+
+# === GPT context ===
+
+@dataclass
+class GptContext:
+    """Всё, что нужно промпту о пользователе, одним запросом"""
+    cabinet_id: int = 0
+    cabinet_name: str = "Моя аптечка"
+    history: list = field(default_factory=list)    # [{"role", "content"}], старые сначала
+    inventory: list = field(default_factory=list)  # [(medicine_name, quantity, dosage, expiry_date, category, storage)]
+    family: list = field(default_factory=list)     # [(name, age, gender, relation)]
+    cabinets: list = field(default_factory=list)   # [(id, name, is_default)]
+    reminders: list = field(default_factory=list)  # [(family_member, medicine_name, dosage, schedule_time, meal_relation, course_days)]
+    summary: str = ""                              # резюме реплик до summary_upto (их нет в history)
+    summary_upto: int = 0
+
+GPT_CONTEXT_SQL = """
+WITH st AS (
+    SELECT COALESCE((SELECT active_cabinet_id FROM user_state WHERE user_id = %(uid)s), 0) AS cab_id
+), summ AS (
+    SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = %(uid)s
+), hist AS (
+    SELECT role, content, timestamp FROM messages
+    WHERE user_id = %(uid)s AND id > COALESCE((SELECT last_message_id FROM summ), 0)
+    ORDER BY timestamp DESC LIMIT %(limit)s
+)
+SELECT
+    st.cab_id,
+    (SELECT name FROM cabinets WHERE id = st.cab_id),
+    (SELECT COALESCE(json_agg(json_build_array(role, content) ORDER BY timestamp), '[]') FROM hist),
+    (SELECT COALESCE(json_agg(json_build_array(medicine_name, quantity, dosage, expiry_date, category, storage) ORDER BY medicine_name), '[]')
+        FROM inventory WHERE user_id = %(uid)s AND cabinet_id = st.cab_id),
+    (SELECT COALESCE(json_agg(json_build_array(name, age, gender, relation) ORDER BY id), '[]') FROM family WHERE user_id = %(uid)s),
+    (SELECT COALESCE(json_agg(json_build_array(id, name, is_default) ORDER BY id), '[]') FROM cabinets WHERE user_id = %(uid)s),
+    (SELECT COALESCE(json_agg(json_build_array(family_member, medicine_name, dosage, schedule_time, meal_relation, course_days) ORDER BY id), '[]')
+        FROM reminders WHERE user_id = %(uid)s AND active = TRUE),
+    (SELECT summary FROM summ),
+    COALESCE((SELECT last_message_id FROM summ), 0)
+FROM st
+"""
+
+def load_gpt_context(uid, history_limit=20):
+    """История, активная аптечка, лекарства, семья, аптечки и напоминания за один round trip"""
+    ctx = GptContext()
+    conn = get_db_connection()
+    if not conn: return ctx
+    try:
+        c = conn.cursor()
+        c.execute(GPT_CONTEXT_SQL, {"uid": uid, "limit": history_limit})
+        cab_id, cab_name, hist, inv, fam, cabs, rems, ctx.summary, ctx.summary_upto = c.fetchone()
+        ctx.summary = ctx.summary or ""
+        ctx.cabinet_id = cab_id
+        if cab_id > 0 and cab_name:
+            ctx.cabinet_name = cab_name
+        ctx.history = [{"role": h[0], "content": h[1]} for h in hist]
+        ctx.inventory = [tuple(m) for m in inv]
+        ctx.family = [tuple(f) for f in fam]
+        ctx.cabinets = [tuple(cb) for cb in cabs]
+        ctx.reminders = [tuple(r) for r in rems]
+    except Exception as e: logger.error("Ctx err: %s", e)
+    finally: conn.close()
+    return ctx
+
+def inventory_line(m):
+    storage_info = ""
+    if m[5] and m[5].strip():
+        storage_info = ", хранение: %s" % m[5]
+    return "- %s, кол-во: %s, дозировка: %s, годен до: %s, категория: %s%s" % (m[0], m[1], m[2] or "?", m[3] or "?", m[4] or "?", storage_info)
+
+def build_context_text(ctx, inv_lines=None, omitted=0):
+    """inv_lines - уже отобранные строки аптечки (по умолчанию вся), omitted - сколько не вошло (число или {категория: число})"""
+    from datetime import date as _date
+    if inv_lines is None:
+        inv_lines = [inventory_line(m) for m in ctx.inventory]
+    inv_text = "Аптечка пуста."
+    if inv_lines:
+        inv_text = "\n".join(inv_lines)
+        if isinstance(omitted, dict) and omitted:
+            inv_text += "\n- ...и ещё %s лекарств не показаны: %s" % (sum(omitted.values()), ", ".join(
+                "%s %s" % (cat, n) for cat, n in sorted(omitted.items(), key=lambda kv: -kv[1])))
+        elif omitted:
+            inv_text += "\n- ...и ещё %s лекарств (не показаны)" % omitted
+    fam_text = "Семья не указана."
+    if ctx.family:
+        fam_text = "\n".join(["- %s, %s лет, %s, %s" % (f[0], f[1], f[2], f[3]) for f in ctx.family])
+    cab_text = "Сегодня: %s. Текущая аптечка: %s" % (_date.today().isoformat(), ctx.cabinet_name)
+    if ctx.cabinets:
+        cab_text += ". Все аптечки: " + ", ".join([c[1] for c in ctx.cabinets])
+    rem_text = "Напоминаний нет."
+    if ctx.reminders:
+        rlines = []
+        for r in ctx.reminders:
+            course_str = "бессрочно" if (r[5] == 0 or r[5] is None) else "%s дней" % r[5]
+            rlines.append("- %s %s, приём: %s %s, курс: %s" % (r[1], ("для "+r[0]) if r[0] else "", r[3], r[4] or "", course_str))
+        rem_text = "\n".join(rlines)
+    return cab_text + "\nАптечка:\n" + inv_text + "\nСемья:\n" + fam_text + "\nНапоминания:\n" + rem_text
+
+# === Prompt budget ===
+
+SUMMARY_HEADER = "Ранее в разговоре (кратко):\n"
+MSG_OVERHEAD_TOKENS = 4  # служебные токены на каждое сообщение chat-формата
+_tokenizer = None
+
+def count_tokens(text):
+    """Токены o200k_base (gpt-4o*) через tiktoken; без него - оценка ~3 символа кириллицы на токен"""
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            import tiktoken
+            _tokenizer = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logger.warning("tiktoken unavailable, estimating tokens: %s", e)
+            _tokenizer = False
+    if _tokenizer:
+        return len(_tokenizer.encode(text))
+    return len(text) // 3 + 1
+
+def truncate_tokens(text, limit):
+    if count_tokens(text) <= limit:
+        return text
+    if _tokenizer:
+        return _tokenizer.decode(_tokenizer.encode(text)[:limit]) + " ..."
+    return text[:limit * 3] + " ..."
+
+# Симптомы в вопросе -> категории аптечки, которые стоит показать GPT первыми (основы слов)
+SYMPTOM_CATEGORIES = {
+    "ТЕМПЕРАТУРА": ("темпер", "жар", "простуд", "грипп", "орви", "озноб", "лихорад"),
+    "БОЛЬ": ("болит", "боль", "голов", "зуб", "спин", "мигрен", "спазм", "месячн", "сустав", "мышц"),
+    "ЖИВОТ": ("живот", "желуд", "понос", "диаре", "тошн", "рвот", "изжог", "запор", "отрав", "вздут", "кишеч"),
+    "РАНЫ": ("порез", "ран", "ссадин", "ожог", "царап", "ушиб", "синяк", "кровот", "мозол", "укус"),
+    "РАЗНОЕ": ("аллерг", "кашел", "кашля", "насмор", "нос", "горл", "глаз", "уш", "давлен", "сердц", "нерв", "сон", "витамин"),
+}
+EXPIRY_WORDS = ("срок", "просроч", "годн", "истек", "выброс")
+
+def inventory_doc(m):
+    """Слова строки аптечки для лексического индекса: название, категория и действующее вещество из справочника"""
+    entry = medref.lookup(m[0])
+    text = "%s %s %s" % (m[0], m[4] or "", entry.substance + " " + entry.name if entry else "")
+    return set(w[:5] for w in re.findall(r"\w{4,}", text.lower().replace("ё", "е")))
+
+def rank_inventory(inventory, user_text, with_scores=False):
+    """Лекарства по релевантности вопросу, при равенстве - как были.
+    Слова вопроса против индекса строк (редкое в аптечке слово весит больше), +3 за категорию, подходящую
+    к симптому, +3 просроченным и истекающим, если спрашивают о сроках"""
+    import math
+    text = user_text.lower().replace("ё", "е")
+    stems = set(w[:5] for w in re.findall(r"\w{4,}", text))
+    docs = [inventory_doc(m) for m in inventory]
+    df = {}
+    for d in docs:
+        for w in d & stems:
+            df[w] = df.get(w, 0) + 1
+    wanted = set(cat for cat, words in SYMPTOM_CATEGORIES.items() if any(re.search(r"\b" + w, text) for w in words))
+    about_expiry = any(w in text for w in EXPIRY_WORDS)
+    scored = []
+    for i, (m, d) in enumerate(zip(inventory, docs)):
+        score = sum(1 + math.log(len(inventory) / df[w]) for w in d & stems)
+        if (m[4] or "").upper() in wanted:
+            score += 3
+        if about_expiry and check_expiry(m[3])[0] != "ok":
+            score += 3
+        scored.append((-score, i, m))
+    scored.sort()
+    if with_scores:
+        return [(m, -s) for s, i, m in scored]
+    return [m for s, i, m in scored]
+
+class PromptStats:
+    """Средние токены промпта по разделам - в /metrics"""
+    SECTIONS = ("system", "context", "summary", "inventory", "recent", "older", "user", "total")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.sums = dict.fromkeys(self.SECTIONS, 0)
+        self.inventory_dropped = 0
+        self.trimmed_requests = 0
+
+    def record(self, report):
+        with self._lock:
+            self.requests += 1
+            for k in self.SECTIONS:
+                self.sums[k] += report.get(k, 0)
+            if report.get("inventory_dropped"):
+                self.inventory_dropped += report["inventory_dropped"]
+                self.trimmed_requests += 1
+
+    def snapshot(self):
+        with self._lock:
+            avg = dict((k, round(v / self.requests)) for k, v in self.sums.items()) if self.requests else {}
+            return {"requests": self.requests, "avg_tokens": avg,
+                    "inventory_trimmed_requests": self.trimmed_requests, "inventory_dropped_rows": self.inventory_dropped}
+
+prompt_stats = PromptStats()
+
+def build_messages(ctx, user_text, budget=GPT_CONTEXT_BUDGET, system=None, tools=None):
+    """Сообщения для chat.completions в пределах budget токенов и отчёт по разделам.
+    Приоритет: системный промпт и вопрос (всегда), лекарства по релевантности (не больше GPT_INVENTORY_TOP_K строк
+    и GPT_INVENTORY_SHARE остатка), свежие реплики, старые реплики. Не вошедшие лекарства - одной строкой со счётчиками по категориям.
+    Порядок - под кэш промптов провайдера (он кэширует общий префикс от PROMPT_CACHE_MIN_TOKENS): сначала неизменный
+    ACTIVE_SYSTEM_PROMPT со справочником (одинаковый до байта у всех), потом то, что у пользователя меняется редко
+    (резюме) или только дописывается (история), и лишь в конце - дата, аптечка, семья, напоминания, которые меняются от запроса к запросу"""
+    report = dict.fromkeys(PromptStats.SECTIONS, 0)
+    system = system or ACTIVE_SYSTEM_PROMPT
+    report["system"] = count_tokens(system) + MSG_OVERHEAD_TOKENS
+    if tools:
+        report["system"] += count_tokens(json.dumps(tools, ensure_ascii=False))
+    report["user"] = count_tokens(user_text) + MSG_OVERHEAD_TOKENS
+    report["context"] = count_tokens(build_context_text(ctx, inv_lines=[])) + MSG_OVERHEAD_TOKENS
+    summary_text = SUMMARY_HEADER + ctx.summary if ctx.summary else ""
+    if summary_text:
+        report["summary"] = count_tokens(summary_text) + MSG_OVERHEAD_TOKENS
+    left = budget - report["system"] - report["user"] - report["context"] - report["summary"]
+    inv_left = int(max(left, 0) * GPT_INVENTORY_SHARE)
+    inv_lines = []
+    ranked = rank_inventory(ctx.inventory, user_text)
+    for n, m in enumerate(ranked):
+        if n >= GPT_INVENTORY_TOP_K and len(ranked) > GPT_INVENTORY_TOP_K:
+            break
+        line = inventory_line(m)
+        t = count_tokens(line) + 1
+        if t > inv_left:
+            break
+        inv_left -= t
+        report["inventory"] += t
+        inv_lines.append(line)
+    omitted = {}
+    for m in ranked[len(inv_lines):]:
+        cat = (m[4] or "?").upper()
+        omitted[cat] = omitted.get(cat, 0) + 1
+    left -= report["inventory"]
+    history = []
+    for i, h in enumerate(reversed(ctx.history)):
+        content = truncate_tokens(h["content"], GPT_TURN_MAX_TOKENS)
+        t = count_tokens(content) + MSG_OVERHEAD_TOKENS
+        if t > left:
+            break
+        left -= t
+        report["recent" if i < GPT_RECENT_TURNS else "older"] += t
+        history.append({"role": h["role"], "content": content})
+    history.reverse()
+    messages = [{"role": "system", "content": system}]
+    if summary_text:
+        messages.append({"role": "system", "content": summary_text})
+    messages.extend(history)
+    messages.append({"role": "system", "content": build_context_text(ctx, inv_lines, omitted)})
+    messages.append({"role": "user", "content": user_text})
+    report["total"] = sum(report[k] for k in PromptStats.SECTIONS if k != "total")
+    report.update({"budget": budget, "inventory_items": "%s/%s" % (len(inv_lines), len(ctx.inventory)),
+                   "inventory_dropped": len(ctx.inventory) - len(inv_lines),
+                   "turns": "%s/%s" % (len(history), len(ctx.history))})
+    return messages, report
+
+# === Conversation summaries ===
+
+SUMMARY_PROMPT = """Ты ведёшь краткое резюме переписки пользователя с ботом домашней аптечки НеБолит.
+Обнови резюме с учётом новых реплик. Сохрани долгосрочные факты: здоровье и хронические состояния членов семьи, аллергии и непереносимости, назначения врача, предпочтения пользователя, нерешённые вопросы. Не пересказывай содержимое аптечки и список напоминаний - они передаются боту отдельно. Не больше 120 слов, по-русски, без вступлений."""
+
+SUMMARY_BATCH = 100  # реплик за один вызов GPT - у давних пользователей история сворачивается за несколько заходов
+
+_summary_executor = None
+_summary_inflight = set()
+_summary_lock = threading.Lock()
+
+def schedule_summary(uid):
+    """Обновить резюме в фоне, не задерживая ответ; один пользователь - не больше одной задачи сразу"""
+    global _summary_executor
+    from concurrent.futures import ThreadPoolExecutor
+    with _summary_lock:
+        if uid in _summary_inflight:
+            return
+        _summary_inflight.add(uid)
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+    _summary_executor.submit(_summary_job, uid)
+
+def _summary_job(uid):
+    try:
+        while update_summary(uid):
+            pass
+    except Exception as e: logger.error("Summary err %s: %s", uid, e)
+    finally:
+        with _summary_lock:
+            _summary_inflight.discard(uid)
+
+def update_summary(uid):
+    """Свернуть в резюме реплики вне окна GPT_SUMMARY_RECENT (не больше SUMMARY_BATCH). True - свернули, может остаться ещё"""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        c = conn.cursor()
+        c.execute("SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = %s", (uid,))
+        row = c.fetchone()
+        summary, upto = row if row else ("", 0)
+        c.execute("""SELECT id, role, content FROM (
+                         SELECT id, role, content FROM messages WHERE user_id = %s AND id > %s ORDER BY id DESC OFFSET %s
+                     ) t ORDER BY id LIMIT %s""", (uid, upto, GPT_SUMMARY_RECENT, SUMMARY_BATCH))
+        rows = c.fetchall()
+        conn.rollback()
+    finally: conn.close()
+    if len(rows) < GPT_SUMMARY_EVERY:
+        return False
+    turns = "\n".join("%s: %s" % ("Пользователь" if r[1] == "user" else "Бот", truncate_tokens(clean_commands(r[2]), GPT_TURN_MAX_TOKENS)) for r in rows)
+    resp = openai_call("summary", lambda client, m: client.chat.completions.create(model=m, max_tokens=400, temperature=0.2, messages=[
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": "Текущее резюме:\n%s\n\nНовые реплики:\n%s" % (summary or "(пусто)", turns)}]), model=GPT_SUMMARY_MODEL)
+    new_summary = (resp.choices[0].message.content or "").strip()
+    if not new_summary:
+        return False
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        c = conn.cursor()
+        # last_message_id = upto: параллельное обновление (другой инстанс) не затрём
+        c.execute("""INSERT INTO conversation_summaries (user_id, summary, last_message_id) VALUES (%s, %s, %s)
+                     ON CONFLICT (user_id) DO UPDATE SET summary = EXCLUDED.summary, last_message_id = EXCLUDED.last_message_id, updated_at = NOW()
+                     WHERE conversation_summaries.last_message_id = %s""", (uid, new_summary, rows[-1][0], upto))
+        conn.commit()
+        logger.info("Summary for %s: folded %s messages up to %s", uid, len(rows), rows[-1][0])
+        return c.rowcount > 0 and len(rows) == SUMMARY_BATCH
+    except Exception as e:
+        logger.error("Summary save err: %s", e)
+        conn.rollback()
+        return False
+    finally: conn.close()
+
+# === Answer cache ===
+# Общие ответы на справочные вопросы ("что такое ибупрофен", "побочные парацетамола"): у пользователя без
+# аптечки, семьи, напоминаний и резюме ответ GPT от него не зависит - его можно отдать следующему.
+# Память процесса (LRU + TTL) и, по желанию, answer_cache в Postgres - общий для инстансов и переживает рестарт
+
+FREE_WORDS = ["что такое", "для чего", "от чего", "зачем", "описание", "инструкция", "побочные", "аналог", "что принять", "что выпить", "болит", "температура", "кашель", "насморк", "тошнит", "голова"]
+CACHE_STOP_WORDS = {"пожалуйста", "подскажи", "подскажите", "скажи", "скажите", "расскажи", "расскажите", "мне", "привет", "здравствуйте", "бот", "ли"}
+FOLLOW_UP_RE = re.compile(r"^(а|и|тогда|ещё|еще|также|так|ну)\b")
+
+def answer_cache_stems(text):
+    """Слова вопроса целиком (ё=е) без вежливых слов - порядок не важен. Не обрезаем: "кларитин" и "кларитромицин",
+    "амоксиклав" и "амоксициллин" - разные лекарства"""
+    words = re.findall(r"[а-яa-z0-9\-]+", text.lower().replace("ё", "е"))
+    return frozenset(w for w in words if w not in CACHE_STOP_WORDS)
+
+def answer_cache_key(ctx, user_text):
+    """Ключ общего кэша или None - вопрос личный / уточняющий, у пользователя есть свои данные"""
+    text = user_text.strip().lower()
+    if ctx.inventory or ctx.family or ctx.reminders or ctx.summary:
+        return None
+    # Вопрос уже сохранён в историю перед вызовом GPT - он не в счёт; любая реплика до него делает вопрос
+    # зависимым от разговора ("а детям можно?")
+    prior = ctx.history
+    if prior and prior[-1]["role"] == "user" and prior[-1]["content"].strip() == user_text.strip():
+        prior = prior[:-1]
+    if prior:
+        return None
+    if not any(w in text for w in FREE_WORDS) or FOLLOW_UP_RE.match(text) or len(text) > 120 or "\n" in text:
+        return None
+    stems = answer_cache_stems(text)
+    if not 2 <= len(stems) <= 12:
+        return None
+    return " ".join(sorted(stems))
+
+def has_commands(text):
+    return re.search(r"\[[A-Z_]+:", text) is not None
+
+class AnswerCache:
+    """LRU в памяти с TTL; near_dup > 0 - ещё и поиск похожего вопроса (доля общих слов не меньше near_dup).
+    Отличаться при этом могут только короткие служебные слова ("от", "для", "при") - длинное слово может быть
+    другим лекарством"""
+    def __init__(self, size=ANSWER_CACHE_SIZE, ttl_hours=ANSWER_CACHE_TTL_HOURS, near_dup=ANSWER_CACHE_NEAR_DUP, use_db=ANSWER_CACHE_DB):
+        from collections import OrderedDict
+        self.size = size
+        self.ttl = ttl_hours * 3600
+        self.near_dup = near_dup
+        self.use_db = use_db
+        self._items = OrderedDict()  # key -> (answer, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {"hits_memory": 0, "hits_near": 0, "hits_db": 0, "misses": 0, "bypass": 0, "stores": 0}
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _get_memory(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[1] > now:
+                self._items.move_to_end(key)
+                self.stats["hits_memory"] += 1
+                return item[0]
+            if item:
+                del self._items[key]
+            if self.near_dup > 0:
+                stems = set(key.split())
+                best, best_score = None, self.near_dup
+                for k, (answer, expires) in self._items.items():
+                    if expires <= now:
+                        continue
+                    other = set(k.split())
+                    if any(len(w) > 4 for w in stems ^ other):
+                        continue
+                    score = len(stems & other) / len(stems | other)
+                    if score >= best_score:
+                        best, best_score = k, score
+                if best:
+                    self._items.move_to_end(best)
+                    self.stats["hits_near"] += 1
+                    return self._items[best][0]
+        return None
+
+    def _put_memory(self, key, answer, expires):
+        with self._lock:
+            self._items[key] = (answer, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def get(self, key):
+        answer = self._get_memory(key)
+        if answer is not None or not self.use_db:
+            if answer is None:
+                self.count("misses")
+            return answer
+        conn = get_db_connection()
+        if conn:
+            try:
+                c = conn.cursor()
+                c.execute("""UPDATE answer_cache SET hits = hits + 1 WHERE key = %s AND created_at > NOW() - %s * INTERVAL '1 hour'
+                             RETURNING answer, EXTRACT(EPOCH FROM created_at + %s * INTERVAL '1 hour' - NOW())""", (key, self.ttl / 3600, self.ttl / 3600))
+                row = c.fetchone()
+                conn.commit()
+                if row:
+                    self._put_memory(key, row[0], time.time() + float(row[1]))
+                    self.count("hits_db")
+                    return row[0]
+            except Exception as e:
+                logger.error("Answer cache err: %s", e)
+                try: conn.rollback()
+                except: pass
+            finally: conn.close()
+        self.count("misses")
+        return None
+
+    def put(self, key, question, answer):
+        self._put_memory(key, answer, time.time() + self.ttl)
+        self.count("stores")
+        if not self.use_db:
+            return
+        conn = get_db_connection()
+        if not conn: return
+        try:
+            c = conn.cursor()
+            c.execute("""INSERT INTO answer_cache (key, question, answer) VALUES (%s, %s, %s)
+                         ON CONFLICT (key) DO UPDATE SET question = EXCLUDED.question, answer = EXCLUDED.answer, created_at = NOW()""",
+                      (key, question[:500], answer))
+            conn.commit()
+        except Exception as e:
+            logger.error("Answer cache save err: %s", e)
+            try: conn.rollback()
+            except: pass
+        finally: conn.close()
+
+    def snapshot(self):
+        with self._lock:
+            st = dict(self.stats)
+            st["size"] = len(self._items)
+        hits = st["hits_memory"] + st["hits_near"] + st["hits_db"]
+        st["hit_rate"] = round(hits / (hits + st["misses"]), 3) if hits + st["misses"] else 0.0
+        return st
+
+answer_cache = AnswerCache()
+
 # === Subscription ===
 
 def get_subscription(uid):
@@ -263,26 +1500,143 @@ def create_yukassa_payment(uid, amount, description="Подписка НеБол
         return payment_id, pay_url
     except Exception as e: logger.error("YuKassa err: %s", e); return None, None
 
+# === OpenAI client ===
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Общий клиент на процесс: один пул соединений к API вместо нового TLS на каждый вызов.
+    Повторы SDK выключены - ими управляет openai_call"""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0,
+                                        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT))
+    return _openai_client
+
+class RetryBudget:
+    """Каждый вызов пополняет бюджет на ratio, повтор тратит 1: при сбое API повторов не больше ratio от потока"""
+    def __init__(self, ratio, cap=10):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+class OpenAIMetrics:
+    """Задержка и токены по видам вызовов (chat, chat_stream, vision, whisper), последние 1000 задержек.
+    cached_tokens - часть промпта из кэша провайдера; задержка отдельно для вызовов с попаданием в кэш и без"""
+    LISTS = ("latencies", "cached_latencies", "uncached_latencies")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.kinds = {}
+
+    def _kind(self, kind):
+        return self.kinds.setdefault(kind, {"calls": 0, "errors": 0, "retries": 0, "fallbacks": 0, "prompt_tokens": 0,
+                                            "completion_tokens": 0, "cached_tokens": 0, "cache_hits": 0,
+                                            "latencies": [], "cached_latencies": [], "uncached_latencies": []})
+
+    def record(self, kind, seconds, usage=None):
+        with self._lock:
+            k = self._kind(kind)
+            k["calls"] += 1
+            k["latencies"] = k["latencies"][-999:] + [seconds]
+            if usage is not None and hasattr(usage, "prompt_tokens"):
+                k["prompt_tokens"] += usage.prompt_tokens or 0
+                k["completion_tokens"] += usage.completion_tokens or 0
+                cached = usage_cached_tokens(usage)
+                k["cached_tokens"] += cached
+                k["cache_hits"] += 1 if cached else 0
+                key = "cached_latencies" if cached else "uncached_latencies"
+                k[key] = k[key][-999:] + [seconds]
+
+    def count(self, kind, key):
+        with self._lock:
+            self._kind(kind)[key] += 1
+
+    def snapshot(self):
+        out = {}
+        with self._lock:
+            for kind, k in self.kinds.items():
+                lat = sorted(k["latencies"])
+                out[kind] = dict((n, v) for n, v in k.items() if n not in self.LISTS)
+                out[kind].update({"p50_ms": round(percentile(lat, 50) * 1000), "p99_ms": round(percentile(lat, 99) * 1000)})
+                if k["prompt_tokens"]:
+                    out[kind].update({"cached_share": round(k["cached_tokens"] / k["prompt_tokens"], 3),
+                                      "p50_cached_ms": round(percentile(sorted(k["cached_latencies"]), 50) * 1000),
+                                      "p50_uncached_ms": round(percentile(sorted(k["uncached_latencies"]), 50) * 1000)})
+        return out
+
+def usage_cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+openai_retry_budget = RetryBudget(OPENAI_RETRY_BUDGET)
+openai_metrics = OpenAIMetrics()
+
+class StreamInterrupted(Exception):
+    """Обрыв потока после первых фрагментов: повтор продублировал бы уже показанный текст"""
+
+def openai_call(kind, fn, model=GPT_MODEL, fallback=True):
+    """fn(client, model) -> ответ. Сетевые ошибки, 429 и 5xx повторяются (не больше OPENAI_MAX_RETRIES и бюджета),
+    затем - один заход на GPT_FALLBACK_MODEL. Задержка и usage ответа - в openai_metrics"""
+    import openai
+    retryable = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+    models = [model] + ([GPT_FALLBACK_MODEL] if fallback and GPT_FALLBACK_MODEL and GPT_FALLBACK_MODEL != model else [])
+    db_release()
+    client = get_openai_client()
+    openai_retry_budget.deposit()
+    error = None
+    for i, m in enumerate(models):
+        if i:
+            logger.warning("OpenAI %s: falling back to %s after %s", kind, m, error)
+            openai_metrics.count(kind, "fallbacks")
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            t = time.monotonic()
+            try:
+                result = fn(client, m)
+                openai_metrics.record(kind, time.monotonic() - t, getattr(result, "usage", None))
+                return result
+            except retryable as e:
+                openai_metrics.count(kind, "errors")
+                error = e
+                if attempt == OPENAI_MAX_RETRIES or not openai_retry_budget.withdraw():
+                    break
+                openai_metrics.count(kind, "retries")
+                time.sleep(0.5 * 2 ** attempt)
+            except Exception:
+                openai_metrics.count(kind, "errors")
+                raise
+    raise error
+
 # === Voice & Photo ===
 
 def process_voice(voice_bytes):
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
     try:
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as tmp:
-            tmp.write(voice_bytes); tmp_path = tmp.name
-        with open(tmp_path, "rb") as af:
-            transcript = client.audio.transcriptions.create(model="whisper-1", file=af, language="ru")
-        os.unlink(tmp_path)
+        # Файл из памяти: без временного файла на диске, и повтор может отправить его заново
+        transcript = openai_call("whisper", lambda client, m: client.audio.transcriptions.create(
+            model=m, file=("voice.ogg", voice_bytes), language="ru"), model="whisper-1", fallback=False)
         return transcript.text.strip()
     except Exception as e: logger.error("Whisper err: %s", e); return ""
 
 def process_photo_vision(photo_bytes):
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
     try:
         b64 = base64.b64encode(photo_bytes).decode("utf-8")
-        resp = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role":"user","content":[{"type":"text","text":"На фото упаковка лекарства. Определи название, действующее вещество, дозировку, срок годности, показания, категорию. Также определи условия хранения: если лекарство требует хранения в холодильнике (2-8°C) — укажи ХОЛОДИЛЬНИК, иначе — КОМНАТНАЯ. Кратко."},{"type":"image_url","image_url":{"url":"data:image/jpeg;base64,"+b64}}]}], max_tokens=500)
+        resp = openai_call("vision", lambda client, m: client.chat.completions.create(model=m, messages=[{"role":"user","content":[{"type":"text","text":"На фото упаковка лекарства. Определи название, действующее вещество, дозировку, срок годности, показания, категорию. Также определи условия хранения: если лекарство требует хранения в холодильнике (2-8°C) — укажи ХОЛОДИЛЬНИК, иначе — КОМНАТНАЯ. Кратко. Если на фото несколько разных упаковок — вместо этого перечисли их нумерованным списком, по строке на упаковку: название, дозировка, срок годности."},{"type":"image_url","image_url":{"url":"data:image/jpeg;base64,"+b64}}]}], max_tokens=500))
         return resp.choices[0].message.content
     except Exception as e: logger.error("Vision err: %s", e); return ""
 
@@ -294,7 +1648,7 @@ SYSTEM_PROMPT = """Ты умный и дружелюбный помощник п
 [ADD_MEDICINE:название|количество|дозировка|срок|категория|хранение] - добавить лекарство.
 Поле хранение: ХОЛОДИЛЬНИК или КОМНАТНАЯ. Определяй сам на основе знаний о лекарстве. Лекарства, требующие холодильника: инсулин, свечи (суппозитории), многие глазные капли, вакцины, интерфероны, некоторые мази, живые пробиотики (Линекс, Бифидумбактерин), Виферон свечи, оксолиновая мазь и др. Если сомневаешься — ставь КОМНАТНАЯ.
 
-КАТЕГОРИИ определяй сам: ТЕМПЕРАТУРА, БОЛЬ, ЖИВОТ, РАНЫ, РАЗНОЕ. НИКОГДА не спрашивай категорию.
+КАТЕГОРИИ определяй сам: ТЕМПЕРАТУРА, БОЛЬ, ЖИВОТ, РАНЫ, РАЗНОЕ. НИКОГДА не спрашивай категорию. Частые лекарства бот дополнительно сверит со справочником.
 [REMOVE_MEDICINE:название] - удалить лекарство.
 [REMOVE_FAMILY:имя] - удалить члена семьи.
 [ADD_FAMILY:имя|возраст|пол|отношение] - добавить семью.
@@ -303,7 +1657,7 @@ SYSTEM_PROMPT = """Ты умный и дружелюбный помощник п
 [SWITCH_CABINET:название] - переключить.
 [SHARE_ACCESS:@username|отношение] - поделиться.
 
-При добавлении лекарства: определи правильное название, стандартную дозировку если не указана, категорию сам, условия хранения сам.
+При добавлении лекарства: определи правильное название, стандартную дозировку если не указана, категорию сам, условия хранения сам. Если называют силу или форму (форте, детский, сироп) - дозировка именно этой формы.
 СТРОГАЯ ПРОВЕРКА СРОКОВ: сравнивай с текущей датой. Просрочено — НЕ добавляй, предупреди. Менее 2 месяцев — предупреди. Годно — зелёная галочка. Формат срока: ГГГГ-ММ-ДД или ГГГГ-ММ.
 НИКОГДА не подставляй шаблонные значения.
 
@@ -314,52 +1668,111 @@ SYSTEM_PROMPT = """Ты умный и дружелюбный помощник п
 Для напоминаний ОБЯЗАТЕЛЬНО используй [ADD_REMINDER:...].
 НИКОГДА не используй шаблонные значения типа "имя", "возраст", "пол", "отношение" - только реальные данные от пользователя!"""
 
-def generate_gpt_response(uid, user_text):
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    history = get_user_history(uid, limit=20)
-    inventory = get_user_inventory(uid)
-    family = get_user_family(uid)
-    inv_text = "Аптечка пуста."
-    if inventory:
-        inv_lines = []
-        for m in inventory:
-            storage_info = ""
-            if m[5] and m[5].strip():
-                storage_info = ", хранение: %s" % m[5]
-            inv_lines.append("- %s, кол-во: %s, дозировка: %s, годен до: %s, категория: %s%s" % (m[0], m[1], m[2] or "?", m[3] or "?", m[4] or "?", storage_info))
-        inv_text = "\n".join(inv_lines)
-    fam_text = "Семья не указана."
-    if family:
-        fam_text = "\n".join(["- %s, %s лет, %s, %s" % (f[0], f[1], f[2], f[3]) for f in family])
-    from datetime import date as _date
-    cab_id, cab_name = get_active_cabinet(uid)
-    cab_text = "Сегодня: %s. Текущая аптечка: %s" % (_date.today().isoformat(), cab_name)
-    cabs = get_user_cabinets(uid)
-    if cabs:
-        cab_text += ". Все аптечки: " + ", ".join([c[1] for c in cabs])
-    rem_text = "Напоминаний нет."
-    conn2 = get_db_connection()
-    if conn2:
-        try:
-            c2 = conn2.cursor()
-            c2.execute("SELECT family_member, medicine_name, dosage, schedule_time, meal_relation, course_days FROM reminders WHERE user_id = %s AND active = TRUE", (uid,))
-            rems = c2.fetchall()
-            if rems:
-                rlines = []
-                for r in rems:
-                    course_str = "бессрочно" if (r[5] == 0 or r[5] is None) else "%s дней" % r[5]
-                    rlines.append("- %s %s, приём: %s %s, курс: %s" % (r[1], ("для "+r[0]) if r[0] else "", r[3], r[4] or "", course_str))
-                rem_text = "\n".join(rlines)
-        except: pass
-        finally: conn2.close()
-    ctx = cab_text + "\nАптечка:\n" + inv_text + "\nСемья:\n" + fam_text + "\nНапоминания:\n" + rem_text
-    messages = [{"role":"system","content":SYSTEM_PROMPT},{"role":"system","content":ctx}]
-    messages.extend(history)
-    messages.append({"role":"user","content":user_text})
+# GPT_TOOLS=1: те же правила, но действия - вызовами функций (схемы в TOOLS), без синтаксиса скобок
+SYSTEM_PROMPT_TOOLS = SYSTEM_PROMPT.split("\n\nКоманды:")[0] + """
+
+Действия (добавить/удалить лекарство или члена семьи, напоминание, аптечки, доступ) выполняй только вызовом функций, не пиши команды текстом и не спрашивай разрешения.
+При добавлении лекарства определи правильное название и стандартную дозировку, если не указана; категорию и хранение определяй сам, НИКОГДА не спрашивай. Хранение: если сомневаешься — КОМНАТНАЯ. Просроченное не добавляй - предупреди. Менее 2 месяцев до конца срока - предупреди.
+НИКОГДА не подставляй шаблонные значения типа "имя", "возраст" - только реальные данные от пользователя!"""
+
+def medref_prompt(ref):
+    """Справочник одной строкой на категорию: так модель пишет названия и дозировки как бот, а неизменный
+    префикс промпта дотягивает до PROMPT_CACHE_MIN_TOKENS - короче провайдер его не кэширует"""
+    groups = {}
+    for e in ref.entries:
+        name = " ".join([e.name] + [w for w in e.dosage.split() if w not in e.name.split()])  # "МИГ 400" + "400 мг"
+        groups.setdefault(e.category, []).append(name + (" (холодильник)" if e.storage == "ХОЛОДИЛЬНИК" else ""))
+    if not groups:
+        return ""
+    return "\n\nСправочник частых лекарств (названия и дозировки пиши так же):\n" + \
+        "\n".join("%s: %s" % (cat, ", ".join(names)) for cat, names in groups.items())
+
+# Неизменный префикс промпта - общий для всех: ни дат, ни имён, порядок справочника - как в файле.
+# Хэш в /metrics: поменялся между деплоями - кэш провайдера прогревается заново
+ACTIVE_SYSTEM_PROMPT = (SYSTEM_PROMPT_TOOLS if GPT_TOOLS else SYSTEM_PROMPT) + (medref_prompt(medref) if GPT_PROMPT_MEDREF else "")
+PROMPT_PREFIX_SHA1 = hashlib.sha1(ACTIVE_SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+def prompt_prefix_stats():
+    """Кэшируемый префикс: функции (их провайдер ставит перед сообщениями) и системный промпт"""
+    tokens = count_tokens(ACTIVE_SYSTEM_PROMPT) + MSG_OVERHEAD_TOKENS
+    if GPT_TOOLS:
+        tokens += count_tokens(json.dumps(TOOLS, ensure_ascii=False))
+    return {"sha1": PROMPT_PREFIX_SHA1, "tokens": tokens, "min_cacheable": PROMPT_CACHE_MIN_TOKENS,
+            "cacheable": tokens >= PROMPT_CACHE_MIN_TOKENS}
+
+@dataclass
+class StreamResult:
+    text: str
+    usage: object = None
+    tool_calls: list = field(default_factory=list)  # [(имя функции, JSON аргументов)]
+
+def stream_chat(client, model, messages, on_delta, tools=None):
+    """Потоковый ответ целиком; usage приходит последним фрагментом (include_usage), вызовы функций - кусками по index"""
+    parts = []
+    usage = None
+    calls = {}
+    extra = {"tools": tools} if tools else {}
+    try:
+        for chunk in client.chat.completions.create(model=model, messages=messages, max_tokens=1000, temperature=0.7,
+                                                    stream=True, stream_options={"include_usage": True}, **extra):
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            for tc in chunk.choices[0].delta.tool_calls or ():
+                call = calls.setdefault(tc.index, ["", ""])
+                if tc.function and tc.function.name:
+                    call[0] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call[1] += tc.function.arguments
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+    except Exception as e:
+        if parts:
+            raise StreamInterrupted("%s after %s chars" % (e, len("".join(parts))))
+        raise
+    return StreamResult("".join(parts), usage, [tuple(calls[i]) for i in sorted(calls)])
+
+def generate_gpt_response(uid, user_text, on_delta=None):
+    """on_delta(кусок) - потоковый режим: вызывается на каждый фрагмент ответа, команды в ответе ещё не выполнены"""
+    gctx = load_gpt_context(uid, history_limit=GPT_HISTORY_ROWS)
+    cache_key = answer_cache_key(gctx, user_text) if ANSWER_CACHE else None
+    if cache_key:
+        cached = answer_cache.get(cache_key)
+        if cached:
+            logger.info("Cached answer for %s: %s", uid, cache_key)
+            return cached
+    elif ANSWER_CACHE:
+        answer_cache.count("bypass")
+    tools = TOOLS if GPT_TOOLS else None
+    messages, report = build_messages(gctx, user_text, system=ACTIVE_SYSTEM_PROMPT, tools=tools)
+    prompt_stats.record(report)
+    logger.info("Prompt tokens for %s: %s", uid, report)
+    if GPT_SUMMARY and len(gctx.history) >= GPT_SUMMARY_RECENT + GPT_SUMMARY_EVERY:
+        schedule_summary(uid)
     try:
-        resp = client.chat.completions.create(model="gpt-4o-mini", messages=messages, max_tokens=1000, temperature=0.7)
-        reply = resp.choices[0].message.content
+        extra = {"tools": tools} if tools else {}
+        if on_delta:
+            resp = openai_call("chat_stream", lambda client, m: stream_chat(client, m, messages, on_delta, tools))
+            reply, tool_calls = resp.text, resp.tool_calls
+        else:
+            resp = openai_call("chat", lambda client, m: client.chat.completions.create(model=m, messages=messages, max_tokens=1000, temperature=0.7, **extra))
+            msg = resp.choices[0].message
+            reply = msg.content or ""
+            tool_calls = [(tc.function.name, tc.function.arguments) for tc in msg.tool_calls or ()]
+        if resp.usage:
+            logger.info("GPT usage for %s: prompt %s (cached %s), completion %s", uid, resp.usage.prompt_tokens,
+                        usage_cached_tokens(resp.usage), resp.usage.completion_tokens)
+        if tools:
+            # Схема уже проверила поля - эвристики "забыл команду" не нужны; скобки, если модель всё же их написала, тоже исполняем
+            commands = parse_tool_calls(tool_calls) + parse_bracket_commands(reply)
+            execute_commands(uid, commands)
+            reply = clean_commands(reply) or describe_commands(commands)
+            if cache_key and not commands:
+                answer_cache.put(cache_key, user_text, reply)
+            return reply
         # Если GPT не включил команду ADD_MEDICINE но явно добавляет лекарство
         family_words = ["семь", "член", "сын", "дочь", "муж", "жен", "мам", "пап", "бабушк", "дедушк", "ребён", "ребен", "брат", "сестр"]
         is_family_context = any(w in reply.lower() for w in family_words)
@@ -376,12 +1789,13 @@ def generate_gpt_response(uid, user_text):
                     dose = dose_match.group(1) if dose_match else ""
                     exp_match = _re.search(r'(?:годност|срок)[а-яё]*:?\s*(\d{4}[-./]\d{2}(?:[-./]\d{2})?)', reply, _re.IGNORECASE)
                     exp = exp_match.group(1) if exp_match else ""
-                    cat = "РАЗНОЕ"
+                    cat = ""  # не нашли в ответе - категорию подставит справочник или РАЗНОЕ
                     for c_name in ["ТЕМПЕРАТУРА", "БОЛЬ", "ЖИВОТ", "РАНЫ"]:
                         if c_name.lower() in reply.lower() or c_name in reply:
                             cat = c_name
                             break
                     storage = "ХОЛОДИЛЬНИК" if "холодильник" in reply.lower() else "КОМНАТНАЯ"
+                    med_name, dose, cat, storage = normalize_medicine(med_name, dose, cat, storage)
                     cmd = "[ADD_MEDICINE:%s|1|%s|%s|%s|%s]" % (med_name, dose, exp, cat, storage)
                     logger.info("Fallback ADD command: %s", cmd)
                     reply += "\n" + cmd
@@ -409,6 +1823,8 @@ def generate_gpt_response(uid, user_text):
                     reply += "\n" + cmd
 
         process_gpt_commands(uid, reply)
+        if cache_key and reply and not has_commands(reply):
+            answer_cache.put(cache_key, user_text, clean_commands(reply))
         return clean_commands(reply)
     except Exception as e: logger.error("GPT err: %s", e); return "Ошибка связи с ИИ."
 
@@ -422,145 +1838,772 @@ CABINET_SWITCH_RE = r"\[SWITCH_CABINET:(.+?)\]"
 REM_FAM_RE = r"\[REMOVE_FAMILY:(.+?)\]"
 REM_FAM_RE = r"\[REMOVE_FAMILY:(.+?)\]"
 
-def process_gpt_commands(uid, text):
+def process_gpt_commands(uid, text):
+    """Команды [КОМАНДА:...] из ответа GPT или локального разбора: один проход регулярки, исполнение пачкой"""
+    return execute_commands(uid, parse_bracket_commands(text))
+
+def parse_schedule_times(schedule):
+    """'8:00, 20:00' -> ['08:00', '20:00'], мусор отбрасывается"""
+    times = []
+    for t in (schedule or "").split(","):
+        m = re.match(r"^\s*(\d{1,2})[:.](\d{2})\s*$", t)
+        if m and int(m.group(1)) < 24 and int(m.group(2)) < 60:
+            times.append("%02d:%s" % (int(m.group(1)), m.group(2)))
+    return times
+
+def clean_commands(text):
+    for rx in [ADD_MED_RE, REM_MED_RE, ADD_FAM_RE, ADD_REM_RE, SHARE_RE, CABINET_CREATE_RE, CABINET_SWITCH_RE, REM_FAM_RE]:
+        text = re.sub(rx, "", text)
+    return text.strip()
+
+def visible_stream_text(text):
+    """Недописанный ответ без команд: готовые вырезаются, начатая ("[ADD_MEDI...") скрывается до закрывающей скобки"""
+    text = clean_commands(text)
+    cut = text.rfind("[")
+    if cut != -1 and "]" not in text[cut:]:
+        text = text[:cut]
+    return text.rstrip()
+
+# === GPT commands ===
+# Команда - (вид, поля по схеме). Приходит скобками из текста ответа или вызовом функции (GPT_TOOLS=1),
+# проверяется одной схемой и исполняется в одной транзакции: по одному запросу на вид, строки - массивами через unnest
+
+COMMAND_SCHEMAS = {
+    "add_medicine": ("Добавить лекарство в текущую аптечку", [
+        ("name", {"type": "string", "description": "Название"}),
+        ("quantity", {"type": "integer", "minimum": 1, "default": 1}),
+        ("dosage", {"type": "string", "description": "Дозировка, если не названа - стандартная"}),
+        ("expiry", {"type": "string", "description": "Срок годности ГГГГ-ММ-ДД или ГГГГ-ММ"}),
+        ("category", {"type": "string", "enum": list(CATEGORIES), "description": "Не названа - из справочника, иначе РАЗНОЕ"}),
+        ("storage", {"type": "string", "enum": list(STORAGES), "default": ""}),
+    ], ["name"]),
+    "remove_medicine": ("Удалить лекарство", [("name", {"type": "string"})], ["name"]),
+    "add_family": ("Добавить или обновить члена семьи", [
+        ("name", {"type": "string", "description": "Имя в именительном падеже"}),
+        ("age", {"type": "integer", "minimum": 0}),
+        ("gender", {"type": "string", "enum": ["М", "Ж"]}),
+        ("relation", {"type": "string", "description": "жена, сын, мама..."}),
+    ], ["name"]),
+    "remove_family": ("Удалить члена семьи", [("name", {"type": "string"})], ["name"]),
+    "add_reminder": ("Напоминание о приёме лекарства", [
+        ("member", {"type": "string", "description": "Для кого, пусто - для самого пользователя"}),
+        ("medicine", {"type": "string"}),
+        ("schedule", {"type": "string", "description": "Время приёма ЧЧ:ММ через запятую", "default": "08:00"}),
+        ("meal", {"type": "string", "description": "до/после/во время еды"}),
+        ("dosage", {"type": "string", "default": ""}),
+        ("course_days", {"type": "integer", "minimum": 0, "default": 0, "description": "Дней курса, 0 - бессрочно"}),
+        ("pills_per_dose", {"type": "number", "minimum": 0, "default": 1.0}),
+        ("pills_in_pack", {"type": "integer", "minimum": 0, "default": 0}),
+    ], ["medicine"]),
+    "create_cabinet": ("Создать аптечку и переключиться на неё", [("name", {"type": "string"})], ["name"]),
+    "switch_cabinet": ("Переключиться на аптечку", [("name", {"type": "string"})], ["name"]),
+    "share_access": ("Поделиться аптечкой", [
+        ("username", {"type": "string", "description": "@username в Telegram"}),
+        ("relation", {"type": "string", "default": ""}),
+    ], ["username"]),
+}
+# Порядок исполнения видов - как в прежнем process_gpt_commands
+COMMAND_ORDER = ("add_medicine", "remove_medicine", "add_family", "create_cabinet", "switch_cabinet", "remove_family", "share_access", "add_reminder")
+COMMAND_RE = re.compile(r"\[(%s):(.+?)\]" % "|".join(k.upper() for k in COMMAND_SCHEMAS))
+BAD_VALUES = {'имя', 'name', 'test', 'член_семьи', 'member', 'пол', 'gender', 'отношение', 'relation', 'возраст'}
+
+TOOLS = [{"type": "function", "function": {
+    "name": kind, "description": desc,
+    "parameters": {"type": "object", "properties": dict((n, dict((k, v) for k, v in spec.items() if k != "default")) for n, spec in props),
+                   "required": required}}}
+    for kind, (desc, props, required) in COMMAND_SCHEMAS.items()]
+
+def validate_command(kind, args):
+    """Поля по схеме команды: числа приводятся, неподходящее значение - default (или пусто).
+    None - неизвестная команда или нет обязательного поля"""
+    if kind not in COMMAND_SCHEMAS or not isinstance(args, dict):
+        return None
+    _, props, required = COMMAND_SCHEMAS[kind]
+    out = {}
+    for name, spec in props:
+        v = args.get(name)
+        if isinstance(v, str):
+            v = v.strip()
+        if v is None or v == "":
+            v = spec.get("default")
+        elif spec["type"] in ("integer", "number"):
+            try: v = int(v) if spec["type"] == "integer" else float(v)
+            except (TypeError, ValueError): v = spec.get("default")
+            if v is not None and v < spec.get("minimum", v):
+                v = spec.get("default")
+        else:
+            v = str(v)
+            if "enum" in spec:
+                v = v.upper() if v.upper() in spec["enum"] else spec.get("default")
+        out[name] = v
+    if any(not out.get(r) for r in required):
+        return None
+    return out
+
+def parse_bracket_commands(text):
+    """[ADD_MEDICINE:Нурофен|1|200 мг|...] -> [("add_medicine", {...})]; поля по позициям схемы"""
+    commands = []
+    for kind, body in COMMAND_RE.findall(text or ""):
+        kind = kind.lower()
+        props = COMMAND_SCHEMAS[kind][1]
+        parts = body.split("|") if len(props) > 1 else [body]
+        args = validate_command(kind, dict(zip([n for n, _ in props], parts)))
+        if args:
+            commands.append((kind, args))
+        else:
+            command_stats.count("invalid")
+    return commands
+
+def parse_tool_calls(tool_calls):
+    """[(имя функции, JSON аргументов)] от модели -> проверенные команды; битые отбрасываются с записью в лог"""
+    commands = []
+    for name, arguments in tool_calls:
+        try: args = json.loads(arguments or "{}")
+        except ValueError: args = None
+        cmd = validate_command(name, args)
+        if cmd:
+            commands.append((name, cmd))
+        else:
+            logger.warning("Invalid tool call %s: %s", name, arguments)
+            command_stats.count("invalid")
+    return commands
+
+def expiry_date(expiry):
+    """'2027-01' -> '2027-01-28', '2027-01-15' как есть, остальное - None"""
+    expiry = (expiry or "").strip()
+    if re.match(r"^\d{4}-\d{2}-\d{2}$", expiry):
+        return expiry
+    if re.match(r"^\d{4}-\d{2}$", expiry):
+        return expiry + "-28"
+    return None
+
+def prepare_medicines(items):
+    """Поля add_medicine по справочнику -> (строки [имя, кол-во, дозировка, срок, категория, хранение], просроченные имена).
+    Повторы в самом списке (то же имя, дозировка и срок) складываются"""
+    rows, expired = {}, []
+    for a in items:
+        name, dosage, category, storage = normalize_medicine(a["name"], a["dosage"], a["category"], a["storage"])
+        status, _ = check_expiry(a["expiry"] or "")
+        if status == "expired":
+            expired.append(name)
+            continue
+        row = [name, a["quantity"], dosage, expiry_date(a["expiry"]), category, storage or ""]
+        if inventory_key(row) in rows:
+            rows[inventory_key(row)][1] += a["quantity"]
+        else:
+            rows[inventory_key(row)] = row
+    return list(rows.values()), expired
+
+def dosage_key(dosage):
+    """'200 мг' и '200мг' - одна дозировка"""
+    return re.sub(r"\s+", "", (dosage or "").lower())
+
+def inventory_key(row):
+    """Одна строка аптечки = имя + дозировка + срок: 400 мг не сливается с 200 мг, новая упаковка со своим сроком - отдельно"""
+    return row[0].lower(), dosage_key(row[2]), row[3]
+
+def active_cabinet(c, uid):
+    """(id, название) активной аптечки на уже открытом курсоре"""
+    c.execute("""SELECT us.active_cabinet_id, cb.name FROM user_state us LEFT JOIN cabinets cb ON cb.id = us.active_cabinet_id
+                 WHERE us.user_id = %s""", (uid,))
+    row = c.fetchone()
+    if not row or not row[0]:
+        return 0, "Моя аптечка"
+    return row[0], row[1] or "Моя аптечка"
+
+def upsert_inventory(c, uid, cab_id, rows):
+    """Строки в аптечку одним запросом. Уже лежащее в ней лекарство (то же имя или то же по справочнику, та же дозировка
+    и тот же срок) не дублируется - прибавляется количество; другая дозировка или срок - новая строка.
+    -> [(имя, True - новое / False - пополнено)]"""
+    c.execute("SELECT DISTINCT medicine_name FROM inventory WHERE user_id = %s AND cabinet_id = %s", (uid, cab_id))
+    existing = [r[0] for r in c.fetchall()]
+    by_lower = dict((n.lower(), n) for n in existing)
+    by_entry = {}
+    for n in existing:
+        entry = medref.lookup(n, exact=True)
+        if entry:
+            by_entry.setdefault(id(entry), []).append(n)
+    merged = {}
+    for r in rows:
+        if r[0].lower() not in by_lower:
+            entry = medref.lookup(r[0], exact=True)
+            same = by_entry.get(id(entry), []) if entry else []
+            if len(same) == 1:
+                r[0] = same[0]  # "Нурофен" в аптечку, где уже есть "Nurofen 200"
+        if inventory_key(r) in merged:
+            merged[inventory_key(r)][1] += r[1]
+        else:
+            merged[inventory_key(r)] = r
+    rows = list(merged.values())
+    if not rows:
+        return []
+    # Уникального индекса на (user_id, cabinet_id, medicine_name) нет - upsert через CTE: обновить первую найденную строку,
+    # вставить остальные. Оба шага видят один снимок, поэтому повторов в rows быть не должно (сложены выше)
+    c.execute("""WITH v AS (SELECT * FROM unnest(%s::text[], %s::int[], %s::text[], %s::date[], %s::text[], %s::text[], %s::text[])
+                            WITH ORDINALITY AS t(name, qty, dosage, exp, cat, storage, dkey, k)),
+                 upd AS (UPDATE inventory i SET quantity = COALESCE(i.quantity, 0) + v.qty,
+                                category = COALESCE(NULLIF(i.category, ''), v.cat), storage = COALESCE(NULLIF(i.storage, ''), v.storage)
+                         FROM v WHERE i.id = (SELECT MIN(j.id) FROM inventory j WHERE j.user_id = %s AND j.cabinet_id = %s
+                                                  AND LOWER(j.medicine_name) = LOWER(v.name)
+                                                  AND LOWER(REGEXP_REPLACE(COALESCE(j.dosage, ''), '\\s+', '', 'g')) = v.dkey
+                                                  AND j.expiry_date IS NOT DISTINCT FROM v.exp)
+                         RETURNING v.k, i.medicine_name),
+                 ins AS (INSERT INTO inventory (user_id, medicine_name, quantity, dosage, expiry_date, category, cabinet_id, storage)
+                         SELECT %s, v.name, v.qty, v.dosage, v.exp, v.cat, %s, v.storage FROM v
+                         WHERE v.k NOT IN (SELECT k FROM upd)
+                         RETURNING medicine_name)
+                 SELECT medicine_name, FALSE FROM upd UNION ALL SELECT medicine_name, TRUE FROM ins""",
+              tuple(list(col) for col in zip(*rows)) + ([dosage_key(r[2]) for r in rows], uid, cab_id, uid, cab_id))
+    return c.fetchall()
+
+def _exec_add_medicine(c, uid, items):
+    rows, _ = prepare_medicines(items)
+    if not rows:
+        return 0
+    cab_id, _ = active_cabinet(c, uid)
+    return len(upsert_inventory(c, uid, cab_id, rows))
+
+def _exec_remove_medicine(c, uid, items):
+    # Только из активной аптечки - её пользователь видит и её называет ответ; в других то же лекарство остаётся
+    cab_id, _ = active_cabinet(c, uid)
+    names = list(dict.fromkeys(a["name"] for a in items))
+    c.execute("""DELETE FROM inventory WHERE user_id = %s AND cabinet_id = %s
+                 AND LOWER(medicine_name) IN (SELECT LOWER(n) FROM unnest(%s::text[]) AS n)
+                 RETURNING LOWER(medicine_name)""", (uid, cab_id, names))
+    deleted = set(r[0] for r in c.fetchall())
+    n = len(deleted)
+    # "Удали нурофен", а в аптечке "Nurofen" - то же лекарство по справочнику, если оно там одно
+    entries = [e for e in (medref.lookup(x, exact=True) for x in names if x.lower() not in deleted) if e]
+    if entries:
+        c.execute("SELECT DISTINCT medicine_name FROM inventory WHERE user_id = %s AND cabinet_id = %s", (uid, cab_id))
+        inv_names = [r[0] for r in c.fetchall()]
+        same = [[x for x in inv_names if medref.lookup(x, exact=True) is e] for e in entries]
+        extra = [s[0] for s in same if len(s) == 1]
+        if extra:
+            c.execute("DELETE FROM inventory WHERE user_id = %s AND cabinet_id = %s AND medicine_name = ANY(%s)", (uid, cab_id, extra))
+            n += c.rowcount
+    return n
+
+def _exec_add_family(c, uid, items):
+    members = {}
+    for a in items:
+        if a["name"].lower() in BAD_VALUES:
+            continue
+        gender = None if (a["gender"] or "").lower() in BAD_VALUES else a["gender"]
+        relation = None if (a["relation"] or "").lower() in BAD_VALUES else a["relation"]
+        members[a["name"].lower()] = (a["name"], a["age"], gender, relation)
+    if not members:
+        return 0
+    # Уникального индекса на (user_id, name) нет - upsert через CTE: обновить найденных, вставить остальных
+    c.execute("""WITH v AS (SELECT * FROM unnest(%s::text[], %s::int[], %s::text[], %s::text[]) AS t(name, age, gender, relation)),
+                 upd AS (UPDATE family f SET age = v.age, gender = v.gender, relation = v.relation FROM v
+                         WHERE f.user_id = %s AND LOWER(f.name) = LOWER(v.name) RETURNING LOWER(f.name) AS lname)
+                 INSERT INTO family (user_id, name, age, gender, relation)
+                 SELECT %s, v.name, v.age, v.gender, v.relation FROM v WHERE LOWER(v.name) NOT IN (SELECT lname FROM upd)""",
+              tuple(list(col) for col in zip(*members.values())) + (uid, uid))
+    logger.info("Family upsert for user %s: %s (%s new)", uid, ", ".join(m[0] for m in members.values()), c.rowcount)
+    return len(members)
+
+def _exec_remove_family(c, uid, items):
+    c.execute("DELETE FROM family WHERE user_id = %s AND LOWER(name) IN (SELECT LOWER(n) FROM unnest(%s::text[]) AS n)",
+              (uid, [a["name"] for a in items]))
+    logger.info("Deleted family members: %s for user %s", ", ".join(a["name"] for a in items), uid)
+    return c.rowcount
+
+def _exec_create_cabinet(c, uid, items):
+    c.execute("INSERT INTO cabinets (user_id, name) SELECT %s, t.n FROM unnest(%s::text[]) WITH ORDINALITY AS t(n, i) ORDER BY t.i RETURNING id",
+              (uid, [a["name"] for a in items]))
+    new_id = max(r[0] for r in c.fetchall())
+    c.execute("INSERT INTO user_state (user_id, active_cabinet_id) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET active_cabinet_id = %s", (uid, new_id, new_id))
+    return len(items)
+
+def _exec_switch_cabinet(c, uid, items):
+    # Активной остаётся последняя аптечка, на которую удалось переключиться
+    for a in reversed(items):
+        c.execute("SELECT id FROM cabinets WHERE user_id = %s AND LOWER(name) LIKE LOWER(%s)", (uid, "%" + a["name"] + "%"))
+        row = c.fetchone()
+        cab_id = row[0] if row else (0 if a["name"].lower() in ("моя аптечка", "своя", "моя", "основная") else None)
+        if cab_id is not None:
+            c.execute("INSERT INTO user_state (user_id, active_cabinet_id) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET active_cabinet_id = %s", (uid, cab_id, cab_id))
+            return 1
+    return 0
+
+def _exec_share_access(c, uid, items):
+    c.execute("""INSERT INTO shared_access (owner_id, shared_with_id, shared_with_username, relation)
+                 SELECT %s, 0, t.u, t.r FROM unnest(%s::text[], %s::text[]) AS t(u, r) ON CONFLICT DO NOTHING""",
+              (uid, [a["username"].replace("@", "") for a in items], [a["relation"] for a in items]))
+    return c.rowcount
+
+def _exec_add_reminder(c, uid, items):
+    from datetime import date, datetime, timedelta
+    start = date.today()
+    rows = []
+    for a in items:
+        days = a["course_days"]
+        total = days * len(a["schedule"].split(",")) * a["pills_per_dose"] if days > 0 else 0
+        rows.append((a["member"] or "", a["medicine"], a["dosage"], a["schedule"], a["meal"] or "", days,
+                     a["pills_per_dose"], a["pills_in_pack"], total, start + timedelta(days=days) if days > 0 else None))
+    c.execute("""INSERT INTO reminders (user_id, family_member, medicine_name, dosage, schedule_time, meal_relation, course_days,
+                                        pills_per_dose, pills_in_pack, pills_remaining, start_date, end_date, active)
+                 SELECT %s, t.member, t.medicine, t.dosage, t.schedule, t.meal, t.days, t.ppd, t.pip, t.total, %s, t.end_date, TRUE
+                 FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::int[], %s::real[], %s::int[], %s::real[], %s::date[])
+                      AS t(member, medicine, dosage, schedule, meal, days, ppd, pip, total, end_date)
+                 RETURNING id, schedule_time, end_date""",
+              (uid, start) + tuple(list(col) for col in zip(*rows)))
+    created = c.fetchall()
+    fire = [(rid, t) for rid, schedule, _ in created for t in parse_schedule_times(schedule)]
+    if fire:
+        c.execute("""INSERT INTO reminder_times (reminder_id, user_id, fire_time)
+                     SELECT t.rid, %s, t.ft FROM unnest(%s::int[], %s::time[]) AS t(rid, ft) ON CONFLICT DO NOTHING""",
+                  (uid, [f[0] for f in fire], [f[1] for f in fire]))
+    if reminder_scheduler:
+        # В колесо - только после фиксации: иначе при откате сработает напоминание, которого нет в БД
+        def schedule_created():
+            now = datetime.utcnow() + timedelta(hours=3)
+            for rid, schedule, end in created:
+                reminder_scheduler.add(rid, parse_schedule_times(schedule), end, since=now)
+        db_after_commit(schedule_created)
+    return len(created)
+
+COMMAND_EXECUTORS = {
+    "add_medicine": _exec_add_medicine, "remove_medicine": _exec_remove_medicine, "add_family": _exec_add_family,
+    "create_cabinet": _exec_create_cabinet, "switch_cabinet": _exec_switch_cabinet, "remove_family": _exec_remove_family,
+    "share_access": _exec_share_access, "add_reminder": _exec_add_reminder,
+}
+
+class CommandStats:
+    """Команды в ответах: сколько на ответ, каких видов, время исполнения пачки - в /metrics"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.replies = 0
+        self.commands = 0
+        self.max_per_reply = 0
+        self.kinds = {}
+        self.invalid = 0
+        self.errors = 0
+        self.latencies = []
+
+    def count(self, key):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def record(self, commands, seconds=None):
+        with self._lock:
+            self.replies += 1
+            self.commands += len(commands)
+            self.max_per_reply = max(self.max_per_reply, len(commands))
+            for kind, _ in commands:
+                self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            if seconds is not None:
+                self.latencies = self.latencies[-999:] + [seconds]
+
+    def snapshot(self):
+        with self._lock:
+            lat = sorted(self.latencies)
+            return {"replies": self.replies, "commands": self.commands, "max_per_reply": self.max_per_reply,
+                    "avg_per_reply": round(self.commands / self.replies, 2) if self.replies else 0.0,
+                    "kinds": dict(self.kinds), "invalid": self.invalid, "errors": self.errors,
+                    "p50_ms": round(percentile(lat, 50) * 1000, 1), "p99_ms": round(percentile(lat, 99) * 1000, 1)}
+
+command_stats = CommandStats()
+
+def execute_commands(uid, commands):
+    """Проверенные команды одной транзакцией, по запросу на вид. {вид: сколько исполнено}; ошибка - откат всего, {}"""
+    if not commands:
+        command_stats.record(commands)
+        return {}
+    groups = {}
+    for kind, args in commands:
+        groups.setdefault(kind, []).append(args)
+    done = {}
+    started = time.monotonic()
+    with db_unit():  # исполнители откладывают побочные действия (колесо напоминаний) до фиксации через db_after_commit
+        conn = get_db_connection()
+        if not conn: return done
+        try:
+            c = conn.cursor()
+            for kind in COMMAND_ORDER:
+                if kind in groups:
+                    done[kind] = COMMAND_EXECUTORS[kind](c, uid, groups[kind])
+            conn.commit()
+            command_stats.record(commands, time.monotonic() - started)
+        except Exception as e:
+            logger.error("Cmd err: %s", e, exc_info=True)
+            command_stats.count("errors")
+            done = {}
+            try: conn.rollback()
+            except: pass
+        finally: conn.close()
+    return done
+
+def describe_commands(commands):
+    """Короткое подтверждение, когда модель ответила только вызовами функций, без текста"""
+    lines = []
+    for kind, fmt, key in (("add_medicine", "\u2705 Добавил в аптечку: %s", "name"), ("remove_medicine", "\U0001f5d1 Удалил из аптечки: %s", "name"),
+                             ("add_family", "\u2705 Добавил в семью: %s", "name"), ("remove_family", "\U0001f5d1 Удалил из семьи: %s", "name"),
+                             ("create_cabinet", "\U0001f4e6 Создал аптечку: %s", "name"), ("switch_cabinet", "\U0001f504 Переключил на аптечку: %s", "name"),
+                             ("share_access", "\U0001f91d Открыл доступ: %s", "username"), ("add_reminder", "\u23f0 Напоминание: %s", "medicine")):
+        names = [a[key] for k, a in commands if k == kind]
+        if names:
+            lines.append(fmt % ", ".join(names))
+    return "\n".join(lines) or "Готово."
+
+# === Local intents ===
+# Простые однозначные просьбы разбираются без GPT и исполняются теми же командами process_gpt_commands.
+# parse_intent - только текст (проверяется eval_intents.py на intents_corpus.tsv), route_intent - сверка с данными пользователя.
+# Любое сомнение (нет совпадения, несколько совпадений, непонятный падеж) - None, дальше отвечает GPT
+
+RELATIONS = {"жена": "жена", "жену": "жена", "муж": "муж", "мужа": "муж", "сын": "сын", "сына": "сын",
+             "дочь": "дочь", "дочка": "дочь", "дочку": "дочь", "мама": "мама", "маму": "мама", "мать": "мама",
+             "папа": "папа", "папу": "папа", "отец": "папа", "отца": "папа", "бабушка": "бабушка", "бабушку": "бабушка",
+             "дедушка": "дедушка", "дедушку": "дедушка", "брат": "брат", "брата": "брат", "сестра": "сестра", "сестру": "сестра"}
+FEMALE_RELATIONS = ("жена", "дочь", "мама", "бабушка", "сестра")
+# Мужские имена на -а/-я: в них окончание - не винительный падеж
+MALE_NAMES_A = {"никита", "илья", "саша", "миша", "дима", "лёша", "леша", "алёша", "алеша", "паша", "гоша", "ваня", "петя",
+                "коля", "серёжа", "сережа", "женя", "вова", "слава", "федя", "толя", "костя", "боря", "гриша", "кузьма", "фома", "лука"}
+# Беглая гласная: "Павла" - Павел, не "Павл"
+FLEETING_NAMES = {"павла": "павел", "льва": "лев", "петра": "пётр"}
+# Без родства ("добавь Илью 12 лет") имя берётся, только если оно отсюда: иначе "добавь нурофен 2 года" - член семьи
+KNOWN_NAMES = MALE_NAMES_A | set(FLEETING_NAMES.values()) | {
+    "александр", "алексей", "анатолий", "андрей", "антон", "аркадий", "артём", "артем", "артур", "богдан", "борис", "вадим",
+    "валентин", "валерий", "василий", "виктор", "виталий", "владимир", "владислав", "всеволод", "вячеслав", "геннадий",
+    "георгий", "глеб", "григорий", "давид", "даниил", "денис", "дмитрий", "евгений", "егор", "захар", "иван", "игорь",
+    "кирилл", "константин", "леонид", "макар", "максим", "марк", "матвей", "михаил", "назар", "николай", "олег", "пётр",
+    "петр", "роман", "руслан", "семён", "семен", "сергей", "станислав", "степан", "тимофей", "тимур", "фёдор", "федор",
+    "филипп", "юрий", "ярослав", "александра", "алина", "алиса", "алла", "анастасия", "ангелина", "анна", "антонина",
+    "арина", "валентина", "валерия", "варвара", "вера", "вероника", "виктория", "галина", "дарья", "диана", "ева",
+    "евгения", "екатерина", "елена", "елизавета", "жанна", "зинаида", "зоя", "инна", "ирина", "карина", "кира", "клавдия",
+    "кристина", "ксения", "лариса", "лидия", "любовь", "людмила", "маргарита", "марина", "мария", "милана", "надежда",
+    "наталья", "наталия", "нина", "оксана", "олеся", "ольга", "оля", "полина", "раиса", "светлана", "софия", "софья",
+    "таисия", "тамара", "татьяна", "ульяна", "юлия", "яна", "аня", "катя", "лена", "маша", "наташа", "настя", "таня",
+    "юля", "света", "ира", "соня", "даша", "галя", "люда", "вика", "лиза", "надя", "валя", "зина", "рая"}
+MAIN_CABINET_WORDS = {"основную", "основная", "основной", "мою", "моя", "свою", "своя", "главную", "главная"}
+NOT_A_NAME = {"все", "всё", "просроченные", "просрочку", "напоминание", "напоминания", "аптечку", "семью", "его", "её", "ее",
+              "это", "их", "то", "лекарства", "таблетки", "историю", "курс"}
+
+_REL = "|".join(sorted(RELATIONS, key=len, reverse=True))
+_ADD = r"(?:добавь|добавить|запиши|внеси)\s+(?:в\s+семью\s+)?"
+INTENT_RULES = [
+    ("remove_family", re.compile(r"^(?:удали|удалить|убери|убрать)\s+(?P<name>[а-яё]+)\s+из\s+(?:моей\s+)?семьи$")),
+    ("remove_medicine", re.compile(r"^(?:удали|удалить|убери|убрать|выкинь|выбрось|выброси)\s+(?:из\s+аптечки\s+)?(?:лекарство\s+|препарат\s+)?"
+                                   r"(?P<name>[а-яёa-z0-9][а-яёa-z0-9\- ]{1,40}?)(?:\s+из\s+аптечки)?$")),
+    ("switch_cabinet", re.compile(r"^(?:переключи(?:сь)?|перейди|переключить)\s+(?:на\s+)?(?:аптечку\s+)?(?P<name>[а-яё\- ]{2,40})$")),
+    ("show_inventory", re.compile(r"^(?:покажи|открой|показать)\s+(?:мне\s+)?(?:мою\s+)?аптечку(?:\s+(?P<name>[а-яё\- ]{2,40}))?$")),
+    ("show_inventory", re.compile(r"^что\s+(?:у\s+меня\s+)?в\s+аптечке(?:\s+(?P<name>[а-яё\- ]{2,40}))?$")),
+    ("add_family", re.compile(r"^" + _ADD + r"(?P<name>[а-яё]+)\s*,?\s*(?P<age>\d{1,3})\s*(?P<years>лет|год|года)?\s*,?\s*(?P<rel>" + _REL + r")?(?:\s+в\s+семью)?$")),
+    ("add_family", re.compile(r"^" + _ADD + r"(?P<rel>" + _REL + r")\s+(?P<name>[а-яё]+)\s*,?\s*(?P<age>\d{1,3})\s*(?P<years>лет|год|года)?(?:\s+в\s+семью)?$")),
+]
+
+def nominative_name(word, gender=None):
+    """Имя из просьбы ("добавь Анну") в именительном падеже или None, если падеж не определить"""
+    w = word.lower()
+    if w in FLEETING_NAMES:
+        w = FLEETING_NAMES[w]
+    elif w.endswith("у"):
+        w = w[:-1] + "а"   # Анну, Никиту
+    elif w.endswith("ю"):
+        w = w[:-1] + "я"   # Марию, Илью
+    elif w[-1] in "ая":
+        if w in MALE_NAMES_A or gender == "Ж":
+            pass
+        elif gender == "М" and w.endswith("а") and w[-2] not in "аеёиоуыэюя":
+            w = w[:-1]     # Ивана, Олега
+        else:
+            return None    # Анна или Ивана, Андрея или Игоря - пусть решает GPT
+    return w.capitalize()
+
+def name_gender(name):
+    return "М" if name.lower() in MALE_NAMES_A or name[-1] not in "ая" else "Ж"
+
+def parse_intent(text):
+    """(intent, arg) по одному тексту без БД; None - не уверены"""
+    t = re.sub(r"\s+", " ", text.strip().lower()).rstrip(".!?")
+    if not t or len(t) > 80 or "\n" in text.strip():
+        return None
+    for intent, rx in INTENT_RULES:
+        m = rx.match(t)
+        if not m:
+            continue
+        name = (m.groupdict().get("name") or "").strip()
+        if intent in ("remove_medicine", "remove_family"):
+            if not name or set(name.split()) & NOT_A_NAME:
+                return None
+            return intent, name
+        if intent in ("switch_cabinet", "show_inventory"):
+            if name.endswith(" аптечку"):
+                name = name[:-len(" аптечку")]  # "на мою аптечку"
+            if name in MAIN_CABINET_WORDS:
+                name = "основная"
+            if intent == "switch_cabinet" and not name:
+                return None
+            return intent, name
+        if intent == "add_family":
+            rel = RELATIONS.get(m.group("rel") or "")
+            if not rel and not m.group("years"):
+                return None  # "добавь нурофен 2" - не про семью
+            age = int(m.group("age"))
+            if not 0 < age < 120 or name in NOT_A_NAME or name in RELATIONS:
+                return None  # "добавь жену 30 лет" - имени нет
+            gender = ("Ж" if rel in FEMALE_RELATIONS else "М") if rel else None
+            nom = nominative_name(name, gender)
+            if not nom or (not rel and nom.lower() not in KNOWN_NAMES):
+                return None
+            return intent, "%s|%s|%s|%s" % (nom, age, gender or name_gender(nom), rel or "")
+    return None
+
+def same_name(form, name):
+    """Падежная форма из просьбы и имя из базы: "анну"/"Анна", "ивана"/"Иван", "андрея"/"Андрей" """
+    f, n = form.lower(), name.lower()
+    if f == n or f == n + "а" or (n[-1:] in "йь" and f == n[:-1] + "я"):
+        return True
+    return len(f) == len(n) and len(n) > 2 and f[:-1] == n[:-1]
+
+def find_cabinet(name, cabinets):
+    """Аптечка по слову из просьбы ("мамы", "дачную"): подстрока или основа слова. Только если одна"""
+    # "мамы" -> "мам", "дачную" -> "дачн": отрезаем до двух букв окончания, пока не найдётся
+    for cut in range(0, 3):
+        stem = name[:len(name) - cut]
+        if len(stem) < 3:
+            break
+        found = [cb for cb in cabinets if stem in cb[1].lower()]
+        if found:
+            return found[0] if len(found) == 1 else None
+    return None
+
+@dataclass
+class RoutedIntent:
+    intent: str
+    commands: str = ""   # команды в формате ответа GPT для process_gpt_commands
+    reply: str = ""
+    then: str = ""       # команда бота, которую выполнить следом ("/inventory")
+
+class IntentStats:
+    """Сколько сообщений обработано без GPT; rejected - шаблон подошёл, но сверка с данными не прошла"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.routed = {}
+        self.rejected = {}
+
+    def record(self, intent=None, routed=False):
+        with self._lock:
+            self.messages += 1
+            if intent:
+                bucket = self.routed if routed else self.rejected
+                bucket[intent] = bucket.get(intent, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            hits = sum(self.routed.values())
+            return {"messages": self.messages, "routed": dict(self.routed), "rejected": dict(self.rejected),
+                    "hit_rate": round(hits / self.messages, 3) if self.messages else 0.0}
+
+intent_stats = IntentStats()
+
+def route_intent(uid, text):
+    """RoutedIntent, если просьбу можно выполнить без GPT, иначе None"""
+    parsed = parse_intent(text)
+    if not parsed:
+        intent_stats.record()
+        return None
+    intent, arg = parsed
+    routed = _resolve_intent(uid, intent, arg)
+    intent_stats.record(intent, routed is not None)
+    if routed:
+        logger.info("Local intent for %s: %s %s", uid, intent, arg)
+    return routed
+
+def _resolve_intent(uid, intent, arg):
+    if intent == "add_family":
+        name, age, gender, rel = arg.split("|")
+        if medref.lookup(name, exact=True):
+            return None  # "добавь Нурофен 2 года, сына" - лекарство, не человек
+        ctx = load_gpt_context(uid, history_limit=0)
+        if any(same_name(name, f[0]) for f in ctx.family):
+            return None  # уже есть в семье - пусть GPT уточнит, обновить или добавить второго
+        return RoutedIntent(intent, "[ADD_FAMILY:%s]" % arg,
+                            "\u2705 Добавил в семью: **%s**, %s лет%s." % (name, age, ", " + rel if rel else ""))
+    if intent == "show_inventory" and not arg:
+        return RoutedIntent(intent, then="/inventory")
+    ctx = load_gpt_context(uid, history_limit=0)
+    if intent == "remove_medicine":
+        forms = {arg, arg[:-1] + "а" if arg.endswith("у") else arg}  # но-шпу -> но-шпа
+        found = [m[0] for m in ctx.inventory if m[0].lower() in forms] or \
+                [m[0] for m in ctx.inventory if any(m[0].lower().startswith(f + " ") for f in forms)]
+        entry = next((e for e in (medref.lookup(f, exact=True) for f in forms) if e), None) if not found else None
+        if entry:
+            found = [m[0] for m in ctx.inventory if medref.lookup(m[0], exact=True) is entry]  # "нурофен" -> "Nurofen 200"
+        if len(set(found)) != 1:
+            return None
+        return RoutedIntent(intent, "[REMOVE_MEDICINE:%s]" % found[0], "\U0001f5d1 Удалил **%s** из аптечки «%s»." % (found[0], ctx.cabinet_name))
+    if intent == "remove_family":
+        found = [f[0] for f in ctx.family if same_name(arg, f[0])]
+        if len(found) != 1:
+            return None
+        return RoutedIntent(intent, "[REMOVE_FAMILY:%s]" % found[0], "\U0001f5d1 Удалил **%s** из семьи." % found[0])
+    if intent in ("switch_cabinet", "show_inventory"):
+        if arg == "основная":
+            cmd, cab_name = "[SWITCH_CABINET:основная]", "Моя аптечка"
+        else:
+            cab = find_cabinet(arg, ctx.cabinets)
+            if not cab:
+                return None
+            cmd, cab_name = "[SWITCH_CABINET:%s]" % cab[1], cab[1]
+        if intent == "show_inventory":
+            return RoutedIntent(intent, cmd, then="/inventory")
+        return RoutedIntent(intent, cmd, "\U0001f504 Переключил на аптечку «%s»." % cab_name)
+    return None
+
+# === Bulk ingest ===
+# Целая аптечка одним сообщением: "добавь нурофен 200 мг, смекту, но-шпу 2 уп", список строк, голос или фото
+# нескольких упаковок (vision перечисляет их нумерованным списком). Без GPT: разбор, справочник, одна транзакция, один ответ.
+# Берётся, только если каждый пункт точно узнан справочником или похож на лекарство (есть дозировка) - иначе решает GPT.
+# Просьбы с чужой аптечкой или человеком ("в аптечке мамы", "для сына") - тоже GPT: список ушёл бы в активную аптечку
+
+ADD_LIST_RE = re.compile(r"^\s*(?:добавь|добавить|добавьте|запиши|запишите|внеси|внесите|положи|купил[аи]?|в аптечке|у меня есть)\b[\s:,-]*", re.IGNORECASE)
+LIST_MARK_RE = re.compile(r"^\s*(?:\d{1,2}[.)]|[-•*—])\s+")
+DOSE_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s?(мг|мл|мкг|г|%|ме|ед)(?![а-яё])", re.IGNORECASE)
+QTY_RE = re.compile(r"(\d+)\s?(?:шт|уп|пач|флак|тюб|блист)[а-яё]*\.?", re.IGNORECASE)
+EXP_RE = re.compile(r"(\d{4})-(\d{1,2})(?:-(\d{1,2}))?|(?:(\d{1,2})[./])?(\d{1,2})[./](\d{4})")
+EXP_WORDS_RE = re.compile(r"\b(?:срок\w*|годен|годна|годности|до)\b", re.IGNORECASE)
+NAME_LABEL_RE = re.compile(r"^\s*(?:название|наименование|препарат|лекарство)\s*:\s*", re.IGNORECASE)
+LIST_TARGET_RE = re.compile(r"\b(?:аптечк\w*|для|у\s+(?!меня\b)[а-яё]+|мам[аыеуой]|пап[аыеуой]|сын[ауом]?|доч[ьиекуой]\w*|жен[аыеуой]|муж[ауе]?"
+                            r"|бабушк[аиеуой]|дедушк[аиеуой]|брат[ауе]?|сестр[аыеуой]|ребён\w*|ребен\w*|детей|детям)\b", re.IGNORECASE)
+
+def parse_list_item(chunk):
+    """'Нурофен 200 мг, 2 уп до 05.2027' -> поля add_medicine или None"""
+    text = NAME_LABEL_RE.sub("", LIST_MARK_RE.sub("", chunk))  # "Название: Нурофен"
+    expiry = None
+    m = EXP_RE.search(text)
+    if m:
+        if m.group(1):
+            expiry = "%s-%02d" % (m.group(1), int(m.group(2))) + ("-%02d" % int(m.group(3)) if m.group(3) else "")
+        else:
+            expiry = "%s-%02d" % (m.group(6), int(m.group(5))) + ("-%02d" % int(m.group(4)) if m.group(4) else "")
+        text = text[:m.start()] + " " + text[m.end():]
+    qty = 1
+    m = QTY_RE.search(text)
+    if m:
+        qty = int(m.group(1))
+        text = text[:m.start()] + " " + text[m.end():]
+    dosage = None
+    m = DOSE_RE.search(text)
+    if m:
+        dosage = "%s %s" % (m.group(1), m.group(2).lower())
+        text = text[:m.start()] + " " + text[m.end():]
+    name = " ".join(re.sub(r"[^\w\s\-]", " ", EXP_WORDS_RE.sub(" ", text)).split())
+    if not re.search(r"[A-Za-zА-Яа-яЁё]", name) or len(name.split()) > 4:
+        return None
+    if not medref.lookup(name, exact=True) and name[-1:].lower() in "ую":
+        nom = name[:-1] + ("а" if name[-1].lower() == "у" else "я")
+        if medref.lookup(nom, exact=True):
+            name = nom  # "купила смекту"
+    return validate_command("add_medicine", {"name": name, "quantity": qty, "dosage": dosage, "expiry": expiry})
+
+def parse_medicine_list(text):
+    """Пункты списка лекарств (поля add_medicine) или None, если сообщение не список для добавления"""
+    if "?" in text or LIST_TARGET_RE.search(ADD_LIST_RE.sub("", text, count=1)):
+        return None
+    lines = [l for l in text.splitlines() if l.strip()]
+    marked = [l for l in lines if LIST_MARK_RE.match(l)]
+    if len(marked) >= BULK_INGEST_MIN:
+        chunks = marked
+    elif ADD_LIST_RE.match(text):
+        chunks = re.split(r"[,;\n]|\s+и\s+|\.\s", ADD_LIST_RE.sub("", text, count=1))
+    elif len(lines) >= BULK_INGEST_MIN and all(len(l.split()) <= 6 for l in lines):
+        chunks = lines
+    else:
+        return None
+    items = []
+    for chunk in chunks:
+        if not chunk.strip():
+            continue
+        item = parse_list_item(chunk)
+        if not item or not (medref.lookup(item["name"], exact=True) or item["dosage"]):
+            return None
+        items.append(item)
+    return items if len(items) >= BULK_INGEST_MIN else None
+
+def ingest_medicines(uid, items):
+    """Пункты списка в активную аптечку одной транзакцией; текст итога для пользователя"""
+    started = time.monotonic()
+    rows, expired = prepare_medicines(items)
     conn = get_db_connection()
-    if not conn: return
+    if not conn: return "Не удалось сохранить аптечку, попробуйте ещё раз."
     try:
         c = conn.cursor()
-        for med in re.findall(ADD_MED_RE, text):
-            parts = [p.strip() for p in med.split("|")]
-            name = parts[0] if len(parts) > 0 else ""
-            qty = 1
-            if len(parts) > 1:
-                try: qty = int(parts[1])
-                except: qty = 1
-            dosage = parts[2] if len(parts) > 2 else None
-            expiry = parts[3] if len(parts) > 3 else None
-            category = parts[4] if len(parts) > 4 else None
-            storage = parts[5] if len(parts) > 5 else ""
-            if name:
-                status, _ = check_expiry(expiry or "")
-                if status == "expired":
-                    continue
-                cab_id, _ = get_active_cabinet(uid)
-                exp_date = None
-                if expiry and expiry.strip() and expiry.strip() != "?":
-                    try:
-                        if re.match(r"^\d{4}-\d{2}-\d{2}$", expiry.strip()):
-                            exp_date = expiry.strip()
-                        elif re.match(r"^\d{4}-\d{2}$", expiry.strip()):
-                            exp_date = expiry.strip() + "-28"
-                    except: exp_date = None
-                c.execute("INSERT INTO inventory (user_id, medicine_name, quantity, dosage, expiry_date, category, cabinet_id, storage) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)", (uid, name, qty, dosage, exp_date, category, cab_id, storage or ""))
-        for name in re.findall(REM_MED_RE, text):
-            c.execute("DELETE FROM inventory WHERE user_id = %s AND LOWER(medicine_name) = LOWER(%s)", (uid, name.strip()))
-        for fam in re.findall(ADD_FAM_RE, text):
-            parts = [p.strip() for p in fam.split("|")]
-            name = parts[0] if len(parts) > 0 else ""
-            age = None
-            if len(parts) > 1:
-                try: age = int(parts[1])
-                except: age = None
-            gender = parts[2] if len(parts) > 2 else None
-            relation = parts[3] if len(parts) > 3 else None
-            # Проверка на шаблонные значения
-            bad_values = ['имя', 'name', 'test', 'член_семьи', 'member', 'пол', 'gender', 'отношение', 'relation', 'возраст']
-            if name and name.lower() not in bad_values:
-                if gender and gender.lower() in bad_values: gender = None
-                if relation and relation.lower() in bad_values: relation = None
-                # Проверяем дубликат
-                c.execute("SELECT id FROM family WHERE user_id = %s AND LOWER(name) = LOWER(%s)", (uid, name))
-                existing = c.fetchone()
-                if existing:
-                    c.execute("UPDATE family SET age=%s, gender=%s, relation=%s WHERE id=%s", (age, gender, relation, existing[0]))
-                    logger.info("Updated family member: %s for user %s", name, uid)
-                else:
-                    c.execute("INSERT INTO family (user_id, name, age, gender, relation) VALUES (%s,%s,%s,%s,%s)", (uid, name, age, gender, relation))
-                    logger.info("Added family member: %s for user %s", name, uid)
-        for cab in re.findall(CABINET_CREATE_RE, text):
-            cab_name = cab.strip()
-            if cab_name:
-                c.execute("INSERT INTO cabinets (user_id, name) VALUES (%s, %s) RETURNING id", (uid, cab_name))
-                new_id = c.fetchone()[0]
-                c.execute("INSERT INTO user_state (user_id, active_cabinet_id) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET active_cabinet_id = %s", (uid, new_id, new_id))
-        for cab in re.findall(CABINET_SWITCH_RE, text):
-            cab_name = cab.strip()
-            if cab_name:
-                c.execute("SELECT id FROM cabinets WHERE user_id = %s AND LOWER(name) LIKE LOWER(%s)", (uid, "%" + cab_name + "%"))
-                row = c.fetchone()
-                if row:
-                    c.execute("INSERT INTO user_state (user_id, active_cabinet_id) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET active_cabinet_id = %s", (uid, row[0], row[0]))
-                elif cab_name.lower() in ("моя аптечка", "своя", "моя", "основная"):
-                    c.execute("INSERT INTO user_state (user_id, active_cabinet_id) VALUES (%s, 0) ON CONFLICT (user_id) DO UPDATE SET active_cabinet_id = 0", (uid,))
-        for fam_del in re.findall(REM_FAM_RE, text):
-            fname = fam_del.strip()
-            if fname:
-                c.execute("DELETE FROM family WHERE user_id = %s AND LOWER(name) = LOWER(%s)", (uid, fname))
-                logger.info("Deleted family member: %s for user %s", fname, uid)
-
-        for fam_del in re.findall(REM_FAM_RE, text):
-            fname = fam_del.strip()
-            if fname:
-                c.execute("DELETE FROM family WHERE user_id = %s AND LOWER(name) = LOWER(%s)", (uid, fname))
-                logger.info("Deleted family member: %s for user %s", fname, uid)
-
-        for sh in re.findall(SHARE_RE, text):
-            parts = [p.strip() for p in sh.split("|")]
-            username = parts[0].replace("@", "") if len(parts) > 0 else ""
-            relation = parts[1] if len(parts) > 1 else ""
-            if username:
-                c.execute("INSERT INTO shared_access (owner_id, shared_with_id, shared_with_username, relation) VALUES (%s, 0, %s, %s) ON CONFLICT DO NOTHING", (uid, username, relation))
-        for rem in re.findall(ADD_REM_RE, text):
-            parts = [p.strip() for p in rem.split("|")]
-            member = parts[0] if len(parts) > 0 else ""
-            medicine = parts[1] if len(parts) > 1 else ""
-            schedule = parts[2] if len(parts) > 2 else "08:00"
-            meal = parts[3] if len(parts) > 3 else ""
-            dosage = parts[4] if len(parts) > 4 else ""
-            course_days = 0
-            if len(parts) > 5:
-                try: course_days = int(parts[5])
-                except: course_days = 0
-            pills_per_dose = 1.0
-            if len(parts) > 6:
-                try: pills_per_dose = float(parts[6])
-                except: pills_per_dose = 1.0
-            pills_in_pack = 0
-            if len(parts) > 7:
-                try: pills_in_pack = int(parts[7])
-                except: pills_in_pack = 0
-            if medicine:
-                from datetime import date, timedelta
-                start = date.today()
-                end = start + timedelta(days=course_days) if course_days > 0 else None
-                times_per_day = len(schedule.split(","))
-                total_pills = course_days * times_per_day * pills_per_dose if course_days > 0 else 0
-                c.execute("INSERT INTO reminders (user_id, family_member, medicine_name, dosage, schedule_time, meal_relation, course_days, pills_per_dose, pills_in_pack, pills_remaining, start_date, end_date, active) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,TRUE)", (uid, member, medicine, dosage, schedule, meal, course_days, pills_per_dose, pills_in_pack, total_pills, start, end))
+        cab_id, cab_name = active_cabinet(c, uid)
+        done = upsert_inventory(c, uid, cab_id, rows) if rows else []
         conn.commit()
     except Exception as e:
-        logger.error("Cmd err: %s", e, exc_info=True)
+        logger.error("Bulk ingest err: %s", e, exc_info=True)
+        command_stats.count("errors")
         try: conn.rollback()
         except: pass
+        return "Не удалось сохранить аптечку, попробуйте ещё раз."
     finally: conn.close()
-
-def clean_commands(text):
-    for rx in [ADD_MED_RE, REM_MED_RE, ADD_FAM_RE, ADD_REM_RE, SHARE_RE, CABINET_CREATE_RE, CABINET_SWITCH_RE, REM_FAM_RE]:
-        text = re.sub(rx, "", text)
-    return text.strip()
+    command_stats.record([("add_medicine", a) for a in items], time.monotonic() - started)
+    added = [n for n, new in done if new]
+    topped = [n for n, new in done if not new]
+    logger.info("Bulk ingest for %s: %s items, %s new, %s merged, %s expired", uid, len(items), len(added), len(topped), len(expired))
+    lines = ["\U0001f4e6 Аптечка «%s»: добавлено %s, пополнено %s." % (cab_name, len(added), len(topped))]
+    if added:
+        lines.append("\u2705 Новые: " + ", ".join(added))
+    if topped:
+        lines.append("\u2795 Уже были, прибавил количество: " + ", ".join(topped))
+    if expired:
+        lines.append("\u26d4 Просрочены, не добавлял: " + ", ".join(expired))
+    return "\n".join(lines)
 
 # === Telegram ===
 
-def tg_send_reminder(chat_id, text, reminder_id, log_id):
+def _b36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if n == 0:
+            return out
+
+def parse_reminder_callback(data):
+    """'rd:1a.1b' -> ('done', [46, 47]); старый формат rem_done_<rem>_<log> тоже понимаем"""
+    if data.startswith(("rd:", "rs:")):
+        try: ids = [int(x, 36) for x in data[3:].split(".") if x]
+        except ValueError: return None, []
+        return ("done" if data[1] == "d" else "snooze"), ids
+    for prefix, action in (("rem_done_", "done"), ("rem_snooze_", "snooze")):
+        if data.startswith(prefix):
+            parts = data.split("_")
+            if len(parts) >= 4 and parts[3].isdigit():
+                return action, [int(parts[3])]
+    return None, []
+
+def reminder_keyboard(items):
+    """items: [(log_id, название)]. У каждой дозы свои кнопки, для нескольких - ещё 'все сразу'"""
+    if len(items) == 1:
+        i = _b36(items[0][0])
+        return {"inline_keyboard": [[{"text": "\u2705 Принял", "callback_data": "rd:" + i}, {"text": "\u23f0 Отложить (1ч)", "callback_data": "rs:" + i}]]}
+    rows = [[{"text": "\u2705 " + name[:30], "callback_data": "rd:" + _b36(log_id)}, {"text": "\u23f0 1ч", "callback_data": "rs:" + _b36(log_id)}] for log_id, name in items]
+    all_ids = ".".join(_b36(log_id) for log_id, _ in items)
+    if len("rd:" + all_ids) <= 64:  # лимит callback_data
+        rows.append([{"text": "\u2705 Принял все", "callback_data": "rd:" + all_ids}, {"text": "\u23f0 Все на 1ч", "callback_data": "rs:" + all_ids}])
+    return {"inline_keyboard": rows}
+
+def remaining_reminder_items(markup, handled_ids):
+    """Дозы из клавиатуры сообщения, по которым ещё не нажимали"""
+    items = []
+    for row in (markup or {}).get("inline_keyboard", []):
+        action, ids = parse_reminder_callback(row[0].get("callback_data", ""))
+        if action == "done" and len(ids) == 1 and ids[0] not in handled_ids:
+            items.append((ids[0], row[0]["text"].replace("\u2705 ", "", 1)))
+    return items
+
+def tg_send_reminder(chat_id, text, items):
     """Отправить напоминание с inline-кнопками"""
     html_text = md_to_html(text)
-    keyboard = {"inline_keyboard": [
-        [{"text": "\u2705 Принял", "callback_data": "rem_done_%s_%s" % (reminder_id, log_id)},
-         {"text": "\u23f0 Отложить (1ч)", "callback_data": "rem_snooze_%s_%s" % (reminder_id, log_id)}]
-    ]}
     try:
-        result = tg_api("sendMessage", {"chat_id": chat_id, "text": html_text, "parse_mode": "HTML", "reply_markup": keyboard})
-        if result and result.get("ok"):
-            return result["result"]["message_id"]
+        return tg_api("sendMessage", {"chat_id": chat_id, "text": html_text, "parse_mode": "HTML", "reply_markup": reminder_keyboard(items)})
     except Exception as e:
         logger.error("Send reminder error: %s", e)
     return None
@@ -572,34 +2615,111 @@ def tg_answer_callback(callback_query_id, text=""):
     except Exception as e:
         logger.error("Answer callback error: %s", e)
 
-def tg_edit_message(chat_id, message_id, text):
-    """Отредактировать сообщение (убрать кнопки)"""
+def tg_edit_message(chat_id, message_id, text, reply_markup=None):
+    """Отредактировать сообщение (без reply_markup кнопки убираются)"""
     html_text = md_to_html(text)
+    data = {"chat_id": chat_id, "message_id": message_id, "text": html_text, "parse_mode": "HTML"}
+    if reply_markup:
+        data["reply_markup"] = reply_markup
     try:
-        tg_api("editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": html_text, "parse_mode": "HTML"})
+        tg_api("editMessageText", data)
     except Exception as e:
         logger.error("Edit message error: %s", e)
 
+# Таймауты по методам, сек.: короткие вызовы не должны висеть по 30 секунд
+TG_TIMEOUTS = {"answerCallbackQuery": 5, "deleteMessage": 5, "getMe": 5, "editMessageText": 10, "sendMessage": 15, "getFile": 10, "getUpdates": 10}
+TG_DOWNLOAD_TIMEOUT = 30
+
+_tg_client = None
+_tg_client_lock = threading.Lock()
+
+def get_tg_client():
+    """Общий потокобезопасный httpx-клиент: пул keep-alive соединений, HTTP/2 если установлен h2"""
+    global _tg_client
+    if _tg_client is None:
+        with _tg_client_lock:
+            if _tg_client is None:
+                http2 = importlib.util.find_spec("h2") is not None
+                _tg_client = httpx.Client(http2=http2, timeout=httpx.Timeout(15, connect=5),
+                                          limits=httpx.Limits(max_connections=TG_POOL_SIZE, max_keepalive_connections=TG_POOL_SIZE, keepalive_expiry=60))
+    return _tg_client
+
 def tg_api(method, data=None):
-    url = "https://api.telegram.org/bot" + TELEGRAM_TOKEN + "/" + method
-    if data:
-        req = urllib.request.Request(url, data=json.dumps(data).encode("utf-8"), headers={"Content-Type":"application/json"})
-    else:
-        req = urllib.request.Request(url)
+    db_release()
+    url = TELEGRAM_API_BASE + "/bot" + TELEGRAM_TOKEN + "/" + method
+    timeout = httpx.Timeout(TG_TIMEOUTS.get(method, 15), connect=5)
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            return json.loads(resp.read().decode("utf-8"))
+        if data:
+            resp = get_tg_client().post(url, json=data, timeout=timeout)
+        else:
+            resp = get_tg_client().get(url, timeout=timeout)
     except Exception as e: logger.error("TG err: %s", e); return None
+    if resp.status_code >= 400:
+        # Telegram отдаёт ошибку JSON-ом: ok=false, error_code, parameters.retry_after при 429
+        logger.error("TG err %s: %s %s", method, resp.status_code, resp.text[:200])
+    try: return resp.json()
+    except ValueError: return None
 
-def tg_send(chat_id, text):
-    html_text = md_to_html(text)
-    try:
-        result = tg_api("sendMessage", {"chat_id": chat_id, "text": html_text, "parse_mode": "HTML"})
-        if not result or not result.get("ok"):
-            return tg_api("sendMessage", {"chat_id": chat_id, "text": text})
-        return result
-    except:
-        return tg_api("sendMessage", {"chat_id": chat_id, "text": text})
+def tg_api_html(method, data, text, retry_429=True):
+    """Запрос с text в HTML. Без разметки - повтор, только если Telegram не разобрал HTML (400).
+    429 - один повтор после retry_after через общий лимит (retry_429=False - повторяет вызывающий, как ReminderFanout).
+    Нет ответа (таймаут) - не повторяем: сообщение могло уйти"""
+    result = tg_api(method, dict(data, text=md_to_html(text), parse_mode="HTML"))
+    retry_after = ((result or {}).get("parameters") or {}).get("retry_after")
+    if retry_after and retry_429:
+        tg_rate_limiter.pause(retry_after)
+        tg_rate_limiter.acquire()
+        result = tg_api(method, dict(data, text=md_to_html(text), parse_mode="HTML"))
+    if result and not result.get("ok") and result.get("error_code") == 400 and "parse" in result.get("description", "").lower():
+        tg_rate_limiter.acquire()
+        result = tg_api(method, dict(data, text=text))
+    return result
+
+def tg_send(chat_id, text, retry_429=True):
+    return tg_api_html("sendMessage", {"chat_id": chat_id}, text, retry_429)
+
+class StreamingReply:
+    """Одно сообщение, которое дописывается правками по мере генерации ответа.
+    Правки не чаще раза в interval сек. и через общий лимит бота; промежуточные - без разметки"""
+    MAX_LEN = 4096  # лимит Telegram на текст сообщения
+
+    def __init__(self, chat_id, interval=GPT_STREAM_EDIT_INTERVAL, min_chars=GPT_STREAM_MIN_CHARS):
+        self.chat_id = chat_id
+        self.interval = interval
+        self.min_chars = min_chars
+        self.parts = []
+        self.message_id = None
+        self.shown = ""
+        self.next_edit = 0.0
+        self.edits = 0
+
+    def feed(self, delta):
+        self.parts.append(delta)
+        if time.monotonic() < self.next_edit:
+            return
+        text = visible_stream_text("".join(self.parts))[:self.MAX_LEN]
+        if len(text) < self.min_chars or text == self.shown:
+            return
+        tg_rate_limiter.acquire()
+        if self.message_id is None:
+            result = tg_api("sendMessage", {"chat_id": self.chat_id, "text": text})
+            if result and result.get("ok"):
+                self.message_id = result["result"]["message_id"]
+        else:
+            tg_api("editMessageText", {"chat_id": self.chat_id, "message_id": self.message_id, "text": text})
+            self.edits += 1
+        self.shown = text
+        self.next_edit = time.monotonic() + self.interval
+
+    def finish(self, text):
+        """Окончательный текст (команды уже выполнены и вырезаны) - с разметкой, как tg_send"""
+        if self.message_id is None:
+            return tg_send(self.chat_id, text)
+        html = md_to_html(text)
+        if text == self.shown and html == text:
+            return None  # без разметки показанный текст уже окончательный; с ** - нужна правка с HTML
+        tg_rate_limiter.acquire()
+        return tg_api_html("editMessageText", {"chat_id": self.chat_id, "message_id": self.message_id}, text)
 
 def tg_send_with_menu(chat_id, text):
     keyboard = {"keyboard": [
@@ -607,14 +2727,7 @@ def tg_send_with_menu(chat_id, text):
         [{"text": "\U0001f48a Курсы приёма"}, {"text": "\U0001f468\u200d\U0001f469\u200d\U0001f467\u200d\U0001f466 Семья"}],
         [{"text": "\U0001f3e5 Другие аптечки"}]
     ], "resize_keyboard": True, "one_time_keyboard": False}
-    html_text = md_to_html(text)
-    try:
-        result = tg_api("sendMessage", {"chat_id": chat_id, "text": html_text, "parse_mode": "HTML", "reply_markup": keyboard})
-        if not result or not result.get("ok"):
-            return tg_api("sendMessage", {"chat_id": chat_id, "text": text, "reply_markup": keyboard})
-        return result
-    except:
-        return tg_api("sendMessage", {"chat_id": chat_id, "text": text, "reply_markup": keyboard})
+    return tg_api_html("sendMessage", {"chat_id": chat_id, "reply_markup": keyboard}, text)
 
 def tg_send_start_button(chat_id):
     keyboard = {"keyboard": [[{"text": "\U0001f4aa Навести порядок"}]], "resize_keyboard": True, "one_time_keyboard": True}
@@ -624,9 +2737,12 @@ def tg_get_file_bytes(file_id):
     result = tg_api("getFile", {"file_id": file_id})
     if result and result.get("ok"):
         fp = result["result"]["file_path"]
-        url = "https://api.telegram.org/file/bot" + TELEGRAM_TOKEN + "/" + fp
-        with urllib.request.urlopen(url, timeout=30) as resp:
-            return resp.read()
+        url = TELEGRAM_API_BASE + "/file/bot" + TELEGRAM_TOKEN + "/" + fp
+        try:
+            resp = get_tg_client().get(url, timeout=TG_DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+            return resp.content
+        except Exception as e: logger.error("TG download err: %s", e)
     return None
 
 def tg_delete_message(chat_id, message_id):
@@ -700,10 +2816,68 @@ def handle_admin(chat_id):
 
 # === Main handler ===
 
-def handle_update(data):
+BUTTON_MAP = {
+    "\U0001f3e0 Старт": "/start",
+    "\U0001f4aa Навести порядок": "/start",
+    "\U0001f4e6 Моя аптечка": "/inventory",
+    "\U0001f48a Курсы приёма": "/reminders",
+    "\U0001f468\u200d\U0001f469\u200d\U0001f467\u200d\U0001f466 Семья": "/family",
+    "\U0001f3e5 Другие аптечки": "/cabinets",
+    "\U0001f4e6 Аптечка": "/inventory",
+    "\U0001f3e0 Аптечки": "/cabinets",
+}
+
+def update_user_id(data):
+    for kind in ("message", "callback_query"):
+        if data.get(kind, {}).get("from"):
+            return data[kind]["from"]["id"]
+    return None
+
+def is_mergeable(data):
+    """Обычный текст или голосовое - можно склеить с соседними в один ход GPT. Команды, кнопки, промокоды, фото - нет"""
     msg = data.get("message")
-    if not msg:
+    if not msg or "callback_query" in data:
+        return False
+    if "voice" in msg:
+        return True
+    text = msg.get("text", "").strip()
+    upper = text.upper()
+    return bool(text) and not text.startswith("/") and text not in BUTTON_MAP and not upper.startswith("NB-") and not upper.startswith("NEBOLIT")
+
+# Update-ы одного пользователя без очереди - по очереди внутри процесса. Замок берётся до соединения из пула:
+# ждущий поток не держит соединение. Между инстансами порядок даёт только очередь (UPDATE_QUEUE=1)
+_user_locks = [threading.Lock() for _ in range(64)]
+
+def user_lock(uid):
+    return _user_locks[hash(uid) % len(_user_locks)]
+
+def handle_update_once(data):
+    """handle_update без очереди: повтор того же update от Telegram отбрасывается.
+    Ключ фиксируется вместе с первым отрезком update-а, до первого вызова Telegram или GPT"""
+    keys = update_keys(data)
+    if update_dedup.is_known(keys):
+        return
+    uid = update_user_id(data)
+    with user_lock(uid or 0), db_unit():
+        conn = get_db_connection()
+        if conn and not update_dedup.claim(conn.cursor(), keys):
+            return
+        handle_update(data)
+    update_dedup.remember(keys)
+
+def handle_update(data, more=()):
+    """more - следующие сообщения того же пользователя, склеенные с data в один ход"""
+    with db_unit():
+        if "callback_query" in data:
+            handle_callback(data["callback_query"])
+            return
+        _handle_update(data, more)
+
+def _handle_update(data, more=()):
+    msgs = [m for m in [data.get("message")] + [d.get("message") for d in more] if m]
+    if not msgs:
         return
+    msg = msgs[0]
     chat_id = msg["chat"]["id"]
     uid = msg["from"]["id"]
     uname = msg["from"].get("username") or msg["from"].get("first_name") or ""
@@ -724,56 +2898,52 @@ def handle_update(data):
 
     save_user(uid, uname)
 
-    # Extract user_text from voice/photo/text
-    user_text = ""
+    # Extract user_text from voice/photo/text (склеенные сообщения - построчно)
+    texts = []
     recognition_msg_ids = []
 
-    if "voice" in msg:
-        vb = tg_get_file_bytes(msg["voice"]["file_id"])
-        if vb:
-            t = process_voice(vb)
-            if t:
-                user_text = t
-                result = tg_send(chat_id, "\U0001f3a4 Распознано: " + t)
+    for msg in msgs:
+        if "voice" in msg:
+            vb = tg_get_file_bytes(msg["voice"]["file_id"])
+            if vb:
+                t = process_voice(vb)
+                if t:
+                    texts.append(t)
+                    result = tg_send(chat_id, "\U0001f3a4 Распознано: " + t)
+                    if result and result.get("ok"):
+                        recognition_msg_ids.append(result["result"]["message_id"])
+                else:
+                    tg_send(chat_id, "Не удалось распознать голос.")
+            else:
+                tg_send(chat_id, "Не удалось скачать голосовое.")
+        elif "photo" in msg:
+            pb = tg_get_file_bytes(msg["photo"][-1]["file_id"])
+            if pb:
+                result = tg_send(chat_id, "\U0001f50d Анализирую фото...")
                 if result and result.get("ok"):
                     recognition_msg_ids.append(result["result"]["message_id"])
+                vt = process_photo_vision(pb)
+                if vt:
+                    t = "Сфотографировал упаковку лекарства:\n" + vt
+                    known = medref.find_in_text(vt)
+                    if known:
+                        t += "\nСправочник: " + "; ".join(describe_medicine(e) for e in known)
+                    cap = msg.get("caption", "")
+                    if cap: t += "\nКомментарий: " + cap
+                    texts.append(t)
+                else:
+                    tg_send(chat_id, "Не удалось распознать фото.")
             else:
-                tg_send(chat_id, "Не удалось распознать голос."); return
-        else:
-            tg_send(chat_id, "Не удалось скачать голосовое."); return
-    elif "photo" in msg:
-        pb = tg_get_file_bytes(msg["photo"][-1]["file_id"])
-        if pb:
-            result = tg_send(chat_id, "\U0001f50d Анализирую фото...")
-            if result and result.get("ok"):
-                recognition_msg_ids.append(result["result"]["message_id"])
-            vt = process_photo_vision(pb)
-            if vt:
-                user_text = "Сфотографировал упаковку лекарства:\n" + vt
-                cap = msg.get("caption", "")
-                if cap: user_text += "\nКомментарий: " + cap
-            else:
-                tg_send(chat_id, "Не удалось распознать фото."); return
-        else:
-            tg_send(chat_id, "Не удалось скачать фото."); return
-    elif "text" in msg:
-        user_text = msg["text"]
-    else:
+                tg_send(chat_id, "Не удалось скачать фото.")
+        elif "text" in msg:
+            texts.append(msg["text"])
+    if not texts:
         return
+    user_text = "\n".join(texts)
 
     # Map buttons to commands
-    button_map = {
-        "\U0001f3e0 Старт": "/start",
-        "\U0001f4aa Навести порядок": "/start",
-        "\U0001f4e6 Моя аптечка": "/inventory",
-        "\U0001f48a Курсы приёма": "/reminders",
-        "\U0001f468\u200d\U0001f469\u200d\U0001f467\u200d\U0001f466 Семья": "/family",
-        "\U0001f3e5 Другие аптечки": "/cabinets",
-        "\U0001f4e6 Аптечка": "/inventory",
-        "\U0001f3e0 Аптечки": "/cabinets",
-    }
-    if user_text in button_map:
-        user_text = button_map[user_text]
+    if user_text in BUTTON_MAP:
+        user_text = BUTTON_MAP[user_text]
 
     # Show start button for brand new users
     if is_new and user_text != "/start":
@@ -843,12 +3013,35 @@ def handle_update(data):
 
     # Block paid features if not active
     if not sub["active"]:
-        free_words = ["что такое", "для чего", "от чего", "зачем", "описание", "инструкция", "побочные", "аналог", "что принять", "что выпить", "болит", "температура", "кашель", "насморк", "тошнит", "голова"]
-        is_free = any(w in user_text.lower() for w in free_words)
+        is_free = any(w in user_text.lower() for w in FREE_WORDS)
         if not is_free and user_text.strip() != "/start":
             tg_send(chat_id, "\U0001f512 Эта функция доступна по подписке.\n\nБесплатно: справки о лекарствах и советы при недомогании.\nПолный доступ: /subscribe")
             return
 
+    # Простые просьбы - теми же командами, но без GPT
+    routed = route_intent(uid, user_text) if LOCAL_INTENTS and not user_text.startswith("/") else None
+    if routed:
+        if routed.commands:
+            process_gpt_commands(uid, routed.commands)
+        save_message(uid, "user", user_text)
+        if routed.reply:
+            save_message(uid, "assistant", routed.reply)
+            tg_send(chat_id, routed.reply)
+        if not routed.then:
+            return
+        user_text = routed.then
+
+    # Список лекарств (текстом, голосом, фото нескольких упаковок) - одной транзакцией и одним ответом, без GPT
+    items = parse_medicine_list(user_text) if BULK_INGEST and not user_text.startswith("/") else None
+    if items:
+        reply = ingest_medicines(uid, items)
+        save_message(uid, "user", user_text)
+        save_message(uid, "assistant", reply)
+        tg_send(chat_id, reply)
+        for mid in recognition_msg_ids:
+            tg_delete_message(chat_id, mid)
+        return
+
     # === Commands ===
 
     if user_text.strip() == "/start":
@@ -965,17 +3158,317 @@ def handle_update(data):
 
     # GPT response for everything else
     save_message(uid, "user", user_text)
-    reply = generate_gpt_response(uid, user_text)
+    stream = StreamingReply(chat_id) if GPT_STREAM else None
+    reply = generate_gpt_response(uid, user_text, on_delta=stream.feed if stream else None)
     save_message(uid, "assistant", reply)
     logger.info("GPT reply for %s: %s", uid, reply[:300])
-    tg_send(chat_id, reply)
+    if stream:
+        stream.finish(reply)
+    else:
+        tg_send(chat_id, reply)
 
     # Cleanup recognition messages after response
     for mid in recognition_msg_ids:
         tg_delete_message(chat_id, mid)
 
+# === Update queue ===
+# update_queue - очередь с таймаутом видимости: захват сдвигает visible_at вперёд и увеличивает attempts,
+# успех - DELETE, ошибка - повтор с паузой, после UPDATE_MAX_ATTEMPTS - status = 'dead'.
+# attempts - заодно токен захвата: подтверждает только тот, кто захватил последним.
+# Порядок внутри пользователя: берётся только самый ранний его update в очереди (в работе он тоже 'queued'),
+# так что update-ы одного пользователя идут строго по очереди, а разных - параллельно, на любом инстансе
+
+CLAIM_UPDATE_SQL = """
+    WITH next AS (
+        SELECT id FROM update_queue q WHERE status = 'queued' AND visible_at <= NOW()
+            AND NOT EXISTS (SELECT 1 FROM update_queue p WHERE p.user_id = q.user_id AND p.status = 'queued' AND p.id < q.id)
+        ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    UPDATE update_queue q SET visible_at = NOW() + %(visibility)s * INTERVAL '1 second', attempts = q.attempts + 1
+    FROM next WHERE q.id = next.id
+    RETURNING q.id, q.attempts, q.payload, EXTRACT(EPOCH FROM NOW() - q.created_at), q.user_id, q.mergeable"""
+
+# Следующие update-ы того же пользователя - кандидаты на склейку с захваченным
+MERGE_CANDIDATES_SQL = """
+    SELECT id, mergeable FROM update_queue WHERE user_id = %(uid)s AND status = 'queued' AND id > %(id)s
+    ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED"""
+
+# Debounce: каждое новое сообщение отодвигает ещё не взятые сообщения пользователя, но не дальше 3 окон от первого
+DEBOUNCE_SQL = """
+    UPDATE update_queue SET visible_at = LEAST(NOW() + %(d)s * INTERVAL '1 second', created_at + 3 * %(d)s * INTERVAL '1 second')
+    WHERE user_id = %(uid)s AND status = 'queued' AND mergeable AND attempts = 0"""
+
+def update_keys(data):
+    keys = []
+    if data.get("update_id") is not None:
+        keys.append("u:%s" % data["update_id"])
+    if data.get("callback_query", {}).get("id"):
+        keys.append("cb:%s" % data["callback_query"]["id"])
+    return keys
+
+class UpdateDedup:
+    """Идемпотентность по update_id и callback_query id: LRU в памяти - быстрый путь без БД,
+    processed_updates - между инстансами и рестартами (чистится по DEDUP_TTL_HOURS)"""
+    CLEANUP_EVERY = 1000  # новых ключей между чистками просроченных
+
+    def __init__(self, size=DEDUP_LRU_SIZE, ttl_hours=DEDUP_TTL_HOURS):
+        from collections import OrderedDict
+        self.size = size
+        self.ttl_hours = ttl_hours
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._since_cleanup = 0
+        self.stats = {"hits_memory": 0, "hits_db": 0, "misses": 0}
+
+    def is_known(self, keys):
+        with self._lock:
+            for k in keys:
+                if k in self._seen:
+                    self._seen.move_to_end(k)
+                    self.stats["hits_memory"] += 1
+                    return True
+        return False
+
+    def claim(self, c, keys):
+        """Записать ключи в транзакции вызывающего. False - update уже был (дубль)"""
+        if not keys:
+            return True
+        c.execute("INSERT INTO processed_updates (key) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING RETURNING key", (keys,))
+        new = len(c.fetchall())
+        with self._lock:
+            if new < len(keys):
+                self.stats["hits_db"] += 1
+            else:
+                self.stats["misses"] += 1
+                self._since_cleanup += 1
+            cleanup = self._since_cleanup >= self.CLEANUP_EVERY
+            if cleanup:
+                self._since_cleanup = 0
+        if cleanup:
+            c.execute("DELETE FROM processed_updates WHERE created_at < NOW() - %s * INTERVAL '1 hour'", (self.ttl_hours,))
+        # Новый callback с уже виденным update_id (или наоборот) - тоже дубль
+        return new == len(keys)
+
+    def remember(self, keys):
+        """Только после commit: иначе повтор не сохранённого update-а потеряется"""
+        with self._lock:
+            for k in keys:
+                self._seen[k] = True
+                self._seen.move_to_end(k)
+            while len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+
+    def snapshot(self):
+        with self._lock:
+            st = dict(self.stats)
+            st["lru_size"] = len(self._seen)
+        total = st["hits_memory"] + st["hits_db"] + st["misses"]
+        st["duplicate_rate"] = round((st["hits_memory"] + st["hits_db"]) / total, 4) if total else 0.0
+        return st
+
+update_dedup = UpdateDedup()
+
+def enqueue_update(data):
+    """Сохранить update и разбудить воркер. False - не сохранили, Telegram должен повторить.
+    Повтор уже сохранённого update-а - True без записи"""
+    keys = update_keys(data)
+    if update_dedup.is_known(keys):
+        return True
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        c = conn.cursor()
+        if update_dedup.claim(c, keys):
+            uid, mergeable = update_user_id(data), is_mergeable(data)
+            c.execute("INSERT INTO update_queue (update_id, user_id, mergeable, payload) VALUES (%s, %s, %s, %s::jsonb)",
+                      (data.get("update_id"), uid, mergeable, json.dumps(data)))
+            if mergeable and uid and UPDATE_DEBOUNCE_SECONDS > 0:
+                c.execute(DEBOUNCE_SQL, {"d": UPDATE_DEBOUNCE_SECONDS, "uid": uid})
+            queued = True
+        else:
+            queued = False
+        conn.commit()
+    except Exception as e:
+        logger.error("Enqueue update err: %s", e)
+        try: conn.rollback()
+        except: pass
+        return False
+    finally: conn.close()
+    update_dedup.remember(keys)
+    if queued and update_workers and not UPDATE_DEBOUNCE_SECONDS:
+        update_workers.notify()
+    return True
+
+def requeue_dead_updates():
+    """Вернуть dead letter в очередь (после исправления причины падения)"""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        c = conn.cursor()
+        c.execute("UPDATE update_queue SET status = 'queued', attempts = 0, visible_at = NOW(), last_error = NULL WHERE status = 'dead'")
+        conn.commit()
+        return c.rowcount
+    except Exception as e:
+        logger.error("Requeue dead err: %s", e)
+        conn.rollback()
+        return None
+    finally: conn.close()
+
+class UpdateWorkerPool:
+    """Фоновые обработчики update_queue: workers потоков = не больше стольких update-ов одновременно"""
+    def __init__(self, workers=UPDATE_WORKERS, visibility=UPDATE_VISIBILITY_TIMEOUT, max_attempts=UPDATE_MAX_ATTEMPTS, poll=UPDATE_POLL_INTERVAL):
+        self.workers = workers
+        self.visibility = visibility
+        self.max_attempts = max_attempts
+        self.poll = poll
+        self._cond = threading.Condition()
+        self._kicks = 0
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.stats = {"processed": 0, "retried": 0, "dead": 0, "claim_errors": 0, "merged": 0}
+        self.waits = []  # сек. от записи в очередь до начала обработки, последние 1000
+        self.durations = []
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.run_forever, name="update-worker-%s" % i, daemon=True).start()
+
+    def notify(self):
+        with self._cond:
+            self._kicks += 1
+            self._cond.notify()
+
+    def run_forever(self):
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                logger.error("Claim update err: %s", e)
+                with self._lock:
+                    self.stats["claim_errors"] += 1
+                job = None
+            if job:
+                self.process(*job)
+                continue
+            with self._cond:
+                if not self._kicks:
+                    self._cond.wait(self.poll)
+                self._kicks = max(0, self._kicks - 1)
+
+    def claim(self):
+        """(id, attempts, payload, ждал сек.) первого update-а + [(id, attempts, payload)] склеенных с ним"""
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("no DB connection")
+        try:
+            c = conn.cursor()
+            c.execute(CLAIM_UPDATE_SQL, {"visibility": self.visibility})
+            row = c.fetchone()
+            followers = []
+            if row and row[5] and row[4] and row[1] <= self.max_attempts and UPDATE_MERGE_MAX > 1:
+                c.execute(MERGE_CANDIDATES_SQL, {"uid": row[4], "id": row[0], "limit": UPDATE_MERGE_MAX - 1})
+                ids = []
+                for qid, mergeable in c.fetchall():
+                    if not mergeable:
+                        break  # склеиваем только подряд идущие: команда после текста - отдельным ходом
+                    ids.append(qid)
+                if ids:
+                    c.execute("""UPDATE update_queue SET visible_at = NOW() + %s * INTERVAL '1 second', attempts = attempts + 1
+                                 WHERE id = ANY(%s) RETURNING id, attempts, payload""", (self.visibility, ids))
+                    followers = sorted(c.fetchall())
+            conn.commit()
+            return (row[:4], followers) if row else None
+        finally:
+            conn.close()
+
+    def process(self, head, followers):
+        qid, attempts, payload, waited = head
+        items = [(qid, attempts)] + [(f[0], f[1]) for f in followers]
+        if attempts > self.max_attempts:
+            # Воркер, взявший последнюю попытку, умер, не дойдя до ack/fail
+            self._finish(items, "visibility timeout after %s attempts" % (attempts - 1))
+            return
+        with self._lock:
+            self.busy += 1
+            self.waits = self.waits[-999:] + [float(waited)]
+        t = time.monotonic()
+        error = None
+        try:
+            handle_update(payload, [f[2] for f in followers])
+        except Exception as e:
+            logger.error("Update %s attempt %s err: %s", qid, attempts, e)
+            error = "%s: %s" % (type(e).__name__, e)
+        with self._lock:
+            self.busy -= 1
+            self.durations = self.durations[-999:] + [time.monotonic() - t]
+            self.stats["merged"] += len(followers)
+        self._finish(items, error)
+
+    def _finish(self, items, error):
+        """items: [(id, attempts)] - подтвердить или вернуть в очередь / в dead letter"""
+        conn = get_db_connection()
+        if not conn: return  # не подтвердили - через visibility timeout update обработают ещё раз
+        ids, attempts = [i[0] for i in items], [i[1] for i in items]
+        try:
+            c = conn.cursor()
+            if error is None:
+                c.execute("""DELETE FROM update_queue q USING unnest(%s::bigint[], %s::int[]) AS t(id, attempts)
+                             WHERE q.id = t.id AND q.attempts = t.attempts""", (ids, attempts))
+                counts = {"processed": len(items)}
+            else:
+                # Повтор через 5, 10, 20... сек.
+                c.execute("""UPDATE update_queue q SET status = CASE WHEN q.attempts >= %s THEN 'dead' ELSE 'queued' END,
+                                 last_error = %s, visible_at = NOW() + 5 * POWER(2, q.attempts - 1) * INTERVAL '1 second'
+                             FROM unnest(%s::bigint[], %s::int[]) AS t(id, attempts)
+                             WHERE q.id = t.id AND q.attempts = t.attempts RETURNING q.status""",
+                          (self.max_attempts, error[:1000], ids, attempts))
+                statuses = [r[0] for r in c.fetchall()]
+                counts = {"dead": statuses.count("dead"), "retried": statuses.count("queued")}
+            conn.commit()
+            with self._lock:
+                for k, v in counts.items():
+                    self.stats[k] += v
+        except Exception as e:
+            logger.error("Finish update %s err: %s", ids, e)
+            try: conn.rollback()
+            except: pass
+        finally: conn.close()
+
+    def snapshot(self):
+        with self._lock:
+            st = dict(self.stats)
+            waits, durations = sorted(self.waits), sorted(self.durations)
+            st.update({"workers": self.workers, "busy": self.busy})
+        st.update({"wait_p50_ms": round(percentile(waits, 50) * 1000), "wait_p99_ms": round(percentile(waits, 99) * 1000),
+                   "handle_p50_ms": round(percentile(durations, 50) * 1000), "handle_p99_ms": round(percentile(durations, 99) * 1000)})
+        return st
+
+update_workers = None
+
+def start_update_workers():
+    global update_workers
+    if update_workers:
+        return
+    update_workers = UpdateWorkerPool()
+    update_workers.start()
+    logger.info("Update workers started: %s", update_workers.workers)
+
+if UPDATE_QUEUE:
+    WARMUP_STEPS.append(("update_workers", start_update_workers))
+
 # === Flask routes ===
 
+def admin_required(view):
+    """Служебные эндпоинты - только с ADMIN_API_KEY"""
+    import functools, hmac
+    @functools.wraps(view)
+    def guarded(*args, **kwargs):
+        key = flask_request.headers.get("X-Admin-Key") or flask_request.args.get("key") or ""
+        if not ADMIN_API_KEY or not hmac.compare_digest(key.encode(), ADMIN_API_KEY.encode()):
+            return "Forbidden", 403
+        return view(*args, **kwargs)
+    return guarded
+
 @app.route("/yukassa", methods=["POST"])
 def yukassa_webhook():
     try:
@@ -1004,208 +3497,580 @@ def handle_callback(callback):
     from datetime import datetime, timedelta
     cb_id = callback.get("id")
     data = callback.get("data", "")
+    uid = callback.get("from", {}).get("id")
     message = callback.get("message", {})
     chat_id = message.get("chat", {}).get("id")
     message_id = message.get("message_id")
-
-    if data.startswith("rem_done_"):
-        # Пользователь принял лекарство
-        parts = data.split("_")
-        if len(parts) >= 4:
-            rem_id = parts[2]
-            log_id = parts[3]
-            conn = get_db_connection()
-            if conn:
-                try:
-                    c = conn.cursor()
-                    c.execute("UPDATE reminder_log SET status = 'done', completed_at = NOW() WHERE id = %s", (log_id,))
-                    conn.commit()
-                except Exception as e:
-                    logger.error("Callback done error: %s", e)
-                finally:
-                    conn.close()
+    original_text = message.get("text", "")
+    action, log_ids = parse_reminder_callback(data)
+    shown = remaining_reminder_items(message.get("reply_markup"), [])
+    if not action or not log_ids:
+        tg_answer_callback(cb_id)
+        return
+    conn = get_db_connection()
+    if not conn:
+        tg_answer_callback(cb_id, "\u274c Ошибка, попробуйте ещё раз")
+        return
+    try:
+        c = conn.cursor()
+        if action == "done":
+            # Пользователь принял лекарство
+            c.execute("UPDATE reminder_log SET status = 'done', completed_at = NOW() WHERE id = ANY(%s) AND user_id = %s RETURNING id", (log_ids, uid))
+            handled = [r[0] for r in c.fetchall()]
+            conn.commit()
+            if not handled:
+                # Чужое напоминание или запись уже удалена - записывать нечего
+                tg_answer_callback(cb_id, "\u274c Напоминание не найдено")
+                return
+            names = [name for log_id, name in shown if log_id in handled] if len(shown) > 1 else []
             tg_answer_callback(cb_id, "\u2705 Отлично! Записано.")
-            # Редактируем сообщение - убираем кнопки
-            original_text = message.get("text", "")
-            tg_edit_message(chat_id, message_id, original_text + "\n\n\u2705 _Принято!_")
-
-    elif data.startswith("rem_snooze_"):
-        # Отложить на час
-        parts = data.split("_")
-        if len(parts) >= 4:
-            rem_id = parts[2]
-            log_id = parts[3]
-            conn = get_db_connection()
-            if conn:
-                try:
-                    c = conn.cursor()
-                    c.execute("SELECT snooze_count FROM reminder_log WHERE id = %s", (log_id,))
-                    row = c.fetchone()
-                    if row:
-                        snooze_count = row[0]
-                        if snooze_count >= 3:
-                            tg_answer_callback(cb_id, "\u274c Лимит откладываний исчерпан (3/3)")
-                            tg_edit_message(chat_id, message_id, message.get("text", "") + "\n\n\u274c _Лимит откладываний исчерпан._")
-                        else:
-                            new_time = datetime.utcnow() + timedelta(hours=3) + timedelta(hours=1)
-                            c.execute("UPDATE reminder_log SET status = 'snoozed', snooze_count = %s, scheduled_time = %s WHERE id = %s",
-                                     (snooze_count + 1, new_time, log_id))
-                            conn.commit()
-                            left = 3 - snooze_count - 1
-                            tg_answer_callback(cb_id, "\u23f0 Напомню через час (осталось %s)" % left)
-                            tg_edit_message(chat_id, message_id, message.get("text", "") + "\n\n\u23f0 _Отложено на 1 час (%s/3)_" % (snooze_count + 1))
-                    else:
-                        tg_answer_callback(cb_id, "\u274c Напоминание не найдено")
-                except Exception as e:
-                    logger.error("Callback snooze error: %s", e)
-                finally:
-                    conn.close()
+            note = "\n\n\u2705 _Принято: %s_" % ", ".join(names) if names else "\n\n\u2705 _Принято!_"
+        else:
+            # Отложить на час, не больше 3 раз на дозу
+            new_time = datetime.utcnow() + timedelta(hours=3) + timedelta(hours=1)
+            c.execute("""UPDATE reminder_log SET status = 'snoozed', snooze_count = snooze_count + 1, scheduled_time = %s
+                         WHERE id = ANY(%s) AND user_id = %s AND snooze_count < 3 RETURNING id, snooze_count""", (new_time, log_ids, uid))
+            snoozed = c.fetchall()
+            conn.commit()
+            handled = [r[0] for r in snoozed]
+            names = [name for log_id, name in shown if log_id in handled] if len(shown) > 1 else []
+            if not snoozed:
+                tg_answer_callback(cb_id, "\u274c Лимит откладываний исчерпан (3/3)")
+                tg_edit_message(chat_id, message_id, original_text + "\n\n\u274c _Лимит откладываний исчерпан._")
+                return
+            cnt = max(r[1] for r in snoozed)
+            tg_answer_callback(cb_id, "\u23f0 Напомню через час (осталось %s)" % (3 - cnt))
+            note = "\n\n\u23f0 _Отложено на 1 час (%s/3)%s_" % (cnt, (": " + ", ".join(names)) if names else "")
+        rest = remaining_reminder_items(message.get("reply_markup"), handled)
+        tg_edit_message(chat_id, message_id, original_text + note, reminder_keyboard(rest) if rest else None)
+    except Exception as e:
+        logger.error("Callback %s error: %s", action, e)
+        try: conn.rollback()
+        except: pass
+    finally:
+        conn.close()
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
     try:
         data = flask_request.get_json(force=True)
         logger.info("Update received")
-        handle_update(data)
+        if UPDATE_QUEUE:
+            # Только сохранить: ответ Telegram за миллисекунды, обработка - в update_workers
+            if not enqueue_update(data):
+                return "Queue unavailable", 503
+        else:
+            handle_update_once(data)
     except Exception as e: logger.error("Webhook err: %s", e)
     return "OK", 200
 
+@app.before_request
+def _warmup_on_first_request():
+    # Обычно прогрев уже запущен хуком gunicorn (gunicorn.conf.py); импорт модуля (bench_*, eval_*) его не запускает
+    if not _warmup["started"]:
+        start_warmup()
+
 @app.route("/health", methods=["GET"])
 def health():
     return "OK", 200
 
-@app.route("/cron_reminders", methods=["GET", "POST"])
-def cron_reminders():
-    """Проверяет напоминания и отправляет уведомления"""
-    from datetime import datetime, timedelta
-    now = datetime.utcnow() + timedelta(hours=3)  # Moscow time
-    current_time = now.strftime("%H:%M")
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Готовность инстанса (схема, пул, клиенты прогреты) - в отличие от /health"""
+    if _warmup["ready"]:
+        return "READY", 200
+    start_warmup()
+    return json.dumps(_warmup["steps"]), 503, {"Content-Type": "application/json"}
+
+@app.route("/metrics", methods=["GET"])
+@admin_required
+def metrics():
+    out = {"db_pool": get_db_pool().snapshot(), "cron_reminders": last_cron_stats}
+    if reminder_scheduler:
+        out["reminder_scheduler"] = dict(reminder_scheduler.stats)
+    if update_workers:
+        out["update_workers"] = update_workers.snapshot()
+    out["update_dedup"] = update_dedup.snapshot()
+    out["openai"] = openai_metrics.snapshot()
+    out["intents"] = intent_stats.snapshot()
+    out["answer_cache"] = answer_cache.snapshot()
+    out["prompt"] = prompt_stats.snapshot()
+    out["prompt"]["static_prefix"] = prompt_prefix_stats()
+    out["commands"] = command_stats.snapshot()
+    return json.dumps(out), 200, {"Content-Type": "application/json"}
+
+# === Reminder fan-out ===
+
+class TokenBucket:
+    """Общий лимит отправки: rate сообщений в секунду, pause() - глобальная пауза после 429"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.blocked_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.blocked_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+tg_rate_limiter = TokenBucket(TG_RATE_PER_SEC)
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p / 100))]
+
+class ReminderFanout:
+    """Параллельная рассылка с общим token bucket, лимитом на чат и retry_after при 429"""
+    def __init__(self, workers=REMINDER_SEND_WORKERS, bucket=tg_rate_limiter, chat_interval=TG_CHAT_INTERVAL, retries=TG_SEND_RETRIES):
+        self.workers = workers
+        self.bucket = bucket
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self._chat_next = {}
+        self._lock = threading.Lock()
+        self.stats = {"delivered": 0, "failed": 0, "retried_429": 0}
+        self.lags = []
+        self.delivered_keys = []
+
+    def _wait_chat(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            t = max(now, self._chat_next.get(chat_id, 0))
+            self._chat_next[chat_id] = t + self.chat_interval
+        if t > now:
+            time.sleep(t - now)
+
+    def _send(self, job, started_wall):
+        chat_id, fn, keys = job
+        self._wait_chat(chat_id)
+        for _ in range(self.retries + 1):
+            self.bucket.acquire()
+            result = fn()
+            if result and result.get("ok"):
+                with self._lock:
+                    self.stats["delivered"] += 1
+                    self.lags.append((time.time() - started_wall) * 1000)
+                    self.delivered_keys.extend(keys)
+                return
+            retry_after = ((result or {}).get("parameters") or {}).get("retry_after")
+            if not retry_after:
+                # 400/403: бот заблокирован, чат удалён - повтор не поможет.
+                # None (таймаут): запрос мог дойти до Telegram - повтор прислал бы напоминание с кнопками дважды
+                break
+            with self._lock:
+                self.stats["retried_429"] += 1
+            self.bucket.pause(retry_after)
+        with self._lock:
+            self.stats["failed"] += 1
+
+    def run(self, jobs, fire_at_ts):
+        """jobs: [(chat_id, fn, keys)], fn() возвращает ответ tg_api без своих повторов на 429, keys доставленных - в delivered_keys.
+        Задержка считается от fire_at_ts (unix time)"""
+        from concurrent.futures import ThreadPoolExecutor
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs)), thread_name_prefix="fanout") as ex:
+                for f in [ex.submit(self._send, job, fire_at_ts) for job in jobs]:
+                    try: f.result()
+                    except Exception as e:
+                        logger.error("Fan-out err: %s", e)
+                        with self._lock:
+                            self.stats["failed"] += 1
+        with self._lock:
+            lags = sorted(self.lags)
+            st = dict(self.stats)
+        st.update({"lag_p50_ms": round(percentile(lags, 50)), "lag_p95_ms": round(percentile(lags, 95)), "lag_p99_ms": round(percentile(lags, 99))})
+        return st
+
+last_cron_stats = {}
+
+# reminder_log - очередь отправки: queued -> sending (захвачено воркером) -> pending (отправлено, ждём кнопку) / failed.
+# Шард - hash(user_id) mod shards: несколько воркеров делят минуту, дозы одного пользователя всегда в одном шарде
+SHARD_FILTER = "MOD(ABS(hashtext(%s::text)::bigint), %%(shards)s) = %%(shard)s"
+
+# Дозы этой минуты - в очередь. ON CONFLICT по (reminder_id, fire_time): повторный вызов ничего не добавит
+ENQUEUE_DUE_SQL = """
+INSERT INTO reminder_log (reminder_id, user_id, scheduled_time, fire_time, status)
+SELECT r.id, r.user_id, %(fire_at)s, %(fire_at)s, 'queued'
+FROM reminder_times t JOIN reminders r ON r.id = t.reminder_id
+WHERE t.fire_time = %(fire_time)s AND r.active = TRUE AND """ + SHARD_FILTER % "r.user_id" + """
+ON CONFLICT (reminder_id, fire_time) DO NOTHING
+"""
+
+# Отложенные, у которых подошло время - обратно в очередь
+REQUEUE_SNOOZED_SQL = """
+UPDATE reminder_log l SET status = 'queued'
+FROM reminders r
+WHERE l.status = 'snoozed' AND l.scheduled_time <= %(now)s AND l.snooze_count < 3 AND r.id = l.reminder_id AND r.active = TRUE
+  AND """ + SHARD_FILTER % "l.user_id"
+
+# Конкретные напоминания на конкретную минуту - так ставит в очередь встроенный планировщик
+ENQUEUE_IDS_SQL = """
+INSERT INTO reminder_log (reminder_id, user_id, scheduled_time, fire_time, status)
+SELECT r.id, r.user_id, %(fire_at)s, %(fire_at)s, 'queued'
+FROM reminders r WHERE r.id = ANY(%(ids)s) AND r.active = TRUE
+ON CONFLICT (reminder_id, fire_time) DO NOTHING
+"""
+
+# Захват пачки: SKIP LOCKED - параллельные воркеры берут разные строки, каждая доза уходит одному
+CLAIM_REMINDERS_SQL = """
+UPDATE reminder_log l SET status = 'sending', claimed_at = NOW()
+FROM reminders r
+WHERE r.id = l.reminder_id AND l.id IN (
+    SELECT id FROM reminder_log
+    WHERE (status = 'queued' OR (status = 'sending' AND claimed_at < NOW() - %(reclaim)s * INTERVAL '1 minute'))
+      AND """ + SHARD_FILTER % "user_id" + """
+    ORDER BY user_id, id LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED)
+RETURNING l.id, l.snooze_count, r.id, r.user_id, r.family_member, r.medicine_name, r.dosage, r.meal_relation, r.course_days, r.start_date, r.pills_per_dose
+"""
+
+def reminder_text(row, current_date):
+    log_id, snooze_cnt, rem_id, user_id, member, med_name, dosage, meal, course_days, start_date, pills = row
+    meal_text = ""
+    if meal:
+        meal_text = " (%s еды)" % meal
+    pills_text = ""
+    if pills and pills > 0:
+        pills_text = ", %s шт." % pills
+    if snooze_cnt:
+        msg = "\u23f0 **Напоминание** (повтор %s/3)\n\n" % snooze_cnt
+        msg += "\U0001f48a **%s**%s\n" % (med_name, pills_text)
+        if dosage:
+            msg += "Дозировка: %s\n" % dosage
+        return msg + "Для: %s%s" % (member, meal_text)
+    day_num = ""
+    if course_days and course_days > 0 and start_date:
+        day = (current_date - start_date).days + 1
+        day_num = "\nДень %s из %s" % (day, course_days)
+    msg = "\U0001f48a **Время принять лекарство!**\n\n"
+    msg += "**%s**%s\n" % (med_name, pills_text)
+    if dosage:
+        msg += "Дозировка: %s\n" % dosage
+    return msg + "Для: %s%s%s" % (member, meal_text, day_num)
+
+def grouped_reminder_text(rows, current_date):
+    """Несколько доз одному пользователю в одну минуту - одним сообщением"""
+    if len(rows) == 1:
+        return reminder_text(rows[0], current_date)
+    msg = "\U0001f48a **Время принять лекарства!**\n"
+    for n, row in enumerate(rows, 1):
+        log_id, snooze_cnt, rem_id, user_id, member, med_name, dosage, meal, course_days, start_date, pills = row
+        line = "\n%d. **%s**" % (n, med_name)
+        if pills and pills > 0:
+            line += ", %s шт." % pills
+        if dosage:
+            line += ", %s" % dosage
+        line += "\n    Для: %s" % member
+        if meal:
+            line += " (%s еды)" % meal
+        if snooze_cnt:
+            line += "\n    \u23f0 повтор %s/3" % snooze_cnt
+        elif course_days and course_days > 0 and start_date:
+            line += "\n    День %s из %s" % ((current_date - start_date).days + 1, course_days)
+        msg += line
+    return msg
+
+def process_reminders(now, shard=0, shards=1, enqueue_due=True):
+    """Один тик: закрыть курсы, поставить в очередь дозы этой минуты и отложенные, захватить и разослать.
+    enqueue_due=False - дозы уже поставил в очередь встроенный планировщик"""
+    fire_at = now.replace(second=0, microsecond=0)
     current_date = now.date()
+    params = {"fire_at": fire_at, "fire_time": fire_at.time(), "now": now, "shard": shard, "shards": shards,
+              "reclaim": CRON_RECLAIM_MINUTES, "limit": CRON_CLAIM_BATCH}
+    # Задержка доставки - от начала минуты (в UTC-эпохе, fire_at - московское время без зоны)
+    fire_at_ts = time.time() - (now - fire_at).total_seconds()
+    fanout = ReminderFanout()
     conn = get_db_connection()
     if not conn:
-        return "DB error", 500
+        return None
     try:
         c = conn.cursor()
-        # Получить все активные напоминания
-        c.execute("""SELECT r.id, r.user_id, r.family_member, r.medicine_name, r.dosage, 
-                     r.schedule_time, r.meal_relation, r.course_days, r.start_date, r.pills_per_dose
-                     FROM reminders r WHERE r.active = TRUE""")
-        reminders = c.fetchall()
-        sent_count = 0
-        for rem in reminders:
-            rem_id, user_id, member, med_name, dosage, schedule, meal, course_days, start_date, pills = rem
-            # Проверить не закончился ли курс
-            if course_days and course_days > 0 and start_date:
-                end_date = start_date + timedelta(days=course_days)
-                if current_date > end_date:
-                    c.execute("UPDATE reminders SET active = FALSE WHERE id = %s", (rem_id,))
-                    conn.commit()
-                    # Уведомить о завершении курса
-                    tg_send(user_id, "\u2705 Курс **%s** для %s завершён! Поздравляю!" % (med_name, member))
-                    continue
-            # Проверить совпадает ли время
-            if not schedule:
-                continue
-            times = [t.strip() for t in schedule.split(",")]
-            if current_time not in times:
-                # Проверить отложенные
-                c.execute("""SELECT id, snooze_count FROM reminder_log 
-                            WHERE reminder_id = %s AND status = 'snoozed' 
-                            AND scheduled_time <= %s AND snooze_count < 3""", (rem_id, now))
-                snoozed = c.fetchall()
-                for slog in snoozed:
-                    log_id, snooze_cnt = slog
-                    # Отправить повторно
-                    meal_text = ""
-                    if meal:
-                        meal_text = " (%s еды)" % meal
-                    pills_text = ""
-                    if pills and pills > 0:
-                        pills_text = ", %s шт." % pills
-                    msg = "\u23f0 **Напоминание** (повтор %s/3)\n\n" % (snooze_cnt + 1)
-                    msg += "\U0001f48a **%s**%s\n" % (med_name, pills_text)
-                    if dosage:
-                        msg += "Дозировка: %s\n" % dosage
-                    msg += "Для: %s%s" % (member, meal_text)
-                    msg_id = tg_send_reminder(user_id, msg, rem_id, log_id)
-                    sent_count += 1
-                continue
-            # Проверить не отправляли ли уже сегодня в это время
-            c.execute("""SELECT id FROM reminder_log 
-                        WHERE reminder_id = %s AND DATE(scheduled_time) = %s 
-                        AND status IN ('pending','snoozed','done')
-                        AND scheduled_time::time = %s::time""", (rem_id, current_date, current_time + ":00"))
-            already_sent = c.fetchone()
-            if already_sent:
-                continue
-            # Отправить напоминание
-            meal_text = ""
-            if meal:
-                meal_text = " (%s еды)" % meal
-            pills_text = ""
-            if pills and pills > 0:
-                pills_text = ", %s шт." % pills
-            day_num = ""
-            if course_days and course_days > 0 and start_date:
-                day = (current_date - start_date).days + 1
-                day_num = "\nДень %s из %s" % (day, course_days)
-            msg = "\U0001f48a **Время принять лекарство!**\n\n"
-            msg += "**%s**%s\n" % (med_name, pills_text)
-            if dosage:
-                msg += "Дозировка: %s\n" % dosage
-            msg += "Для: %s%s%s" % (member, meal_text, day_num)
-            # Создать запись в логе
-            sched_dt = datetime.combine(current_date, datetime.strptime(current_time, "%H:%M").time())
-            c.execute("""INSERT INTO reminder_log (reminder_id, user_id, scheduled_time, status) 
-                        VALUES (%s, %s, %s, 'pending') RETURNING id""", (rem_id, user_id, sched_dt))
-            log_id = c.fetchone()[0]
-            conn.commit()
-            msg_id = tg_send_reminder(user_id, msg, rem_id, log_id)
-            sent_count += 1
+        # Закончившиеся курсы: UPDATE ... RETURNING вернёт строку только тому, кто её переключил
+        c.execute("""UPDATE reminders SET active = FALSE
+                     WHERE active = TRUE AND course_days > 0 AND start_date + course_days < %(today)s AND """ + SHARD_FILTER % "user_id" + """
+                     RETURNING user_id, medicine_name, family_member, id""", dict(params, today=current_date))
+        finished = c.fetchall()
+        if enqueue_due:
+            c.execute(ENQUEUE_DUE_SQL, params)
+        c.execute(REQUEUE_SNOOZED_SQL, params)
         conn.commit()
-        return "OK, sent: %s" % sent_count, 200
-    except Exception as e:
-        logger.error("Cron reminders error: %s", e)
-        return "Error: %s" % str(e), 500
+        jobs = []
+        for user_id, med_name, member, rem_id in finished:
+            if reminder_scheduler:
+                reminder_scheduler.remove(rem_id)
+            text = "\u2705 Курс **%s** для %s завершён! Поздравляю!" % (med_name, member)
+            jobs.append((user_id, lambda u=user_id, t=text: tg_send(u, t, retry_429=False), []))  # 429 повторяет fanout
+        stats = fanout.run(jobs, fire_at_ts)
+        while True:
+            c.execute(CLAIM_REMINDERS_SQL, params)
+            # snooze_count в логе - сколько раз уже отложено, в тексте повтора номер на единицу больше
+            claimed = [(r[0], r[1] + 1 if r[1] else 0) + tuple(r[2:]) for r in c.fetchall()]
+            conn.commit()
+            if not claimed:
+                break
+            # Одно сообщение на пользователя за тик: у опекуна с пятью курсами в 08:00 - одно, а не пять
+            by_user = {}
+            for row in claimed:
+                by_user.setdefault(row[3], []).append(row)
+            jobs = []
+            for user_id, rows in by_user.items():
+                text = grouped_reminder_text(rows, current_date)
+                items = [(r[0], r[5]) for r in rows]
+                jobs.append((user_id, lambda u=user_id, t=text, i=items: tg_send_reminder(u, t, i), [r[0] for r in rows]))
+            delivered_before = len(fanout.delivered_keys)
+            stats = fanout.run(jobs, fire_at_ts)
+            ok_ids = fanout.delivered_keys[delivered_before:]
+            # status = 'sending': кнопку могли нажать раньше, чем мы сюда дошли
+            c.execute("""UPDATE reminder_log SET status = CASE WHEN id = ANY(%s) THEN 'pending' ELSE 'failed' END
+                         WHERE id = ANY(%s) AND status = 'sending'""", (ok_ids, [r[0] for r in claimed]))
+            conn.commit()
+            if len(claimed) < CRON_CLAIM_BATCH:
+                break
+        stats.update({"at": fire_at.isoformat(), "shard": "%s/%s" % (shard, shards)})
+        return stats
     finally:
         conn.close()
 
-@app.route("/cleanup_db", methods=["GET"])
-def cleanup_db():
+# === In-process reminder scheduler ===
+
+class ReminderScheduler:
+    """Колесо таймеров на сутки: слот на каждую минуту суток, в слоте - напоминания на это время.
+    Тик обходит только слоты прошедших минут, поэтому стоит O(сработавших) при любом числе активных.
+    Минуты считаются от эпохи по московскому времени, минута суток = минута % 1440."""
+    def __init__(self, on_due, loader=None, reload_minutes=SCHEDULER_RELOAD_MINUTES):
+        self.on_due = on_due  # on_due(fire_at, [reminder_id]) для каждой сработавшей минуты
+        self.loader = loader  # loader() -> строки для load()/sync(): всё активное из reminder_times
+        self.reload_minutes = reload_minutes
+        self._slots = [dict() for _ in range(1440)]  # минута суток -> {reminder_id: None}
+        self._active = {}     # reminder_id -> (минуты суток, последняя минута курса или None, первая минута или None)
+        self._cursor = None   # последняя обработанная минута
+        self._lock = threading.Lock()
+        self.stats = {"ticks": 0, "fired": 0, "active": 0, "reloads": 0, "reload_errors": 0}
+
+    @staticmethod
+    def to_minute(dt):
+        from datetime import datetime
+        return int((dt - datetime(1970, 1, 1)).total_seconds() // 60)
+
+    @staticmethod
+    def from_minute(m):
+        from datetime import datetime, timedelta
+        return datetime(1970, 1, 1) + timedelta(minutes=m)
+
+    def _put(self, rid, times, end_date, since=None):
+        from datetime import datetime, time as dtime
+        self._drop(rid)
+        tods = set()
+        for t in times:
+            h, mi = t.split(":")
+            tods.add(int(h) * 60 + int(mi))
+        end_m = self.to_minute(datetime.combine(end_date, dtime(23, 59))) if end_date else None
+        # Слоты раньше создания напоминания при догоне не срабатывают
+        self._active[rid] = (tods, end_m, self.to_minute(since) if since else None)
+        for tod in tods:
+            self._slots[tod][rid] = None
+
+    def _drop(self, rid):
+        old = self._active.pop(rid, None)
+        if old:
+            for tod in old[0]:
+                self._slots[tod].pop(rid, None)
+
+    def load(self, reminders, since):
+        """reminders: [(reminder_id, ['HH:MM'], последний день курса или None, создано - МСК)].
+        С since досылается пропущенное, но не раньше создания напоминания"""
+        with self._lock:
+            self._slots = [dict() for _ in range(1440)]
+            self._active.clear()
+            for rid, times, end_date, created in reminders:
+                self._put(rid, times, end_date, created)
+            self._cursor = self.to_minute(since) - 1
+            self.stats["active"] = len(self._active)
+
+    def sync(self, reminders, window):
+        """Перечитанное расписание вместо текущего, курсор не трогается. Новые напоминания (созданы на другом инстансе)
+        досылаются за последние window минут, но не раньше создания: {минута: [reminder_id]}"""
+        with self._lock:
+            known = set(self._active)
+            self._slots = [dict() for _ in range(1440)]
+            self._active.clear()
+            for rid, times, end_date, created in reminders:
+                self._put(rid, times, end_date, created)
+            due = {}
+            if self._cursor is not None:
+                for rid in set(self._active) - known:
+                    tods, end_m, start_m = self._active[rid]
+                    for m in range(max(self._cursor - window + 1, start_m if start_m is not None else 0), self._cursor + 1):
+                        if m % 1440 in tods and (end_m is None or m <= end_m):
+                            due.setdefault(m, []).append(rid)
+            self.stats["active"] = len(self._active)
+            self.stats["reloads"] += 1
+            self.stats["fired"] += sum(len(v) for v in due.values())
+        return due
+
+    def add(self, rid, times, end_date=None, since=None):
+        with self._lock:
+            self._put(rid, times, end_date, since)
+            self.stats["active"] = len(self._active)
+
+    def remove(self, rid):
+        with self._lock:
+            self._drop(rid)
+            self.stats["active"] = len(self._active)
+
+    def tick(self, now):
+        """Всё, что сработало с прошлого тика по now: {минута: [reminder_id]}"""
+        now_m = self.to_minute(now)
+        due = {}
+        with self._lock:
+            if self._cursor is None:
+                self._cursor = now_m - 1
+            # Больше суток назад догонять нечего - те же слоты пошли бы по второму кругу
+            for m in range(max(self._cursor + 1, now_m - 1439), now_m + 1):
+                slot = self._slots[m % 1440]
+                if not slot:
+                    continue
+                ids = []
+                for rid in list(slot):
+                    _, end_m, start_m = self._active[rid]
+                    if end_m is not None and m > end_m:
+                        self._drop(rid)  # курс закончился
+                    elif start_m is None or m >= start_m:
+                        ids.append(rid)
+                if ids:
+                    due[m] = ids
+            self._cursor = max(self._cursor, now_m)
+            self.stats["ticks"] += 1
+            self.stats["fired"] += sum(len(v) for v in due.values())
+            self.stats["active"] = len(self._active)
+        return due
+
+    def run_forever(self):
+        from datetime import datetime, timedelta
+        next_reload = time.monotonic() + self.reload_minutes * 60
+        while True:
+            now = datetime.utcnow() + timedelta(hours=3)
+            if self.loader and self.reload_minutes > 0 and time.monotonic() >= next_reload:
+                # Колесо своё у каждого процесса: добавленное и выключенное на других инстансах видно только из БД
+                next_reload = time.monotonic() + self.reload_minutes * 60
+                try:
+                    for m, rids in sorted(self.sync(self.loader(), self.reload_minutes * 2).items()):
+                        self.on_due(self.from_minute(m), rids)
+                except Exception as e:
+                    logger.error("Scheduler reload err: %s", e)
+                    with self._lock:
+                        self.stats["reload_errors"] += 1
+            try:
+                for m, rids in sorted(self.tick(now).items()):
+                    self.on_due(self.from_minute(m), rids)
+                process_reminders(now, enqueue_due=False)  # отложенные, курсы, отправка
+            except Exception as e:
+                logger.error("Scheduler err: %s", e)
+            now = datetime.utcnow() + timedelta(hours=3)
+            time.sleep(max(60 - now.second - now.microsecond / 1e6, 0.05))  # до начала следующей минуты
+
+reminder_scheduler = None
+
+def enqueue_reminders(fire_at, reminder_ids):
     conn = get_db_connection()
-    if not conn:
-        return "DB connection FAILED", 500
+    if not conn: return
     try:
         c = conn.cursor()
-        # Удалить не-лекарства из inventory
-        c.execute("DELETE FROM inventory WHERE LOWER(medicine_name) IN ('лев', 'циньян', 'ян', 'анна')")
-        inv_del = c.rowcount
-        # Удалить дубли из family
-        c.execute("""DELETE FROM family WHERE id NOT IN (
-            SELECT MIN(id) FROM family GROUP BY user_id, LOWER(name)
-        )""")
-        fam_dedup = c.rowcount
-        # Удалить шаблонные записи
-        c.execute("""CREATE TABLE IF NOT EXISTS reminder_log (
-            id SERIAL PRIMARY KEY,
-            reminder_id INTEGER NOT NULL,
-            user_id BIGINT NOT NULL,
-            scheduled_time TIMESTAMP NOT NULL,
-            status TEXT DEFAULT 'pending',
-            snooze_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT NOW(),
-            completed_at TIMESTAMP
-        )""")
-        c.execute("DELETE FROM family WHERE LOWER(name) IN ('имя','name','test','член_семьи')")
-        fam_tpl = c.rowcount
+        c.execute(ENQUEUE_IDS_SQL, {"fire_at": fire_at, "ids": reminder_ids})
         conn.commit()
-        return "Cleanup done. Inv removed: %s, Family deduped: %s, Family templates: %s" % (inv_del, fam_dedup, fam_tpl), 200
     except Exception as e:
-        return "Error: %s" % str(e), 500
+        logger.error("Enqueue reminders err: %s", e)
+        try: conn.rollback()
+        except: pass
+    finally: conn.close()
+
+def load_reminder_times():
+    """[(reminder_id, ['HH:MM'], последний день курса или None, создано - МСК)] всех активных напоминаний"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("no DB connection")
+    try:
+        c = conn.cursor()
+        # created_at - UTC (CURRENT_TIMESTAMP сервера БД), колесо - по МСК
+        c.execute("""SELECT r.id, array_agg(to_char(t.fire_time, 'HH24:MI')), CASE WHEN r.course_days > 0 THEN r.start_date + r.course_days END,
+                            GREATEST(r.created_at + INTERVAL '3 hours', r.start_date::timestamp)
+                     FROM reminder_times t JOIN reminders r ON r.id = t.reminder_id
+                     WHERE r.active = TRUE GROUP BY r.id""")
+        return c.fetchall()
     finally:
         conn.close()
 
+def start_reminder_scheduler():
+    """Загрузить расписание из reminder_times и запустить поток; пропущенное за SCHEDULER_CATCHUP_MINUTES досылается.
+    Каждые SCHEDULER_RELOAD_MINUTES расписание перечитывается - инстансов и воркеров gunicorn может быть несколько"""
+    global reminder_scheduler
+    from datetime import datetime, timedelta
+    if reminder_scheduler:
+        return
+    rows = load_reminder_times()
+    sched = ReminderScheduler(enqueue_reminders, load_reminder_times)
+    now = datetime.utcnow() + timedelta(hours=3)
+    # Повторная постановка уже отправленного - no-op благодаря ON CONFLICT (reminder_id, fire_time)
+    sched.load(rows, now - timedelta(minutes=SCHEDULER_CATCHUP_MINUTES))
+    reminder_scheduler = sched
+    threading.Thread(target=sched.run_forever, name="reminder-scheduler", daemon=True).start()
+    logger.info("Reminder scheduler started: %s reminders", len(rows))
+
+if REMINDER_SCHEDULER == "inprocess":
+    WARMUP_STEPS.append(("scheduler", start_reminder_scheduler))
+
+@app.route("/cron_reminders", methods=["GET", "POST"])
+def cron_reminders():
+    """Проверяет напоминания и отправляет уведомления. ?shard=i&shards=N - своя доля пользователей"""
+    from datetime import datetime, timedelta
+    now = datetime.utcnow() + timedelta(hours=3)  # Moscow time
+    try:
+        shards = max(1, int(flask_request.args.get("shards", 1)))
+        shard = int(flask_request.args.get("shard", 0)) % shards
+    except ValueError:
+        return "Bad shard", 400
+    try:
+        stats = process_reminders(now, shard, shards)
+    except Exception as e:
+        logger.error("Cron reminders error: %s", e)
+        return "Error: %s" % str(e), 500
+    if stats is None:
+        return "DB error", 500
+    last_cron_stats.clear()
+    last_cron_stats.update(stats)
+    logger.info("Cron reminders: %s", stats)
+    return "OK, sent: %(delivered)s, failed: %(failed)s, lag p50/p95/p99: %(lag_p50_ms)s/%(lag_p95_ms)s/%(lag_p99_ms)s ms" % stats, 200
+
+@app.route("/cleanup_db", methods=["GET"])
+@admin_required
+def cleanup_db():
+    done = run_maintenance()
+    if done is None:
+        return "Cleanup FAILED", 500
+    return "Cleanup done. " + ", ".join(["%s: %s" % d for d in done]), 200
+
 @app.route("/debug_db", methods=["GET"])
+@admin_required
 def debug_db():
     conn = get_db_connection()
     if not conn:
@@ -1239,11 +4104,25 @@ def debug_db():
 def index():
     return "Bot running!", 200
 
-try:
-    init_db()
-except Exception as e:
-    logger.error("Init failed: %s", e)
-
 if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "migrate":
+        sys.exit(0 if migrate() else 1)
+    elif cmd == "maintenance":
+        sys.exit(0 if run_maintenance() is not None else 1)
+    elif cmd == "requeue_dead":
+        n = requeue_dead_updates()
+        print("Requeued: %s" % n)
+        sys.exit(0 if n is not None else 1)
+    elif cmd == "check_plans":
+        plans = check_query_plans()
+        if plans is None:
+            sys.exit(1)
+        for name, ok, plan in plans:
+            print("%s %s" % ("OK  " if ok else "SEQ ", name))
+            if not ok:
+                print(plan)
+        sys.exit(0 if all(ok for _, ok, _ in plans) else 1)
+    start_warmup()
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,40 @@
+# eval_intents.py - точность локального разбора просьб (bot.parse_intent) на размеченном корпусе
+# БД не нужна. Запуск: python eval_intents.py [intents_corpus.tsv]
+# Главное - precision: ошибочно разобранная просьба выполняется без GPT, а непонятая просто уходит в GPT
+import sys
+import bot
+
+path = sys.argv[1] if len(sys.argv) > 1 else "intents_corpus.tsv"
+rows = []
+with open(path, encoding="utf-8") as f:
+    for line in f:
+        if line.strip() and not line.startswith("#"):
+            text, intent, arg = (line.rstrip("\n").split("\t") + ["", ""])[:3]
+            rows.append((text, None if intent == "-" else intent, arg))
+
+tp, fp, fn, tn = 0, 0, 0, 0
+per_intent = {}
+for text, intent, arg in rows:
+    got = bot.parse_intent(text)
+    expected = (intent, arg) if intent else None
+    st = per_intent.setdefault(intent or (got[0] if got else "-"), {"tp": 0, "fp": 0, "fn": 0})
+    if got and got == expected:
+        tp += 1; st["tp"] += 1
+    elif got:
+        fp += 1; st["fp"] += 1  # разобрали, но не так: самое опасное
+        print("WRONG  %-45s got %s, expected %s" % (text, got, expected))
+    elif expected:
+        fn += 1; st["fn"] += 1
+        print("MISSED %-45s expected %s" % (text, expected))
+    else:
+        tn += 1
+
+print()
+for intent, st in sorted(per_intent.items()):
+    if intent != "-":
+        prec = st["tp"] / (st["tp"] + st["fp"]) if st["tp"] + st["fp"] else 1.0
+        rec = st["tp"] / (st["tp"] + st["fn"]) if st["tp"] + st["fn"] else 1.0
+        print("%-16s precision %.2f  recall %.2f  (%s)" % (intent, prec, rec, st))
+print("total %s: precision %.3f, recall %.3f, handled locally %.0f%%" % (
+    len(rows), tp / (tp + fp) if tp + fp else 1.0, tp / (tp + fn) if tp + fn else 1.0, 100.0 * (tp + fp) / len(rows)))
+sys.exit(1 if fp else 0)
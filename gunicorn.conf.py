@@ -0,0 +1,6 @@
+# gunicorn читает этот файл из рабочей директории сам (CMD в Dockerfile)
+
+def post_worker_init(worker):
+    # Схема, пул, клиенты OpenAI/Telegram, воркеры очереди - в фоне, до первого запроса
+    from bot import start_warmup
+    start_warmup()
@@ -0,0 +1,68 @@
+# tg_stub.py - локальная заглушка Telegram Bot API для офлайн-замеров
+# Запуск: python tg_stub.py [порт], затем TELEGRAM_API_BASE=http://127.0.0.1:8081 для бота
+# STUB_DELAY_MS - искусственная задержка ответа (имитация сети до api.telegram.org)
+import sys, os, json, time, threading, itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DELAY = float(os.environ.get("STUB_DELAY_MS", "0")) / 1000
+_msg_ids = itertools.count(1)
+_lock = threading.Lock()
+calls = {}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+    disable_nagle_algorithm = True  # иначе на keep-alive ответ ждёт delayed ACK клиента (~40 мс)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body, content_type="application/json"):
+        if DELAY:
+            time.sleep(DELAY)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, data):
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "file":
+            return self._reply(200, b"\x00" * 2048, "application/octet-stream")
+        method = parts[-1]
+        with _lock:
+            calls[method] = calls.get(method, 0) + 1
+        if method == "sendMessage":
+            result = {"message_id": next(_msg_ids), "chat": {"id": data.get("chat_id")}, "date": int(time.time()), "text": data.get("text", "")}
+        elif method == "getFile":
+            result = {"file_id": data.get("file_id"), "file_path": "voice/file_0.oga"}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        self._reply(200, json.dumps({"ok": True, "result": result}).encode("utf-8"))
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        try: data = json.loads(raw.decode("utf-8")) if raw else {}
+        except ValueError: data = {}
+        self._handle(data)
+
+def serve(port=8081):
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    serve(port)
+    print("Telegram stub on http://127.0.0.1:%s" % port)
+    while True:
+        time.sleep(3600)